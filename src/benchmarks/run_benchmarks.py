@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+""" Benchmark suite over synthetic register data: the make_dataset stages,
+    fitting and applying the feature union, training every model_params
+    estimator, single-row and batch prediction and the approximate against
+    the brute-force knn.
+
+    Timings and peak memory are stored as json under reports/benchmarks, named
+    by date and commit, and compared against a previous run to flag
+    regressions.
+"""
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import warnings
+from datetime import datetime
+from os.path import join as pj
+from pathlib import Path
+import click
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.base import clone
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+from src.data import make_dataset
+from src.data.memory import peak_rss, reset_peak_rss
+from src.data.synthetic import generate_raw
+from src.features.build_features import TEXT_VECTORIZERS, make_feature_union, text_vectorizer_name
+from src.features.sparse_union import uncenter_sparse_scalers
+from src.models.approximate_knn import ApproximateKNeighborsClassifier
+from src.models.artifact import save_artifact
+from src.models.export_model import export_linear
+from src.models.model_params import parameters
+from src.models.predict_model import load_model
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREDICT_ROWS = '10000,100000,1000000'
+
+
+class Recorder:
+    """ Collects the wall-clock time and peak RSS of named steps."""
+    def __init__(self):
+        self.results = []
+
+    def measure(self, name, func, *args, rows=None, **kwargs):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        record = {'name': name, 'seconds': seconds, 'peak_rss_mb': peak_rss() / 1024 ** 2}
+        if rows is not None:
+            record['rows'] = rows
+            record['rows_per_s'] = rows / seconds if seconds else None
+        self.results.append(record)
+        logger.info(f'{name}: {seconds:.3f}s, peak RSS {record["peak_rss_mb"]:.0f} MB')
+        return result
+
+    def add(self, name, **values):
+        self.results.append({'name': name, **values})
+        logger.info(f'{name}: ' + ', '.join(f'{k} {v:.3f}' for k, v in values.items()))
+
+    def fail(self, name, error):
+        self.results.append({'name': name, 'error': repr(error)})
+        logger.warning(f'{name} failed: {error!r}')
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        'commit': _git('rev-parse', '--short', 'HEAD'),
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'python': platform.python_version(),
+        'sklearn': sklearn.__version__,
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'machine': platform.machine()
+    }
+
+
+def bench_make_dataset(recorder, raw_dir):
+    """ Times each make_dataset stage and the merge, returning the processed data."""
+    stages = {}
+    for name, load in [('activities', make_dataset.load_activities),
+                       ('classifications', make_dataset.load_classifications),
+                       ('financials', make_dataset.load_financials),
+                       ('charitybase', make_dataset.load_charitybase),
+                       ('self_class', make_dataset.load_self_class)]:
+        stages[name] = recorder.measure(f'make_dataset/{name}', load, raw_dir)
+    merged = recorder.measure('make_dataset/merge', make_dataset.merge_stages, stages)
+    return recorder.measure('make_dataset/finalise', make_dataset.finalise, merged)
+
+
+def make_union(text_features):
+    union = make_feature_union(text_features)
+    # as train_model configures it: the sparse blocks are not centred
+    for _, transformer in union.transformer_list:
+        uncenter_sparse_scalers(transformer)
+    return union
+
+
+def bench_features(recorder, data, text_features):
+    for kind in text_features:
+        union = make_union(kind)
+        recorder.measure(f'features/{kind}/fit_transform', union.fit_transform, data, rows=len(data))
+        recorder.measure(f'features/{kind}/transform', union.transform, data, rows=len(data))
+
+
+def first_candidate(param_grid):
+    """ The first value of every parameter of a grid."""
+    return {name: values[0] for name, values in param_grid.items()}
+
+
+def bench_training(recorder, X, y, estimators):
+    """ Fits each estimator's pipeline with the first candidate of its grid,
+        returning the fitted pipelines.
+    """
+    models = {}
+    for name in estimators:
+        with warnings.catch_warnings():
+            # the first candidates aren't tuned to converge
+            warnings.simplefilter('ignore')
+            try:
+                union = make_union('count')
+                params = parameters(text_vectorizer_name(union))[0][name]
+                pipe = Pipeline([('featureunion', union), ('clf', clone(params['estimator']))])
+                pipe.set_params(**first_candidate(params['param_grid']))
+                models[name] = recorder.measure(f'train/{name}', pipe.fit, X, y, rows=len(X))
+            except Exception as e:
+                # an unknown estimator or a grid the installed sklearn rejects
+                # shouldn't stop the other benchmarks
+                recorder.fail(f'train/{name}', e)
+    return models
+
+
+def bench_predict(recorder, model, name, data, work_dir, batch_rows, n_single=50):
+    """ Single-row latency and batch throughput of predict_model.load_model
+        on a saved model, and on its numpy-only export where it has one.
+    """
+    artifact = save_artifact(model, {'estimator': name}, pj(work_dir, f'model_{name}'))[0]
+    predictors = {'sklearn': recorder.measure(f'predict/{name}/sklearn/load', load_model, artifact)}
+    try:
+        export_linear(model, pj(work_dir, f'export_{name}'))
+        predictors['export'] = recorder.measure(f'predict/{name}/export/load', load_model,
+                                                pj(work_dir, f'export_{name}'))
+    except ValueError as e:
+        logger.info(f'no export of {name}: {e}')
+
+    rows = [data.iloc[[i]] for i in range(min(n_single, len(data)))]
+    for kind, predictor in predictors.items():
+        def single():
+            for row in rows:
+                predictor.predict(row)
+        recorder.measure(f'predict/{name}/{kind}/single', single, rows=len(rows))
+        for n_rows in batch_rows:
+            # the processed rows repeated up to the batch size
+            batch = data.iloc[np.arange(n_rows) % len(data)]
+            recorder.measure(f'predict/{name}/{kind}/batch_{n_rows}', predictor.predict, batch, rows=n_rows)
+
+
+def _recall(found, true):
+    # share of the true neighbours among those found, per query
+    return np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, true)])
+
+
+def bench_knn(recorder, X, y, queries, y_queries, probes, n_neighbors=5):
+    """ Fit and prediction time of the brute-force knn against the
+        approximate one at each of `probes` cells probed, with the recall of
+        the approximate index against an exact search of the same reduced
+        rows and the accuracy of both on `queries`.
+    """
+    union = make_union('count')
+    X = recorder.measure('knn/features/fit_transform', union.fit_transform, X, rows=len(X))
+    queries = union.transform(queries)
+
+    brute = recorder.measure('knn/brute/fit', KNeighborsClassifier(n_neighbors, algorithm='brute').fit, X, y,
+                             rows=X.shape[0])
+    predicted = recorder.measure('knn/brute/predict', brute.predict, queries, rows=queries.shape[0])
+    recorder.add('knn/brute/quality', accuracy=np.mean(predicted == y_queries))
+
+    ann = ApproximateKNeighborsClassifier(n_neighbors, random_state=0)
+    ann = recorder.measure('knn/ann/fit', ann.fit, X, y, rows=X.shape[0])
+    # a single cell holding every row is an exact search of the reduced rows
+    exact = ann.set_params(n_probe=len(ann.centroids_)).kneighbors(queries, return_distance=False)
+    for n_probe in probes:
+        ann.set_params(n_probe=n_probe)
+        predicted = recorder.measure(f'knn/ann/probe_{n_probe}/predict', ann.predict, queries,
+                                     rows=queries.shape[0])
+        found = ann.kneighbors(queries, return_distance=False)
+        recorder.add(f'knn/ann/probe_{n_probe}/quality', recall=_recall(found, exact),
+                     accuracy=np.mean(predicted == y_queries))
+
+
+def compare(results, baseline, tolerance, min_delta=0.05, log=logger):
+    """ Logs each step's time against `baseline` and returns the names of the
+        steps more than `tolerance` times and `min_delta` seconds slower (the
+        shortest steps are mostly noise).
+    """
+    before = {r['name']: r for r in baseline['results']}
+    regressions = []
+    log.info(f'against {baseline["environment"].get("commit")} of {baseline["date"]}:')
+    log.info(f'{"step":45}{"before s":>10}{"after s":>10}{"ratio":>8}')
+    for r in results:
+        if 'seconds' not in r or 'seconds' not in before.get(r['name'], {}):
+            continue
+        ratio = r['seconds'] / before[r['name']]['seconds'] if before[r['name']]['seconds'] else float('inf')
+        flag = ''
+        if ratio > tolerance and r['seconds'] - before[r['name']]['seconds'] > min_delta:
+            regressions.append(r['name'])
+            flag = '  REGRESSION'
+        log.info(f'{r["name"]:45}{before[r["name"]]["seconds"]:>10.3f}{r["seconds"]:>10.3f}{ratio:>7.2f}x{flag}')
+    return regressions
+
+
+@click.command()
+@click.option('--n-charities', 'n_charities', default=170000, type=int)
+@click.option('--seed', 'seed', default=0, type=int)
+@click.option('--work-dir', 'work_dir', default=None,
+              help='Where the synthetic data and models go; a temporary directory if not given.')
+@click.option('--suites', 'suites', default='make_dataset,features,train,predict,knn',
+              help='Comma separated subset of make_dataset, features, train, predict and knn.')
+@click.option('--text-features', 'text_features', default=','.join(TEXT_VECTORIZERS))
+@click.option('--estimators', 'estimators', default=None,
+              help='Comma separated model_params estimators to train; all of them if not given.')
+@click.option('--train-rows', 'train_rows', default=20000, type=int)
+@click.option('--predict-estimator', 'predict_estimator', default='logit')
+@click.option('--predict-rows', 'predict_rows', default=DEFAULT_PREDICT_ROWS)
+@click.option('--knn-queries', 'knn_queries', default=2000, type=int,
+              help='Charities the knn benchmark classifies, besides the --train-rows it indexes.')
+@click.option('--knn-probes', 'knn_probes', default='1,4,16',
+              help='Comma separated numbers of cells the approximate knn probes.')
+@click.option('--results-dir', 'results_dir', default=None, help='Defaults to reports/benchmarks.')
+@click.option('--baseline', 'baseline', default=None,
+              help='Results file to compare against; "latest" for the newest one in the results dir.')
+@click.option('--tolerance', 'tolerance', default=1.25, type=float,
+              help='Slowdown ratio above which a step is reported as a regression.')
+def main(n_charities, seed, work_dir, suites, text_features, estimators, train_rows, predict_estimator,
+         predict_rows, knn_queries, knn_probes, results_dir, baseline, tolerance):
+    """ Runs the benchmarks on synthetic data and stores the results."""
+    suites = suites.split(',')
+    results_dir = results_dir or pj(project_dir, 'reports', 'benchmarks')
+    os.makedirs(results_dir, exist_ok=True)
+    if baseline == 'latest':
+        previous = sorted(glob.glob(pj(results_dir, 'benchmark_*.json')))
+        baseline = previous[-1] if previous else None
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline = json.load(f)
+
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark_')
+    recorder = Recorder()
+    try:
+        raw_dir = pj(work_dir, 'raw')
+        if not os.path.exists(pj(raw_dir, 'cc_class.csv')):
+            recorder.measure('synthetic/generate', generate_raw, raw_dir, n_charities, seed=seed)
+        if 'make_dataset' in suites or not os.path.exists(pj(work_dir, 'data.pkl')):
+            data = bench_make_dataset(recorder, raw_dir)
+            data.to_pickle(pj(work_dir, 'data.pkl'))
+        else:
+            data = pd.read_pickle(pj(work_dir, 'data.pkl'))
+        y = data.pop('icnpo')
+
+        if 'features' in suites:
+            bench_features(recorder, data, text_features.split(','))
+
+        models = {}
+        if 'train' in suites or 'predict' in suites:
+            train = data.sample(min(train_rows, len(data)), random_state=seed)
+            names = estimators.split(',') if estimators else list(parameters()[0])
+            if 'train' not in suites:
+                names = [predict_estimator]
+            models = bench_training(recorder, train, y[train.index], names)
+
+        if 'predict' in suites and predict_estimator not in models:
+            # its training failed (and was recorded) or it wasn't among the estimators
+            recorder.fail(f'predict/{predict_estimator}', ValueError(f'{predict_estimator} was not trained'))
+        elif 'predict' in suites:
+            batch_rows = [int(n) for n in predict_rows.split(',') if n]
+            bench_predict(recorder, models[predict_estimator], predict_estimator, data, work_dir, batch_rows)
+
+        if 'knn' in suites:
+            sample = data.sample(min(train_rows + knn_queries, len(data)), random_state=seed)
+            queries, train = sample.iloc[:knn_queries], sample.iloc[knn_queries:]
+            bench_knn(recorder, train, y[train.index].values, queries, y[queries.index].values,
+                      [int(n) for n in knn_probes.split(',') if n])
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir)
+
+    run = {
+        'date': datetime.now().isoformat(),
+        'environment': environment(),
+        'config': {'n_charities': n_charities, 'seed': seed, 'suites': suites, 'train_rows': train_rows,
+                   'predict_estimator': predict_estimator, 'predict_rows': predict_rows,
+                   'knn_queries': knn_queries, 'knn_probes': knn_probes},
+        'results': recorder.results
+    }
+    path = pj(results_dir, f'benchmark_{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}_'
+                           f'{run["environment"]["commit"] or "unknown"}.json')
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=2)
+    logger.info(f'results saved to {path}')
+
+    if baseline is not None:
+        regressions = compare(recorder.results, baseline, tolerance)
+        if regressions:
+            logger.warning(f'{len(regressions)} steps regressed beyond {tolerance}x: {regressions}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    main()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from os.path import join as pj
+import boto3
+import botocore
+from src.data.s3_transfer import download_files, transfer_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+
+
+def file_md5(path, blocksize=8 * 1024 ** 2):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class S3Source:
+    """ Artifacts stored in an S3 bucket, identified by their ETag. Large objects
+        are fetched as concurrent ranged gets.
+    """
+    def __init__(self, bucket_name, client=None, config=None):
+        self.bucket_name = bucket_name
+        self.client = client or boto3.client('s3')
+        self.config = config or transfer_config()
+
+    def head(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+                raise FileNotFoundError(f's3://{self.bucket_name}/{key}')
+            raise
+        return {'etag': response['ETag'].strip('"'), 'size': response['ContentLength']}
+
+    def download(self, key, dest):
+        self.client.download_file(self.bucket_name, key, dest, Config=self.config)
+
+
+class LocalSource:
+    """ A local directory standing in for the bucket, e.g. for offline runs.
+        The ETag is the md5 of the content, as S3 reports for single-part uploads.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def head(self, key):
+        path = pj(self.root, key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return {'etag': file_md5(path), 'size': os.path.getsize(path)}
+
+    def download(self, key, dest):
+        shutil.copyfile(pj(self.root, key), dest)
+
+
+class ArtifactCache:
+    """ On-disk cache of bucket artifacts keyed by (key, ETag).
+
+        Entries are validated against their content hash when downloaded and
+        their size on every hit; the least recently used entries are evicted
+        once the cache holds more than `max_bytes`.
+    """
+    def __init__(self, source, cache_dir, max_bytes=DEFAULT_MAX_BYTES, verify=False):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # re-hash cached files on every hit, not just on download
+        self.verify = verify
+        os.makedirs(pj(cache_dir, 'objects'), exist_ok=True)
+        self._index_path = pj(cache_dir, 'index.json')
+
+    @contextmanager
+    def _locked_index(self):
+        # the index is shared by every process on the worker
+        with open(pj(self.cache_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = {}
+                if os.path.exists(self._index_path):
+                    with open(self._index_path) as f:
+                        index = json.load(f)
+                yield index
+                tmp_path = self._index_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, self._index_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry_path(self, key, etag):
+        name = hashlib.sha1(f'{key}:{etag}'.encode()).hexdigest()
+        return pj(self.cache_dir, 'objects', name)
+
+    def _is_valid(self, entry, path):
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            return False
+        if self.verify:
+            return file_md5(path) == entry['md5']
+        return True
+
+    def fetch(self, key):
+        """ Returns a local path holding the current content of `key`."""
+        head = self.source.head(key)
+        etag = head['etag']
+        path = self._entry_path(key, etag)
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if entry is not None and entry['etag'] == etag and self._is_valid(entry, path):
+                entry['last_used'] = time.time()
+                logger.info(f'artifact cache hit: {key}')
+                return path
+
+        # download outside the lock so other keys can be fetched concurrently
+        logger.info(f'artifact cache miss: {key}')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+        try:
+            self.source.download(key, tmp_path)
+            # the transfer is only complete once every byte is on disk and
+            # multipart ETags ("<md5>-<parts>") are not a hash of the content
+            size = os.path.getsize(tmp_path)
+            if size != head['size']:
+                raise IOError(f'incomplete download of {key}: {size} of {head["size"]} bytes')
+            md5 = file_md5(tmp_path)
+            if '-' not in etag and md5 != etag:
+                raise IOError(f'content hash mismatch for {key}: {md5} != {etag}')
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if entry is not None and entry['etag'] != etag:
+                self._remove(index, key)
+            os.replace(tmp_path, path)
+            index[key] = {
+                'etag': etag,
+                'md5': md5,
+                'size': size,
+                'last_used': time.time()
+            }
+            self._evict(index, keep=key)
+        return path
+
+    def fetch_to(self, key, dest):
+        """ Copies the cached content of `key` to `dest`."""
+        path = self.fetch(key)
+        shutil.copyfile(path, dest)
+        return dest
+
+    def fetch_many(self, keys_to_paths, max_workers=6):
+        """ fetch_to for several keys concurrently."""
+        return download_files(self.fetch_to, keys_to_paths, max_workers)
+
+    def _remove(self, index, key):
+        entry = index.pop(key)
+        path = self._entry_path(key, entry['etag'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _evict(self, index, keep=None):
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]['size']
+            logger.info(f'artifact cache evicting: {key}')
+            self._remove(index, key)
+
+
+def get_artifact_cache(bucket_name=None):
+    """ Builds the cache from the environment. ARTIFACT_SOURCE_DIR replaces the
+        bucket with a local directory; ARTIFACT_CACHE_DIR and
+        ARTIFACT_CACHE_MAX_BYTES configure the cache itself.
+    """
+    source_dir = os.environ.get('ARTIFACT_SOURCE_DIR')
+    if source_dir:
+        source = LocalSource(source_dir)
+    else:
+        source = S3Source(bucket_name or os.environ.get('BUCKET'))
+    cache_dir = os.environ.get('ARTIFACT_CACHE_DIR',
+                               pj(os.path.expanduser('~'), '.cache', 'char-class'))
+    max_bytes = int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+    return ArtifactCache(source, cache_dir, max_bytes)
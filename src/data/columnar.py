@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import logging
+from sklearn.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+# low-cardinality string columns stored dictionary-encoded
+CATEGORICAL_COLUMNS = ['EER', 'RU', 'LAUA', 'icnpo']
+
+
+def save_columnar(data, path):
+    """ Writes the processed dataset as an uncompressed Arrow IPC (feather v2)
+        file, which can be memory-mapped rather than deserialized on load.
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    data = data.copy()
+    for column in CATEGORICAL_COLUMNS:
+        if column in data.columns:
+            data[column] = data[column].astype('category')
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    feather.write_feather(table, path, compression='uncompressed')
+
+
+def load_columnar(path, columns=None):
+    """ Memory-maps a file written by save_columnar and converts only `columns`
+        (all of them if None) to a DataFrame.
+    """
+    import pyarrow.feather as feather
+
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    # split_blocks avoids consolidating the columns into one extra copy
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def feature_columns(feature_union):
+    """ Names of the dataset columns the feature union's extractors read."""
+    columns = []
+    for _, transformer in feature_union.transformer_list:
+        steps = transformer.steps if isinstance(transformer, Pipeline) else [(None, transformer)]
+        for _, step in steps:
+            column = getattr(step, 'columns', None)
+            if isinstance(column, str) and column not in columns:
+                columns.append(column)
+    return columns
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from os.path import join as pj
+import numpy as np
+import pandas as pd
+from src.data.artifact_cache import file_md5
+
+logger = logging.getLogger(__name__)
+
+
+def regno_hashes(stage):
+    """ One hash per regno over every row belonging to it, so two versions of
+        a stage can be compared charity by charity.
+    """
+    if isinstance(stage, pd.Series):
+        stage = stage.to_frame()
+    keyed_by_index = False
+    if 'regno' in stage.columns:
+        regno = stage['regno']
+    elif 'Charity ID' in stage.columns:
+        regno = stage['Charity ID']
+    else:
+        regno = stage.index.to_series()
+        keyed_by_index = True
+    # row positions are not part of a charity's data
+    row_hashes = pd.util.hash_pandas_object(stage, index=keyed_by_index)
+    return pd.Series(row_hashes.values, index=regno.values).groupby(level=0).sum()
+
+
+def changed_regnos(previous, current):
+    previous, current = regno_hashes(previous), regno_hashes(current)
+    previous, current = previous.align(current)
+    return set(previous.index[previous.ne(current).values])
+
+
+class IncrementalBuild:
+    """ Keeps each make_dataset stage in `interim_dir` alongside a fingerprint
+        of the raw files (and parameters) it was built from.
+
+        Stages whose fingerprint is unchanged are loaded from disk; stages that
+        are recomputed are diffed against their previous version so that the
+        merged frame only has to be rebuilt for the charities that changed.
+    """
+    def __init__(self, interim_dir):
+        self.interim_dir = interim_dir
+        os.makedirs(interim_dir, exist_ok=True)
+        self._manifest_path = pj(interim_dir, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self.manifest = json.load(f)
+        # regnos changed per stage; None means the whole stage must be treated as new
+        self.changed = {}
+
+    def _save_manifest(self):
+        tmp_path = self._manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _stage_path(self, name):
+        return pj(self.interim_dir, f'{name}.pkl')
+
+    def _load(self, name):
+        path = self._stage_path(name)
+        if name in self.manifest and os.path.exists(path):
+            return pd.read_pickle(path)
+        return None
+
+    def _save(self, name, frame, fingerprint):
+        frame.to_pickle(self._stage_path(name))
+        self.manifest[name] = fingerprint
+        self._save_manifest()
+
+    def _pending(self, name):
+        # regnos changed by builds of stage `name` that no merged upsert has
+        # picked up yet, e.g. because the run died in between; None for all
+        pending = self.manifest.get('pending', {}).get(name, [])
+        return None if pending is None else set(pending)
+
+    def _set_pending(self, name, changed):
+        self.manifest.setdefault('pending', {})[name] = None if changed is None else sorted(changed)
+
+    def stage(self, name, paths, func, *args):
+        """ Returns func(*args), reusing the stored result if neither the files in
+            `paths` nor the arguments have changed since it was stored.
+        """
+        fingerprint = {
+            'files': {os.path.basename(path): file_md5(path) for path in paths},
+            'params': json.loads(json.dumps(args[1:], default=str))
+        }
+        previous = self._load(name)
+        if previous is not None and self.manifest[name] == fingerprint:
+            logger.info(f'stage {name} unchanged, loading from {self.interim_dir}')
+            self.changed[name] = self._pending(name)
+            return previous
+
+        logger.info(f'stage {name} changed, recomputing')
+        frame = func(*args)
+        if previous is not None and self.manifest[name]['params'] == fingerprint['params']:
+            self.changed[name] = changed_regnos(previous, frame)
+            logger.info(f'stage {name}: {len(self.changed[name])} charities changed')
+        else:
+            self.changed[name] = None
+        pending = self._pending(name)
+        if pending is None or self.changed[name] is None:
+            self.changed[name] = None
+        else:
+            self.changed[name] |= pending
+        # saved with the stage, so the changes survive until the merged frame has them
+        self._set_pending(name, self.changed[name])
+        self._save(name, frame, fingerprint)
+        return frame
+
+    def upsert(self, name, regno_order, func, params=None):
+        """ Rebuilds the merged stage for the regnos changed by any upstream
+            stage, keeping every other row from the previous build. `func(regnos)`
+            builds the rows for the given regnos (or all of them for None) and
+            rows are kept in the order of `regno_order`.
+        """
+        fingerprint = {'params': json.loads(json.dumps(params, default=str))}
+        previous = self._load(name)
+        if previous is None or self.manifest[name] != fingerprint \
+                or any(changed is None for changed in self.changed.values()):
+            logger.info(f'rebuilding {name} from all stages')
+            frame = func(None)
+        else:
+            regnos = set().union(*self.changed.values())
+            if not regnos:
+                logger.info(f'{name} unchanged')
+                return previous
+            logger.info(f'upserting {len(regnos)} charities into {name}')
+            kept = previous[~previous['regno'].isin(regnos)]
+            frame = pd.concat([kept, func(regnos)], ignore_index=True)
+            # restore the order a full rebuild would produce
+            order = pd.Index(regno_order.values).get_indexer(frame['regno'])
+            frame = frame.iloc[np.argsort(order, kind='mergesort')].reset_index(drop=True)
+        self.manifest['pending'] = {}
+        self._save(name, frame, fingerprint)
+        return frame
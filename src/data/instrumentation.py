@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+""" Per-stage wall time, CPU time, peak RSS and row counts for the data,
+    feature and training scripts, written as json or as a Prometheus textfile.
+
+    Stages measured in worker processes (the feature union steps fitted inside
+    a parallel search) are appended to a spool directory named by the
+    PIPELINE_METRICS_SPOOL environment variable, which workers inherit, and
+    collected by the parent once the search is done.
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import join as pj
+from src.data.memory import current_rss, peak_rss, reset_peak_rss
+
+logger = logging.getLogger(__name__)
+
+SPOOL_ENV = 'PIPELINE_METRICS_SPOOL'
+
+# records of the stages open in this process, outermost first
+_open = []
+
+
+def _fold_peak():
+    # the kernel's peak counter is per process, so an inner stage resetting it
+    # would hide the outer stages' peaks; they keep the highest seen so far
+    peak = peak_rss()
+    for record in _open:
+        record['peak_rss_bytes'] = max(record['peak_rss_bytes'], peak)
+
+
+@contextmanager
+def measure(stage, rows=None, **labels):
+    """ Measures the enclosed block into the yielded record. `rows` can also
+        be set on the record inside the block, once known.
+
+        CPU time is this process's, all threads included; the time of worker
+        processes is only counted by the stages they measure themselves.
+    """
+    _fold_peak()
+    reset_peak_rss()
+    record = {'stage': stage, **labels}
+    if rows is not None:
+        record['rows'] = rows
+    record['peak_rss_bytes'] = current_rss()
+    _open.append(record)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        _fold_peak()
+        _open.remove(record)
+        record['rss_bytes'] = current_rss()
+
+
+def spool_dir():
+    """ The spool directory of the current run, or None outside of one."""
+    path = os.environ.get(SPOOL_ENV)
+    # workers outlive the run that started them
+    return path if path and os.path.isdir(path) else None
+
+
+def spool(records):
+    """ Appends `records` to this process's file in the spool directory."""
+    path = spool_dir()
+    if path is None or not records:
+        return
+    lines = ''.join(json.dumps(record, default=repr) + '\n' for record in records)
+    with open(pj(path, f'records_{os.getpid()}.jsonl'), 'a') as f:
+        f.write(lines)
+
+
+def read_spool(path):
+    records = []
+    for filename in sorted(glob.glob(pj(path, 'records_*.jsonl'))):
+        with open(filename) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def _is_metric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def summarize(records, labels=None):
+    """ Records of the same stage and labels (or only of the given `labels`)
+        merged: peaks are the maximum, times and counts are summed.
+    """
+    groups = OrderedDict()
+    for record in records:
+        if labels is None:
+            key = tuple(sorted((k, str(v)) for k, v in record.items() if not _is_metric(v)))
+        else:
+            key = (('stage', record['stage']),) + tuple((k, str(record.get(k))) for k in labels)
+        group = groups.setdefault(key, {'runs': 0})
+        group['runs'] += 1
+        for name, value in record.items():
+            if not _is_metric(value) or name in ('rss_bytes', 'runs'):
+                continue
+            if name.endswith('_bytes'):
+                group[name] = max(group.get(name, value), value)
+            else:
+                group[name] = group.get(name, 0) + value
+    return [{**dict(key), **group} for key, group in groups.items()]
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Instrumentation:
+    """ Collects the stage records of a run and writes them out."""
+    def __init__(self, prefix='charity_pipeline'):
+        self.prefix = prefix
+        self.records = []
+
+    @contextmanager
+    def stage(self, stage, rows=None, log=logger, **labels):
+        """ Measures and records the enclosed block (see `measure`)."""
+        with measure(stage, rows, **labels) as record:
+            yield record
+        self.records.append(record)
+        log.info(f'stage {stage}: {record["wall_seconds"]:.2f}s wall, {record["cpu_seconds"]:.2f}s CPU, '
+                 f'peak RSS {record["peak_rss_bytes"] / 1024 ** 2:.0f} MB'
+                 + (f', {record["rows"]} rows' if 'rows' in record else ''))
+
+    def add(self, stage, **fields):
+        self.records.append({'stage': stage, **fields})
+
+    @contextmanager
+    def spooling(self):
+        """ Collects what the instrumented feature unions measure in this
+            process and in the workers it starts within the block.
+        """
+        path = tempfile.mkdtemp(prefix='metrics_spool_')
+        previous = os.environ.get(SPOOL_ENV)
+        os.environ[SPOOL_ENV] = path
+        try:
+            yield path
+        finally:
+            if previous is None:
+                del os.environ[SPOOL_ENV]
+            else:
+                os.environ[SPOOL_ENV] = previous
+            self.records.extend(read_spool(path))
+            shutil.rmtree(path, ignore_errors=True)
+
+    def add_search(self, searchcv, **labels):
+        """ Records the mean fit and score time of every candidate of a fitted
+            search from its cv_results_, and its refit time.
+        """
+        results = searchcv.cv_results_
+        n_splits = getattr(searchcv, 'n_splits_', None)
+        for i, params in enumerate(results['params']):
+            record = {
+                'candidate': str(i),
+                'params': json.dumps(params, default=repr, sort_keys=True),
+                'fit_seconds': float(results['mean_fit_time'][i]),
+                'score_seconds': float(results['mean_score_time'][i]),
+                'mean_test_score': float(results['mean_test_score'][i]),
+                **labels
+            }
+            # the halving searches evaluate candidates on growing resources
+            for key in ('iter', 'n_resources'):
+                if key in results:
+                    record[key] = str(results[key][i])
+            if n_splits:
+                record['total_seconds'] = (record['fit_seconds'] + record['score_seconds']) * n_splits
+            self.add('train/candidate', **record)
+        if hasattr(searchcv, 'refit_time_'):
+            self.add('train/refit', wall_seconds=float(searchcv.refit_time_), **labels)
+
+    def log_summary(self, stage, labels, log=logger):
+        """ Logs the time spent per `labels` in `stage`, slowest first."""
+        rows = [r for r in summarize(self.records, labels) if r['stage'] == stage]
+        rows.sort(key=lambda r: r.get('wall_seconds', 0), reverse=True)
+        for r in rows:
+            log.info(f'{stage} ' + ' '.join(f'{k}={r[k]}' for k in labels)
+                     + f': {r.get("wall_seconds", 0):.2f}s wall, {r.get("cpu_seconds", 0):.2f}s CPU, '
+                       f'peak RSS {r.get("peak_rss_bytes", 0) / 1024 ** 2:.0f} MB')
+
+    def to_json(self):
+        return {'date': datetime.now().isoformat(), 'pid': os.getpid(), 'records': self.records,
+                'summary': summarize(self.records)}
+
+    def to_prometheus(self):
+        """ The summarized records in the Prometheus text format, one gauge
+            per measure with the stage and labels of each record as labels.
+        """
+        samples = OrderedDict()
+        for record in summarize(self.records):
+            labels = ','.join(f'{k}="{_label_value(v)}"' for k, v in record.items() if not _is_metric(v))
+            for name, value in record.items():
+                if _is_metric(value):
+                    samples.setdefault(name, []).append(f'{self.prefix}_{name}{{{labels}}} {value!r}')
+        lines = []
+        for name, metric_samples in samples.items():
+            lines.append(f'# HELP {self.prefix}_{name} {name.replace("_", " ")} per pipeline stage')
+            lines.append(f'# TYPE {self.prefix}_{name} gauge')
+            lines.extend(metric_samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Writes a Prometheus textfile if `path` ends in .prom, json
+            otherwise. The file is replaced whole, so a collector never reads
+            it half written.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_json(), indent=2, default=repr)
+        tmp = f'{path}.tmp{os.getpid()}'
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+        logger.info(f'wrote {len(self.records)} stage records to {path}')
+        return path
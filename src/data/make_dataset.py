@@ -3,7 +3,6 @@ import click
 import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
-from time import sleep
 import os
 import gc
 import pandas as pd
@@ -12,176 +11,337 @@ from os.path import join as pj
 import botocore
 import boto3
 import pickle as pkl
+from functools import partial
+from src.data.artifact_cache import get_artifact_cache
+from src.data.s3_transfer import find_keys, upload_file
+from src.data.financials import rolling_financials
+from src.data.incremental import IncrementalBuild
+from src.data.columnar import save_columnar
+from src.data.instrumentation import Instrumentation
+from src.data.text_repair import repair_texts
 
-@click.command()
-@click.option('--use-s3', 'use_s3', default=True)
-def main(use_s3):
-    """ Runs data processing scripts to turn raw data from (../raw) into
-        cleaned data ready to be analyzed (saved in ../processed).
-    """
-    logger = logging.getLogger(__name__)
+STAGE_FILES = {
+    'activities': ['partb_activities_scraped_2020_08_12_20_18.csv', 'regno_activities.txt'],
+    'classifications': ['classification_objects.csv'],
+    'financials': ['cc_financial.csv'],
+    'charitybase': ['CharityBase_20200820.csv'],
+    'self_class': ['cc_class.csv']
+}
 
-    logger.info('making final data set from raw data')
+# reduce rural/urban categories to just 6
+RU_CATEGORIES = {
+    '(England/Wales) Urban city and town': 'urban_mid',
+    '(England/Wales) Urban major conurbation': 'urban_large',
+    '(England/Wales) Rural village': 'rural_mid',
+    '(England/Wales) Rural town and fringe': 'rural_large',
+    '(England/Wales) Rural hamlet and isolated dwellings': 'rural_small',
+    '(England/Wales) Urban minor conurbation': 'urban_small',
+    '(England/Wales) Rural village in a sparse setting': 'rural_mid',
+    '(England/Wales) Rural hamlet and isolated dwellings in a sparse setting': 'rural_small',
+    '(England/Wales) Rural town and fringe in a sparse setting': 'rural_large',
+    '(England/Wales) Urban city and town in a sparse setting': 'urban_mid',
+    '(Scotland) Large Urban Area': 'urban_large',
+    '(Scotland) Accessible Rural': 'rural_mid',
+    '(Scotland) Other Urban Area': 'urban_small', 
+    '(Scotland) Remote Rural': 'rural_small',
+    '(Scotland) Very Remote Rural': 'rural_small', 
+    '(Scotland) Accessible Small Town': 'urban_mid',
+    '(Scotland) Remote Small Town': 'rural_large', 
+    '(Scotland) Very Remote Small Town': 'rural_large' 
+}
 
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(os.environ.get('BUCKET'))
-    raw_dir = pj(project_dir, 'data', os.environ.get('RAW_DIR'))
-    processed_dir = pj(project_dir, 'data', os.environ.get('PROCESSED_DIR'))
 
-    filenames = [
-        'cc_financial.csv',
-        'CharityBase_20200820.csv',
-        'cc_class.csv',
-        'partb_activities_scraped_2020_08_12_20_18.csv',
-        'classification_objects.csv',
-        'regno_activities.txt'
-    ]
+def load_activities(raw_dir, chunksize=None):
+    # a charity keeps its first description with activities, so repeats can be
+    # dropped from each chunk as it is read
+    def process(chunk):
+        return chunk.dropna().drop_duplicates('regno')
 
-    # download datasets from s3
-    if use_s3 is True:
-        print('test')
-        print('---Using S3---')
-        
-        for s3_object in bucket.objects.all():
-            # Need to split s3_object.key into path and file name, else it will give error file not found.
-            path, filename = os.path.split(s3_object.key)
-            if filename in filenames:
-                bucket.download_file(s3_object.key, pj(raw_dir,filename))
-            
-        # wait for temp file to change temp name to final (file)name
-        sleep(20)
-            
     # load scraped part b charities
-    partb_activities = pd.read_csv(pj(raw_dir, 'partb_activities_scraped_2020_08_12_20_18.csv'), \
-                                    index_col=0).iloc[:,1:]
-    partb_activities.dropna(inplace=True)
-    partb_activities.drop_duplicates(inplace=True)
+    partb_activities = read_csv(pj(raw_dir, 'partb_activities_scraped_2020_08_12_20_18.csv'), chunksize, process,
+                                usecols=['regno', 'activities'])
     partb_activities['regno'] = partb_activities['regno'].astype(int).astype(str)
 
     # load scraped non part b charities
-    nonpartb_activities = pd.read_csv(pj(raw_dir, 'regno_activities.txt'), delimiter='\t', \
-                        lineterminator='\n', header=None, names=['regno', 'activities'], dtype={'regno':str}).dropna()
+    nonpartb_activities = read_csv(pj(raw_dir, 'regno_activities.txt'), chunksize, process, delimiter='\t',
+                                   lineterminator='\n', header=None, names=['regno', 'activities'],
+                                   dtype={'regno': str})
 
     activities = pd.concat([partb_activities, nonpartb_activities])
     activities.drop_duplicates('regno', inplace=True)
+    return activities
 
-    # load classifications
-    char_classes = pd.read_csv(pj(raw_dir, 'classification_objects.csv'))
-    char_classes['regno'] = char_classes['regno'].astype(str)
 
+def read_csv(path, chunksize=None, process=None, **kwargs):
+    """ pd.read_csv, optionally streamed in chunks of `chunksize` rows.
+
+        `process` reduces a frame (e.g. to the rows each charity needs) and
+        must give the same result when applied again to the concatenation of
+        reduced frames. Streaming applies it to every chunk, and again to the
+        kept rows whenever they have grown by a chunk or a quarter, so about
+        the reduction of the file is held rather than the whole file.
+    """
+    process = process or (lambda frame: frame)
+    if not chunksize:
+        return process(pd.read_csv(path, **kwargs))
+    kept, rows, limit = [], 0, chunksize
+    for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+        kept.append(process(chunk))
+        rows += len(kept[-1])
+        if rows > limit and len(kept) > 1:
+            kept = [process(pd.concat(kept, ignore_index=True))]
+            rows = len(kept[0])
+            limit = rows + max(chunksize, rows // 4)
+    if len(kept) == 1:
+        return kept[0].reset_index(drop=True)
+    return process(pd.concat(kept, ignore_index=True)).reset_index(drop=True)
+
+
+def load_classifications(raw_dir, chunksize=None):
+    # the last row of a repeated regno is the one merged
+    def process(chunk):
+        chunk['regno'] = chunk['regno'].astype(str)
+        return chunk.drop_duplicates('regno', keep='last')
+
+    return read_csv(pj(raw_dir, 'classification_objects.csv'), chunksize, process,
+                    usecols=['regno', 'ICNPO_NCVO_category', 'objects', 'nicename'])
+
+
+def load_financials(raw_dir, financial_windows=(3,), financial_stats=False, chunksize=None):
+    windows = sorted(set(financial_windows) | {3})
+
+    # only each charity's most recent years up to the longest window are used
+    def process(chunk):
+        chunk['regno'] = chunk['regno'].astype(str)
+        chunk['fyend'] = pd.to_datetime(chunk['fyend'])
+        chunk = chunk.sort_values(['regno', 'fyend'], ascending=[True, False], kind='mergesort')
+        return chunk.groupby('regno', sort=False).head(windows[-1])
+
+    char_financial = read_csv(pj(raw_dir, 'cc_financial.csv'), chunksize, process,
+                              usecols=lambda c: c in ('regno', 'fyend', 'income', 'expend'))
+
+    # 3 year means (plus any optional windows and trend/volatility features)
+    char_means = rolling_financials(char_financial, windows=windows, columns=('income', 'expend'),
+                                    stats=financial_stats)
+    if set(financial_windows) == {3} and not financial_stats:
+        char_means = char_means[['income_3y_mean']]
+    return char_means
+
+
+def load_charitybase(raw_dir, chunksize=None):
+    # charities without a local authority or rural/urban class are dropped when merged
+    def process(chunk):
+        chunk['Charity ID'] = chunk['Charity ID'].astype(str)
+        return chunk.dropna(subset=['LAUA', 'RU'])
+
+    columns = ['Charity ID', 'LAUA', 'RU', 'EER', 'Funders', 'Trustees']
+    charitybase = read_csv(pj(raw_dir, 'CharityBase_20200820.csv'), chunksize, process, usecols=columns)
+    return charitybase[columns]
+
+
+def load_self_class(raw_dir, chunksize=None):
+    # each chunk's classes are joined per charity, and joined again across chunks
+    def process(chunk):
+        joined = chunk.groupby('regno')['classtext'].apply(lambda x: ' '.join(map(str, x)))
+        return joined.reset_index()
+
+    self_class = read_csv(pj(raw_dir, 'cc_class.csv'), chunksize, process, usecols=['regno', 'classtext'],
+                          dtype={'regno': str})
+    return self_class.set_index('regno')['classtext'].rename('self_class')
+
+
+def merge_stages(stages, regnos=None, repair=None):
+    """ Joins the loaded stages into one row per charity, optionally only for
+        `regnos`. `repair`, if given, maps the activities to their repaired text.
+    """
+    activities = stages['activities']
+    if regnos is not None:
+        activities = activities[activities['regno'].isin(regnos)]
+    activities = activities.copy()
 
     # #### Map current classifications to activities data
-    classes_map = pd.Series(char_classes['ICNPO_NCVO_category'].values, char_classes['regno'].values).to_dict()
-    objects_map = pd.Series(char_classes['objects'].values, char_classes['regno'].values).to_dict()
-    name_map = pd.Series(char_classes['nicename'].values, char_classes['regno'].values).to_dict()
+    # indexed lookup (last row wins for a repeated regno, as a dict would)
+    char_classes = stages['classifications'].drop_duplicates('regno', keep='last').set_index('regno')
+    lookup = char_classes.reindex(activities['regno'].values)
 
-    activities['icnpo'] = activities['regno'].map(classes_map)
-    activities['name'] = activities['regno'].map(name_map)
-    activities['objects'] = activities['regno'].map(objects_map)
+    activities['icnpo'] = lookup['ICNPO_NCVO_category'].values
+    activities['name'] = lookup['nicename'].values
+    activities['objects'] = lookup['objects'].values
 
     # #### Add income and expenditure to dataframe
-    char_financial = pd.read_csv(pj(raw_dir, 'cc_financial.csv'))
-    char_financial['regno'] = char_financial['regno'].astype(str)
-    char_financial['fyend'] = pd.to_datetime(char_financial['fyend'])
-
-    # reduce to just charities needed
-    idx = activities.set_index('regno').index
-    char_financial = char_financial.set_index('regno')[char_financial.set_index('regno').index.isin(idx)]\
-                                                                                                    .reset_index()
-    # add 3 year means
-    char_means = {}
-    for name, group in char_financial.groupby('regno'):
-        df = group[['fyend', 'income']].sort_values('fyend', ascending=False).head(3)
-        char_means[name] = df['income'].mean()
-
-    activities['income_3y_mean'] = activities['regno'].map(char_means)
+    char_means = stages['financials']
+    activities['income_3y_mean'] = activities['regno'].map(char_means['income_3y_mean'])
 
     # prepare data for use
-    data = activities.copy()
+    data = activities
     data['activities'] = data['activities'].astype(str)
     data.dropna(inplace=True)
 
+    # optional financial features are joined after dropna so gaps (e.g. one year of
+    # accounts has no trend) don't remove charities from the dataset
+    if len(char_means.columns) > 1:
+        data = data.join(char_means.drop(columns='income_3y_mean'), on='regno')
+
     # fix badly formed sentences (words stuck together) - this also removes punctuation
-    #data['activities'] = data['activities'].apply(lambda x: ' '.join(wordninja.split(x))) - 
+    if repair is not None:
+        data['activities'] = repair(data['activities'])
 
     # add charitybase data
-    charitybase = pd.read_csv(pj(raw_dir, 'CharityBase_20200820.csv'))
-    charitybase['Charity ID'] = charitybase['Charity ID'].astype(str)
-    columns = ['Charity ID', 'LAUA', 'RU', 'EER', 'Funders', 'Trustees']
-    charitybase = charitybase[columns]
-    data_merged = data.merge(charitybase, left_on='regno', right_on='Charity ID')
+    data_merged = data.merge(stages['charitybase'], left_on='regno', right_on='Charity ID')
     data_merged.dropna(subset=['LAUA', 'RU'], inplace=True)
 
-    # reduce rural/urban categories to just 6
-    ru_categories = {
-        '(England/Wales) Urban city and town': 'urban_mid',
-        '(England/Wales) Urban major conurbation': 'urban_large',
-        '(England/Wales) Rural village': 'rural_mid',
-        '(England/Wales) Rural town and fringe': 'rural_large',
-        '(England/Wales) Rural hamlet and isolated dwellings': 'rural_small',
-        '(England/Wales) Urban minor conurbation': 'urban_small',
-        '(England/Wales) Rural village in a sparse setting': 'rural_mid',
-        '(England/Wales) Rural hamlet and isolated dwellings in a sparse setting': 'rural_small',
-        '(England/Wales) Rural town and fringe in a sparse setting': 'rural_large',
-        '(England/Wales) Urban city and town in a sparse setting': 'urban_mid',
-        '(Scotland) Large Urban Area': 'urban_large',
-        '(Scotland) Accessible Rural': 'rural_mid',
-        '(Scotland) Other Urban Area': 'urban_small', 
-        '(Scotland) Remote Rural': 'rural_small',
-        '(Scotland) Very Remote Rural': 'rural_small', 
-        '(Scotland) Accessible Small Town': 'urban_mid',
-        '(Scotland) Remote Small Town': 'rural_large', 
-        '(Scotland) Very Remote Small Town': 'rural_large' 
-    }
-
-    data_merged['RU'] = data_merged['RU'].map(ru_categories)
+    data_merged['RU'] = data_merged['RU'].map(RU_CATEGORIES)
 
     # add self-classified data
-    self_class = pd.read_csv(pj(raw_dir, 'cc_class.csv'), dtype={'self_class': str, 'regno': str})
-    self_class.rename(columns={'classtext': 'self_class'}, inplace=True)
-    self_class = self_class.groupby('regno')['self_class'].apply(lambda x: ' '.join(map(str, x)))
-    data_merged = data_merged.merge(self_class, on='regno')
+    data_merged = data_merged.merge(stages['self_class'], on='regno')
 
     # convert income, funders and trustees to log
     data_merged['income_3y_mean'] = data_merged['income_3y_mean'].apply(lambda x: np.log(x) if x > 0 else 0)
     data_merged['Trustees'] = data_merged['Trustees'].apply(lambda x: np.log(x) if x > 0 else 0)
     data_merged['Funders'] = data_merged['Funders'].apply(lambda x: np.log(x) if x > 0 else 0)
+    for column in data_merged.columns:
+        if column.endswith('y_mean') and column != 'income_3y_mean':
+            data_merged[column] = data_merged[column].apply(lambda x: np.log(x) if x > 0 else 0)
+    return data_merged
+
 
+def finalise(data_merged):
     # remove data where charities have0 income in the last 3 years
     data = data_merged[data_merged['income_3y_mean']>0]
     data.reset_index(inplace=True)
-    del data_merged
+    return data
+
+
+@click.command()
+@click.option('--use-s3', 'use_s3', default=True)
+@click.option('--financial-windows', 'financial_windows', default='3',
+              help='Comma separated year windows for income/expenditure means, e.g. 1,3,5.')
+@click.option('--financial-stats', 'financial_stats', is_flag=True,
+              help='Add trend and volatility of income/expenditure for each window.')
+@click.option('--incremental', 'incremental', is_flag=True,
+              help='Only reprocess stages whose raw files changed, upserting the affected charities.')
+@click.option('--chunksize', 'chunksize', default=None, type=int,
+              help='Stream the large raw csvs in chunks of this many rows to bound peak memory.')
+@click.option('--output-format', 'output_format', default='pickle', type=click.Choice(['pickle', 'feather']),
+              help='feather writes a columnar data.feather that training can memory-map.')
+@click.option('--metrics-file', 'metrics_file', default=None,
+              help='Write per-stage timings and peak memory here: a Prometheus textfile if it ends '
+                   'in .prom, json otherwise.')
+@click.option('--repair-text', 'repair_text', is_flag=True,
+              help='Split run-together words in the activities, caching the results in the interim dir.')
+@click.option('--repair-jobs', 'repair_jobs', default=-1, type=int,
+              help='Processes segmenting the texts the cache does not have; -1 for all cores.')
+def main(use_s3, financial_windows, financial_stats, incremental, chunksize, output_format, metrics_file,
+         repair_text, repair_jobs):
+    """ Runs data processing scripts to turn raw data from (../raw) into
+        cleaned data ready to be analyzed (saved in ../processed).
+    """
+    logger = logging.getLogger(__name__)
 
+    logger.info('making final data set from raw data')
+
+    financial_windows = [int(w) for w in financial_windows.split(',')]
+    instrumentation = Instrumentation()
+
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(os.environ.get('BUCKET'))
+    raw_dir = pj(project_dir, 'data', os.environ.get('RAW_DIR'))
+    processed_dir = pj(project_dir, 'data', os.environ.get('PROCESSED_DIR'))
+    interim_dir = pj(project_dir, 'data', os.environ.get('INTERIM_DIR', 'interim'))
+
+    filenames = [
+        'cc_financial.csv',
+        'CharityBase_20200820.csv',
+        'cc_class.csv',
+        'partb_activities_scraped_2020_08_12_20_18.csv',
+        'classification_objects.csv',
+        'regno_activities.txt'
+    ]
+
+    # download datasets from s3
     if use_s3 is True:
         print('---Using S3---')
-        ### save file to s3 (and load again)
+
+        # list only until the raw files are found (under RAW_PREFIX if set), then
+        # fetch them concurrently; each fetch returns once its file is complete
+        # and verified against the object's size and ETag
+        with instrumentation.stage('make_dataset/download', log=logger):
+            keys = find_keys(bucket.meta.client, bucket.name, filenames,
+                             prefix=os.environ.get('RAW_PREFIX', ''))
+            cache = get_artifact_cache(bucket.name)
+            cache.fetch_many({key: pj(raw_dir, filename) for filename, key in keys.items()})
+
+    # chunksize only changes how files are read, so it is kept out of the stage arguments
+    stage_args = {
+        'activities': (partial(load_activities, chunksize=chunksize), raw_dir),
+        'classifications': (partial(load_classifications, chunksize=chunksize), raw_dir),
+        'financials': (partial(load_financials, chunksize=chunksize), raw_dir, financial_windows,
+                       financial_stats),
+        'charitybase': (partial(load_charitybase, chunksize=chunksize), raw_dir),
+        'self_class': (partial(load_self_class, chunksize=chunksize), raw_dir)
+    }
+
+    # reuse stages whose raw files are unchanged and upsert only the affected regnos
+    build = IncrementalBuild(interim_dir) if incremental else None
+    stages = {}
+    for name, args in stage_args.items():
+        with instrumentation.stage(f'make_dataset/{name}', log=logger) as record:
+            if incremental:
+                stages[name] = build.stage(name, [pj(raw_dir, f) for f in STAGE_FILES[name]], *args)
+            else:
+                stages[name] = args[0](*args[1:])
+            record['rows'] = len(stages[name])
+
+    def repair_activities(texts):
+        # texts segmented in an earlier build are read from the cache
+        with instrumentation.stage('make_dataset/repair_text', rows=len(texts), log=logger) as record:
+            repaired, stats = repair_texts(texts, pj(interim_dir, 'text_repair.sqlite'), repair_jobs)
+            record.update(stats)
+        return repaired
+
+    repair = repair_activities if repair_text else None
+    with instrumentation.stage('make_dataset/merge', log=logger) as record:
+        if incremental:
+            data_merged = build.upsert('merged', stages['activities']['regno'],
+                                       lambda regnos: merge_stages(stages, regnos, repair),
+                                       params=[financial_windows, financial_stats, repair_text])
+        else:
+            data_merged = merge_stages(stages, repair=repair)
+        del stages
+        record['rows'] = len(data_merged)
+
+    with instrumentation.stage('make_dataset/finalise', log=logger) as record:
+        data = finalise(data_merged)
+        del data_merged
+        record['rows'] = len(data)
+
+    # save to local processed folder
+    with instrumentation.stage('make_dataset/save', rows=len(data), log=logger):
+        if output_format == 'feather':
+            # columnar, memory-mappable copy of the dataset
+            filename = 'data.feather'
+            save_columnar(data, pj(processed_dir, filename))
+        else:
+            filename = 'data.pkl'
+            with open(pj(processed_dir, filename), 'wb') as _file:
+                pkl.dump(data, _file)
+    print('Saving complete.')
+
+    if use_s3 is True:
+        print('---Using S3---')
+        # stream the saved file up (multipart for large files) rather than
+        # pickling into memory, and check the upload before moving on
         print("Saving data...")
-        filename = 'data.pkl'
         key = pj('char-class-data', filename)
-        pickle_byte_obj = pkl.dumps(data)
-        bucket.put_object(Key=key, Body=pickle_byte_obj)
-        del pickle_byte_obj
+        with instrumentation.stage('make_dataset/upload', log=logger):
+            upload_file(bucket.meta.client, bucket.name, pj(processed_dir, filename), key)
         print('Data saved to s3.')
 
-        # download to local processed folder
-        print('Downloading pickle file...')
-        try:
-            bucket.download_file(key, pj(processed_dir, filename))
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                print("The object does not exist.")
-            else:
-                raise
-    else:
-        # save to local processed folder
-        filename = 'data.pkl'
-        _file = open(pj(processed_dir, filename), 'wb')
-        pkl.dump(data, _file)
-        print('Saving complete.')
-
     gc.collect()
 
     logger.info('final dataset completed')
+    if metrics_file:
+        instrumentation.write(metrics_file)
 
     
 
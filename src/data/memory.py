@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import resource
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def _status_kb(field):
+    # VmRSS / VmHWM from /proc, in kB; None where /proc is not available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """ Resident set size of this process in bytes."""
+    kb = _status_kb('VmRSS')
+    return kb * 1024 if kb is not None else peak_rss()
+
+
+def peak_rss():
+    """ Peak resident set size in bytes since the last reset_peak_rss()."""
+    kb = _status_kb('VmHWM')
+    if kb is None:
+        # ru_maxrss is kB on Linux and bytes on macOS, and cannot be reset
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb if os.uname().sysname == 'Darwin' else kb * 1024
+    return kb * 1024
+
+
+def available_memory():
+    """ Memory available to new processes in bytes: MemAvailable where /proc
+        has it, the physical memory otherwise.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def reset_peak_rss():
+    """ Resets the kernel's peak RSS counter so the next stage gets its own peak.
+        Returns False where that isn't supported and the peak is process-wide.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def track_memory(stage, log=logger):
+    """ Logs the peak and resulting RSS of the enclosed stage."""
+    reset_peak_rss()
+    start = current_rss()
+    yield
+    log.info(f'stage {stage}: peak RSS {peak_rss() / 1024 ** 2:.0f} MB, '
+             f'RSS {start / 1024 ** 2:.0f} -> {current_rss() / 1024 ** 2:.0f} MB')
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+""" Near-duplicate charities by their text: MinHash signatures of the word
+    shingles of the activities and objects, indexed with locality sensitive
+    hashing (LSH).
+
+    Branches of the same charity often share nearly the same boilerplate, so
+    training can collapse each group of near-duplicates into one row weighted
+    by its size, and prediction can answer a charity from an already
+    classified near-duplicate instead of the model.
+"""
+import logging
+import re
+from pathlib import Path
+from dotenv import find_dotenv, load_dotenv
+import click
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+logger = logging.getLogger(__name__)
+
+TEXT_FIELDS = ('activities', 'objects')
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+# the permutations are (a * x + b) mod PRIME of 32-bit shingle hashes, which fits in uint64
+PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+# documents hashed at a time, which bounds the shingles x permutations matrix
+BATCH_DOCS = 500
+
+
+def lsh_bands(threshold, num_perm):
+    """ (bands, rows) of a banding of `num_perm` hashes whose collision
+        threshold (1 / bands) ** (1 / rows) is closest to `threshold`, using
+        as many of the hashes as the rows per band allow.
+    """
+    options = [(num_perm // r, r) for r in range(1, num_perm + 1)]
+    return min(options, key=lambda o: abs((1 / o[0]) ** (1 / o[1]) - threshold))
+
+
+def combined_text(X, columns=TEXT_FIELDS):
+    """ The text fields of each row of `X` joined into one document."""
+    if not isinstance(X, pd.DataFrame):
+        return pd.Series(X).astype(str)
+    columns = [c for c in columns if c in X.columns]
+    return X[columns].fillna('').astype(str).agg(' '.join, axis=1)
+
+
+def shingles(text, size=3):
+    """ The distinct runs of `size` consecutive words of `text`, lowercased;
+        the whole text if it is shorter.
+    """
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    if len(tokens) <= size:
+        return {' '.join(tokens)} if tokens else set()
+    return {' '.join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def _band_hashes(signatures, bands, rows):
+    # one 64-bit hash per document and band
+    return np.column_stack([
+        pd.util.hash_pandas_object(pd.DataFrame(signatures[:, band * rows:(band + 1) * rows]), index=False).values
+        for band in range(bands)])
+
+
+def _similarity(signatures, a, b):
+    # the share of equal MinHashes estimates the Jaccard similarity of the shingles
+    return (signatures[a] == signatures[b]).mean(axis=1)
+
+
+class NearDuplicateIndex:
+    """ MinHash LSH index of the text of labelled charities.
+
+        Two charities whose shingles have a Jaccard similarity of about
+        `threshold` or more share an LSH bucket in at least one band and are
+        then compared on their whole signatures; near-duplicates are grouped
+        into clusters, chaining through shared members.
+    """
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=3, columns=TEXT_FIELDS, random_state=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.columns = columns
+        self.random_state = random_state
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        rng = np.random.RandomState(random_state)
+        self._a = rng.randint(1, 1 << 32, num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, num_perm, dtype=np.uint64)
+
+    def signatures(self, X):
+        """ MinHash signatures of the rows of `X` (a frame with the text
+            columns or a sequence of texts), and which rows have no words.
+        """
+        docs = [shingles(text, self.shingle_size) for text in combined_text(X, self.columns)]
+        signatures = np.full((len(docs), self.num_perm), MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(docs), BATCH_DOCS):
+            batch = docs[start:start + BATCH_DOCS]
+            sizes = np.array([len(doc) for doc in batch])
+            if not sizes.sum():
+                continue
+            values = np.array([s for doc in batch for s in doc], dtype=object)
+            x = pd.util.hash_array(values) & MAX_HASH
+            hashed = ((x[:, None] * self._a + self._b) % PRIME) & MAX_HASH
+            offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+            filled = sizes > 0
+            signatures[start:start + len(batch)][filled] = np.minimum.reduceat(hashed, offsets[filled], axis=0)
+        return signatures.astype(np.uint32), np.array([not doc for doc in docs], dtype=bool)
+
+    def fit(self, X, y=None):
+        """ Indexes the rows of `X` with labels `y` and clusters them."""
+        self.signatures_, self.empty_ = self.signatures(X)
+        band_hashes = _band_hashes(self.signatures_, self.bands, self.rows)
+
+        # per band, the sorted bucket hashes and the first row in each bucket
+        self.bucket_hashes_, self.bucket_rows_ = [], []
+        pairs = []
+        rows = np.flatnonzero(~self.empty_)
+        for band in range(self.bands):
+            hashes = band_hashes[rows, band]
+            order = np.argsort(hashes, kind='stable')
+            sorted_hashes = hashes[order]
+            starts = np.flatnonzero(np.r_[True, sorted_hashes[1:] != sorted_hashes[:-1]])
+            first = rows[order[starts]]
+            self.bucket_hashes_.append(sorted_hashes[starts])
+            self.bucket_rows_.append(first)
+            # every member of a bucket is a candidate duplicate of its first row
+            members = rows[order]
+            firsts = np.repeat(first, np.diff(np.r_[starts, len(order)]))
+            pairs.append(np.column_stack([firsts, members])[firsts != members])
+
+        pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=int)
+        pairs = pairs[_similarity(self.signatures_, pairs[:, 0], pairs[:, 1]) >= self.threshold]
+        n = len(self.signatures_)
+        graph = sp.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+        self.n_clusters_, self.clusters_ = connected_components(graph, directed=False)
+
+        # the label of each cluster; None where its members disagree
+        self.labels_ = None if y is None else np.asarray(y, dtype=object)
+        self.cluster_labels_ = np.full(self.n_clusters_, None, dtype=object)
+        if y is not None:
+            labels = pd.DataFrame({'cluster': self.clusters_, 'label': self.labels_})
+            counts = labels.groupby('cluster')['label'].nunique()
+            unanimous = counts.index[counts.values == 1]
+            self.cluster_labels_[unanimous] = labels.groupby('cluster')['label'].first()[unanimous].values
+        logger.info(f'{n} rows in {self.n_clusters_} near-duplicate clusters '
+                    f'({len(pairs)} pairs at Jaccard >= {self.threshold}, {self.bands} bands of {self.rows})')
+        return self
+
+    def conflicts(self):
+        """ The clusters whose members have different labels, with the count
+            of each label, largest first.
+        """
+        labels = pd.DataFrame({'cluster': self.clusters_, 'label': self.labels_})
+        counts = labels.groupby(['cluster', 'label']).size().unstack(fill_value=0)
+        counts = counts[(counts > 0).sum(axis=1) > 1]
+        return counts.loc[counts.sum(axis=1).sort_values(ascending=False).index]
+
+    def collapse(self, X, y):
+        """ One row of `X` and `y` per cluster and label, with the number of
+            rows it stands for as its sample weight. `X` and `y` must be the
+            rows the index was fitted on; members of a cluster with different
+            labels keep a row per label.
+        """
+        keys = pd.DataFrame({'cluster': self.clusters_, 'label': np.asarray(y, dtype=object)})
+        groups = keys.groupby(['cluster', 'label'], sort=False)
+        first = groups.cumcount().values == 0
+        weights = groups['cluster'].transform('size').values[first]
+        conflicts = self.conflicts()
+        logger.info(f'collapsed {len(keys)} training rows to {first.sum()} '
+                    f'({len(conflicts)} clusters of {int(conflicts.values.sum())} rows have conflicting labels)')
+        return X[first], y[first], weights.astype(float)
+
+    def query(self, X):
+        """ The most similar indexed row to each row of `X` at or above the
+            threshold (-1 if none) and its estimated similarity.
+        """
+        signatures, empty = self.signatures(X)
+        band_hashes = _band_hashes(signatures, self.bands, self.rows)
+        best = np.full(len(signatures), -1)
+        similarity = np.zeros(len(signatures))
+        for band in range(self.bands):
+            hashes = self.bucket_hashes_[band]
+            if not len(hashes):
+                continue
+            position = np.minimum(np.searchsorted(hashes, band_hashes[:, band]), len(hashes) - 1)
+            found = np.flatnonzero((hashes[position] == band_hashes[:, band]) & ~empty)
+            candidates = self.bucket_rows_[band][position[found]]
+            scores = (signatures[found] == self.signatures_[candidates]).mean(axis=1)
+            better = (scores >= self.threshold) & (scores > similarity[found])
+            best[found[better]] = candidates[better]
+            similarity[found[better]] = scores[better]
+        return best, similarity
+
+    def lookup(self, X):
+        """ The label of each row of `X` taken from its near-duplicate, where
+            that one's cluster is unanimous; None elsewhere.
+        """
+        best, _ = self.query(X)
+        labels = np.full(len(best), None, dtype=object)
+        matched = best >= 0
+        labels[matched] = self.cluster_labels_[self.clusters_[best[matched]]]
+        return pd.Series(labels, index=getattr(X, 'index', None))
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True))
+@click.argument('index_path', type=click.Path())
+@click.option('--threshold', 'threshold', default=0.8, type=float,
+              help='Estimated Jaccard similarity of the word shingles at which charities are near-duplicates.')
+@click.option('--num-perm', 'num_perm', default=128, type=int, help='MinHash permutations per signature.')
+@click.option('--label', 'label', default='icnpo', help='Column of the labels.')
+def main(data_path, index_path, threshold, num_perm, label):
+    """ Indexes the labelled charities of a processed dataset, so bulk
+        prediction can answer their near-duplicates, and logs the clusters
+        with conflicting labels.
+    """
+    data = pd.read_pickle(data_path)
+    index = NearDuplicateIndex(threshold, num_perm).fit(data, data[label])
+    conflicts = index.conflicts()
+    logger.info(f'{len(conflicts)} clusters have conflicting labels'
+                + (f', the largest:\n{conflicts.head(10)}' if len(conflicts) else ''))
+    joblib.dump(index, index_path)
+    logger.info(f'index saved to {index_path}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+
+
+def transfer_config(max_concurrency=8, multipart_chunksize=16 * MB):
+    """ Splits objects above `multipart_chunksize` into ranged gets / multipart
+        uploads of that size, `max_concurrency` parts at a time.
+    """
+    return TransferConfig(multipart_threshold=multipart_chunksize,
+                          multipart_chunksize=multipart_chunksize,
+                          max_concurrency=max_concurrency,
+                          use_threads=True)
+
+
+def find_keys(client, bucket_name, filenames, prefix=''):
+    """ Maps each of `filenames` to the first key ending in it under `prefix`,
+        paging through the listing only until all of them are found.
+    """
+    found = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix or ''):
+        for obj in page.get('Contents', []):
+            filename = os.path.basename(obj['Key'])
+            if filename in filenames and filename not in found:
+                found[filename] = obj['Key']
+        if len(found) == len(filenames):
+            break
+    missing = set(filenames) - set(found)
+    if missing:
+        raise FileNotFoundError(f'not found in s3://{bucket_name}/{prefix or ""}: {sorted(missing)}')
+    return found
+
+
+def download_files(fetch, keys_to_paths, max_workers=6):
+    """ Runs fetch(key, path) for every item concurrently and returns once all
+        of them have finished, re-raising the first failure.
+    """
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(fetch, key, path) for key, path in keys_to_paths.items()]
+        return [future.result() for future in futures]
+
+
+def upload_file(client, bucket_name, path, key, config=None):
+    """ Streams `path` to S3 (multipart above the threshold) and checks the
+        stored object's size before returning.
+    """
+    client.upload_file(path, bucket_name, key, Config=config or transfer_config())
+    client.get_waiter('object_exists').wait(Bucket=bucket_name, Key=key)
+    size = client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+    if size != os.path.getsize(path):
+        raise IOError(f'upload of {key} incomplete: {size} of {os.path.getsize(path)} bytes')
+    logger.info(f'uploaded {path} to s3://{bucket_name}/{key} ({size} bytes)')
+    return key
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+""" Synthetic stand-ins for the six raw files make_dataset reads, for
+    benchmarking and trying the pipeline without access to the bucket.
+
+    Charities get an ICNPO category with a long-tailed class balance, free
+    text of register-like lengths whose words lean towards their category,
+    a varying number of years of accounts and CharityBase attributes.
+"""
+import logging
+import os
+from os.path import join as pj
+import click
+import numpy as np
+import pandas as pd
+from src.data.financials import synthetic_financials
+from src.data.make_dataset import RU_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+FIRST_REGNO = 200000
+
+# NCVO's ICNPO categories, most common first
+ICNPO_CATEGORIES = [
+    'Social services', 'Culture and recreation', 'Religion', 'Education', 'Grant-making foundations',
+    'Health', 'Development and housing', 'Village Halls', 'Parent Teacher Associations',
+    'Playgroups and nurseries', 'Scout groups and youth clubs', 'Environment', 'International',
+    'Law and advocacy', 'Research', 'Employment and training', 'Umbrella bodies', 'Housing',
+    'Armed forces', 'Animal welfare', 'Emergency services', 'Sport'
+]
+
+EER_REGIONS = [
+    'London', 'South East', 'South West', 'East of England', 'West Midlands', 'East Midlands',
+    'Yorkshire and The Humber', 'North West', 'North East', 'Wales'
+]
+
+CLASS_TEXTS = [
+    'General Charitable Purposes', 'Education/training', 'The Advancement Of Health Or Saving Of Lives',
+    'Disability', 'The Prevention Or Relief Of Poverty', 'Overseas Aid/famine Relief',
+    'Accommodation/housing', 'Religious Activities', 'Arts/culture/heritage/science',
+    'Amateur Sport', 'Animals', 'Environment/conservation/heritage', 'Economic/community Development/employment',
+    'Armed Forces/emergency Service Efficiency', 'Human Rights/religious Or Racial Harmony/equality Or Diversity',
+    'Recreation', 'Other Charitable Purposes'
+]
+
+COMMON_WORDS = (
+    'the and of to in for a with by support provide community people local charity services '
+    'help work including young through other public members activities area funds promote '
+    'raising grants organisations families advice care also benefit relief within '
+    'information recorded united kingdom raise individuals older groups training events'
+).split()
+
+SYLLABLES = ['ka', 'ro', 'mi', 'te', 'su', 'la', 'ne', 'vo', 'di', 'pa', 'shi', 'gor', 'len', 'tam',
+             'ber', 'fi', 'ac', 'un', 'ost', 'rel']
+
+
+def _pseudo_words(n, rng, exclude=()):
+    words, seen = [], set(exclude)
+    while len(words) < n:
+        word = ''.join(rng.choice(SYLLABLES, rng.integers(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def _zipf(n, exponent=1.0, shift=2.7):
+    p = 1 / (np.arange(n) + shift) ** exponent
+    return p / p.sum()
+
+
+class TextModel:
+    """ Bag-of-words documents over a shared long-tailed vocabulary, with a
+        share of every document drawn from its category's own words.
+    """
+    def __init__(self, n_classes, rng, n_common=20000, n_topic=400, topic_share=0.3):
+        self.rng = rng
+        self.n_common = n_common
+        self.n_topic = n_topic
+        self.topic_share = topic_share
+        common = COMMON_WORDS + _pseudo_words(n_common - len(COMMON_WORDS), rng, COMMON_WORDS)
+        topic = _pseudo_words(n_classes * n_topic, rng, common)
+        self.words = np.array(common + topic, dtype=object)
+        self.p_common = _zipf(n_common)
+        self.p_topic = _zipf(n_topic, exponent=0.8)
+
+    def documents(self, classes, median_words, sigma=0.8, max_words=400):
+        """ One document per entry of `classes`, with lognormal word counts."""
+        rng = self.rng
+        lengths = np.clip(rng.lognormal(np.log(median_words), sigma, len(classes)), 1, max_words).astype(int)
+        doc_class = np.repeat(classes, lengths)
+        index = rng.choice(self.n_common, len(doc_class), p=self.p_common)
+        topic = rng.random(len(doc_class)) < self.topic_share
+        index[topic] = (self.n_common + doc_class[topic] * self.n_topic
+                        + rng.choice(self.n_topic, topic.sum(), p=self.p_topic))
+        tokens = self.words[index]
+        bounds = np.concatenate([[0], np.cumsum(lengths)])
+        return [' '.join(tokens[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def generate_raw(out_dir, n_charities=170000, n_years=8, seed=0):
+    """ Writes the six raw files make_dataset expects for `n_charities`
+        charities to `out_dir`, and returns their paths.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    regnos = np.arange(FIRST_REGNO, FIRST_REGNO + n_charities).astype(str)
+    classes = rng.choice(len(ICNPO_CATEGORIES), n_charities, p=_zipf(len(ICNPO_CATEGORIES), 1.2, 1.0))
+    text = TextModel(len(ICNPO_CATEGORIES), rng)
+    paths = {}
+
+    # activities: scraped part b pages for the larger charities, a tsv for the rest
+    activities = text.documents(classes, median_words=25)
+    partb = rng.random(n_charities) < 0.3
+    partb_frame = pd.DataFrame({
+        'Unnamed: 0': np.flatnonzero(partb),
+        'regno': regnos[partb].astype(float),
+        'activities': np.array(activities, dtype=object)[partb]
+    })
+    # the scrape repeats some pages
+    partb_frame = pd.concat([partb_frame, partb_frame.sample(frac=0.01, random_state=seed)])
+    paths['partb'] = pj(out_dir, 'partb_activities_scraped_2020_08_12_20_18.csv')
+    partb_frame.to_csv(paths['partb'])
+    paths['nonpartb'] = pj(out_dir, 'regno_activities.txt')
+    with open(paths['nonpartb'], 'w') as f:
+        for regno, doc in zip(regnos[~partb], np.array(activities, dtype=object)[~partb]):
+            f.write(f'{regno}\t{doc}\n')
+
+    # some charities are not classified yet
+    icnpo = np.array(ICNPO_CATEGORIES, dtype=object)[classes]
+    icnpo[rng.random(n_charities) < 0.02] = None
+    paths['classifications'] = pj(out_dir, 'classification_objects.csv')
+    pd.DataFrame({
+        'regno': regnos,
+        'ICNPO_NCVO_category': icnpo,
+        'objects': text.documents(classes, median_words=35),
+        'nicename': text.documents(classes, median_words=4, sigma=0.4, max_words=12)
+    }).to_csv(paths['classifications'], index=False)
+
+    paths['financials'] = pj(out_dir, 'cc_financial.csv')
+    synthetic_financials(n_charities, n_years, seed).to_csv(paths['financials'], index=False)
+
+    ru = list(RU_CATEGORIES)
+    paths['charitybase'] = pj(out_dir, 'CharityBase_20200820.csv')
+    pd.DataFrame({
+        'Charity ID': regnos,
+        'LAUA': [f'E{code:08d}' for code in rng.integers(6000001, 6000350, n_charities)],
+        'RU': np.array(ru, dtype=object)[rng.choice(len(ru), n_charities, p=_zipf(len(ru), 1.0, 1.0))],
+        'EER': rng.choice(EER_REGIONS, n_charities),
+        'Funders': rng.poisson(2, n_charities),
+        'Trustees': np.where(rng.random(n_charities) < 0.05, np.nan, rng.poisson(5, n_charities) + 1)
+    }).to_csv(paths['charitybase'], index=False)
+
+    # one to a few self-declared classifications, leaning towards the category
+    n_class_texts = rng.integers(1, 6, n_charities)
+    leaning = (classes * 7) % len(CLASS_TEXTS)
+    picks = np.where(rng.random(n_class_texts.sum()) < 0.5, np.repeat(leaning, n_class_texts),
+                     rng.integers(0, len(CLASS_TEXTS), n_class_texts.sum()))
+    paths['self_class'] = pj(out_dir, 'cc_class.csv')
+    pd.DataFrame({
+        'regno': np.repeat(regnos, n_class_texts),
+        'classtext': np.array(CLASS_TEXTS, dtype=object)[picks]
+    }).to_csv(paths['self_class'], index=False)
+    logger.info(f'generated raw files for {n_charities} charities in {out_dir}')
+    return paths
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path())
+@click.option('--n-charities', 'n_charities', default=170000, type=int)
+@click.option('--n-years', 'n_years', default=8, type=int)
+@click.option('--seed', 'seed', default=0, type=int)
+def main(output_dir, n_charities, n_years, seed):
+    """ Generates synthetic raw data files for make_dataset."""
+    generate_raw(output_dir, n_charities, n_years, seed)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
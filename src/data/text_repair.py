@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Re-segments activity descriptions whose words were run together when they
+    were scraped (e.g. "helpingpeopleinneed"), with wordninja.
+
+    Segmenting is slow enough that it is done once per distinct text: results
+    are kept in a SQLite cache keyed by a hash of the text, so a rebuild only
+    segments descriptions it has not seen before, and the new ones are split
+    into chunks segmented across a process pool.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# texts per task sent to a worker, and per query against the cache
+CHUNK_TEXTS = 2000
+QUERY_TEXTS = 500
+
+
+def segment(text):
+    """ `text` with run-together words split; this also removes punctuation."""
+    import wordninja
+
+    return ' '.join(wordninja.split(text))
+
+
+def segment_chunk(texts):
+    return [segment(text) for text in texts]
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class SegmentCache:
+    """ Segmented texts in a SQLite database, keyed by the hash of the
+        original text.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS segments (hash TEXT PRIMARY KEY, text TEXT)')
+
+    def get_many(self, hashes):
+        """ {hash: segmented text} for the `hashes` in the cache."""
+        found = {}
+        for start in range(0, len(hashes), QUERY_TEXTS):
+            batch = hashes[start:start + QUERY_TEXTS]
+            query = f'SELECT hash, text FROM segments WHERE hash IN ({", ".join("?" * len(batch))})'
+            found.update(self._conn.execute(query, batch).fetchall())
+        return found
+
+    def put_many(self, items):
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO segments VALUES (?, ?)', items)
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def _segment_chunks(texts, n_jobs, chunk_texts):
+    # yields (texts, segmented texts) chunk by chunk, in order
+    chunks = (texts[start:start + chunk_texts] for start in range(0, len(texts), chunk_texts))
+    if n_jobs == 1:
+        for chunk in chunks:
+            yield chunk, segment_chunk(chunk)
+        return
+    with ProcessPoolExecutor(n_jobs) as pool:
+        # bound the chunks in flight so memory stays flat
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(segment_chunk, chunk)))
+            if len(pending) >= 2 * n_jobs:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+def repair_texts(texts, cache_path=None, n_jobs=1, chunk_texts=CHUNK_TEXTS):
+    """ `texts` (a Series) with each text segmented, looking every distinct
+        text up in the cache at `cache_path` first (no cache if None) and
+        adding the ones it had to segment.
+
+        Returns the repaired Series and a dict of the distinct texts, cache
+        hits and misses and the seconds spent segmenting.
+    """
+    n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+    distinct = pd.unique(texts.values)
+    hashes = [text_hash(text) for text in distinct]
+    cache = SegmentCache(cache_path) if cache_path else None
+    try:
+        found = cache.get_many(hashes) if cache is not None else {}
+        missing = [text for text, h in zip(distinct, hashes) if h not in found]
+        start = time.perf_counter()
+        repaired = {}
+        for chunk, segmented in _segment_chunks(missing, n_jobs, chunk_texts):
+            repaired.update(zip(chunk, segmented))
+            if cache is not None:
+                # stored as they arrive so an interrupted build keeps what it did
+                cache.put_many([(text_hash(text), s) for text, s in zip(chunk, segmented)])
+        seconds = time.perf_counter() - start
+    finally:
+        if cache is not None:
+            cache.close()
+    repaired.update((text, found[h]) for text, h in zip(distinct, hashes) if h in found)
+
+    stats = {'distinct_texts': len(distinct), 'cache_hits': len(distinct) - len(missing),
+             'cache_misses': len(missing), 'segment_seconds': seconds}
+    logger.info(f'repaired {len(texts)} texts ({len(distinct)} distinct): '
+                f'{stats["cache_hits"] / max(len(distinct), 1):.1%} cache hit rate, '
+                f'{len(missing)} segmented in {seconds:.1f}s '
+                f'({len(missing) / max(seconds, 1e-9):.0f} texts/s on {n_jobs} processes)')
+    return texts.map(repaired), stats
@@ -24,40 +24,84 @@ from src.features.custom_transformers import (
     FeatureExtractorNumber,
     CustomImputer
 )
+from src.data.artifact_cache import get_artifact_cache
+from src.data.columnar import load_columnar
+from src.features.sparse_union import make_sparse_union
+from src.features.tokens import (
+    TEXT_COLUMNS,
+    TokenCountVectorizer,
+    TokenHashingVectorizer,
+    build_token_store
+)
 
+TEXT_VECTORIZERS = ['count', 'hashing']
+
+
+def make_text_vectorizer(text_features='count', n_features=2 ** 18):
+    """ The vectorizer for the free-text columns. The hashing vectorizer is
+        stateless: it has no vocabulary to fit or pickle, hashes tokens into
+        `n_features` columns and emits float32 counts. Both also accept the
+        pre-tokenized documents of src.features.tokens.
+    """
+    if text_features == 'hashing':
+        return TokenHashingVectorizer(n_features=n_features, alternate_sign=False, norm=None,
+                                      dtype=np.float32)
+    return TokenCountVectorizer()
+
+
+def text_pipe(column, text_features='count', n_features=2 ** 18):
+    """ Extractor, vectorizer and scaler for a text column, with the step names
+        make_pipeline would give the plain sklearn vectorizers (and which the
+        model_params grids refer to).
+    """
+    return Pipeline([
+        ('featureextractortext', FeatureExtractorText(column)),
+        (f'{text_features}vectorizer', make_text_vectorizer(text_features, n_features)),
+        ('standardscaler', StandardScaler())
+    ])
+
+
+def pre_tokenize(processed_dir):
+    """ Normalizes and tokenizes the text columns of the processed dataset
+        once, for all of the vectorizers and search candidates to reuse.
+    """
+    tokens_dir = pj(processed_dir, 'tokens')
+    if os.path.exists(pj(processed_dir, 'data.feather')):
+        data = load_columnar(pj(processed_dir, 'data.feather'), columns=TEXT_COLUMNS)
+    else:
+        with open(pj(processed_dir, 'data.pkl'), 'rb') as f:
+            data = pkl.load(f)
+    for column in TEXT_COLUMNS:
+        # normalized as train_model configures the vectorizers
+        build_token_store(data[column], pj(tokens_dir, column), lowercase=True, strip_accents='unicode')
+    return tokens_dir
 
 
-@click.command()
-@click.option('--use-s3', 'use_s3', default=True)
-def main(use_s3):
-    """ Builds features for modelling."""
+def text_vectorizer_name(feature_union):
+    """ Step name of the text vectorizer in a feature union built by main,
+        i.e. the prefix of its parameters in the model_params grids.
+    """
+    for _, transformer in feature_union.transformer_list:
+        for name, _ in getattr(transformer, 'steps', []):
+            if name in ('countvectorizer', 'hashingvectorizer'):
+                return name
+    return 'countvectorizer'
 
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(os.environ.get('BUCKET'))
-    processed_dir = pj(project_dir, 'data', os.environ.get('PROCESSED_DIR'))
 
-    activities_pipe = make_pipeline(
-        FeatureExtractorText('activities'),
-        CountVectorizer(),
-        StandardScaler()
-    )
+def make_feature_union(text_features='count', hash_features=2 ** 18, sparse_float32=False):
+    """ The unfitted feature union over the processed dataset's columns that
+        train_model searches over.
+    """
+    activities_pipe = text_pipe('activities', text_features, hash_features)
 
-    objects_pipe = make_pipeline(
-        FeatureExtractorText('objects'),
-        CountVectorizer(),
-        StandardScaler()
-    )
+    objects_pipe = text_pipe('objects', text_features, hash_features)
 
     income_pipe = make_pipeline(
         FeatureExtractorNumber('income_3y_mean'),
         StandardScaler()
     )
 
-    title_pipe = make_pipeline(
-        FeatureExtractorText('name'),
-        CountVectorizer(),
-        StandardScaler()
-    )
+    title_pipe = text_pipe('name', text_features, hash_features)
 
     region_pipe = make_pipeline(
         FeatureExtractorOHE('EER'),
@@ -83,14 +127,36 @@ def main(use_s3):
         StandardScaler()
     )
 
-    selfclass_pipe = make_pipeline(
-        FeatureExtractorText('self_class'),
-        CountVectorizer(),
-        StandardScaler()
-    )
+    selfclass_pipe = text_pipe('self_class', text_features, hash_features)
+
+    pipes = [activities_pipe, objects_pipe, income_pipe, title_pipe, region_pipe,
+             ru_pipe, trustees_pipe, selfclass_pipe]
+    if sparse_float32:
+        return make_sparse_union(*pipes)
+    return make_union(*pipes)
+
+
+@click.command()
+@click.option('--use-s3', 'use_s3', default=True)
+@click.option('--text-features', 'text_features', default='count', type=click.Choice(TEXT_VECTORIZERS),
+              help='Vocabulary-based counts, or stateless feature hashing.')
+@click.option('--hash-features', 'hash_features', default=2 ** 18, type=int,
+              help='Number of hashed columns per text field with --text-features hashing.')
+@click.option('--pre-tokenize', 'pre_tokenize_text', is_flag=True,
+              help='Tokenize the processed text columns once into data/processed/tokens for train_model.')
+@click.option('--sparse-float32', 'sparse_float32', is_flag=True,
+              help='Assemble the features into one float32 CSR matrix, never densifying the sparse blocks.')
+def main(use_s3, text_features, hash_features, pre_tokenize_text, sparse_float32):
+    """ Builds features for modelling."""
+
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(os.environ.get('BUCKET'))
+    processed_dir = pj(project_dir, 'data', os.environ.get('PROCESSED_DIR'))
+
+    feature_union = make_feature_union(text_features, hash_features, sparse_float32)
 
-    feature_union = make_union(activities_pipe, objects_pipe, income_pipe, title_pipe, region_pipe, 
-                    ru_pipe, trustees_pipe, selfclass_pipe)
+    if pre_tokenize_text:
+        pre_tokenize(processed_dir)
 
     
     # save feature_union
@@ -103,12 +169,9 @@ def main(use_s3):
             bucket.put_object(Key=key, Body=fp.read())
         # download to local processed folder
         try:
-            bucket.download_file(key, pj(processed_dir, filename))
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                print("The object does not exist.")
-            else:
-                raise
+            get_artifact_cache(bucket.name).fetch_to(key, pj(processed_dir, filename))
+        except FileNotFoundError:
+            print("The object does not exist.")
     else:
         _file = open(pj(processed_dir, filename), 'wb')
         joblib.dump(feature_union, _file)
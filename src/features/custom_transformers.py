@@ -3,16 +3,26 @@
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.impute import SimpleImputer
 import numpy as np
+import os
+from os.path import join as pj
+from src.features.tokens import TokenDocs, load_token_store
 
 class FeatureExtractorText(BaseEstimator, TransformerMixin):
-    def __init__(self, columns):
+    # class default for extractors pickled before pre-tokenization existed
+    tokens = None
+
+    def __init__(self, columns, tokens=None):
         self.columns = columns
+        # directory of token stores written by build_features --pre-tokenize
+        self.tokens = tokens
 
     def fit(self, X, *args):
         return self
 
     def transform(self, X, *args):
         X = X[self.columns].values
+        if self.tokens is not None and os.path.isdir(pj(self.tokens, self.columns)):
+            return TokenDocs(load_token_store(pj(self.tokens, self.columns)), X)
         return X
 
     
@@ -24,7 +34,8 @@ class FeatureExtractorOHE(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X, *args):
-        X = X[self.columns].values.reshape(-1, 1)
+        # to_numpy also handles categorical columns loaded from the columnar format
+        X = X[self.columns].to_numpy().reshape(-1, 1)
         return X
               
               
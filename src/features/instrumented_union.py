@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""" Feature unions that time every step of every transformer they fit and
+    apply, to see which of the pipelines a search spends its time in.
+
+    The steps are only measured while an Instrumentation is spooling (see
+    src.data.instrumentation), otherwise the unions behave like the ones they
+    were made from. Transformers run one after another either way.
+"""
+import logging
+import numpy as np
+from sklearn.pipeline import FeatureUnion, Pipeline
+from src.data.instrumentation import measure, spool, spool_dir
+from src.features.sparse_union import SparseFeatureUnion
+
+logger = logging.getLogger(__name__)
+
+
+def _n_rows(X):
+    return X.shape[0] if hasattr(X, 'shape') else len(X)
+
+
+def _weighted(X, weight):
+    return X if weight is None else X * weight
+
+
+class InstrumentedUnionMixin:
+    """ fit_transform and transform of FeatureUnion, looping over the
+        transformers' steps so each can be measured.
+    """
+    def _apply(self, phase, name, transformer, X, y=None, **fit_params):
+        fitting = phase == 'fit_transform'
+        if spool_dir() is None or (fit_params and isinstance(transformer, Pipeline)):
+            # nothing to measure into, or fit params only the pipeline can route
+            return transformer.fit_transform(X, y, **fit_params) if fitting else transformer.transform(X)
+
+        steps = transformer.steps if isinstance(transformer, Pipeline) else [(name, transformer)]
+        column = getattr(steps[0][1], 'columns', None)
+        records = []
+        for step_name, step in steps:
+            if step is None or step == 'passthrough':
+                continue
+            with measure(f'features/{phase}', rows=_n_rows(X), pipeline=name, step=step_name,
+                         column=column) as record:
+                if not fitting:
+                    X = step.transform(X)
+                elif hasattr(step, 'fit_transform'):
+                    X = step.fit_transform(X, y, **fit_params)
+                else:
+                    X = step.fit(X, y, **fit_params).transform(X)
+            records.append(record)
+        spool(records)
+        return X
+
+    def fit(self, X, y=None, **fit_params):
+        self.fit_transform(X, y, **fit_params)
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        self.transformer_list = list(self.transformer_list)
+        self._validate_transformers()
+        if hasattr(self, '_validate_transformer_weights'):
+            self._validate_transformer_weights()
+        Xs, transformers = [], []
+        for name, transformer, weight in self._iter():
+            Xs.append(_weighted(self._apply('fit_transform', name, transformer, X, y, **fit_params), weight))
+            transformers.append(transformer)
+        if not Xs:
+            return np.zeros((_n_rows(X), 0))
+        self._update_transformer_list(transformers)
+        return self._hstack(Xs)
+
+    def transform(self, X):
+        Xs = [_weighted(self._apply('transform', name, transformer, X), weight)
+              for name, transformer, weight in self._iter()]
+        if not Xs:
+            return np.zeros((_n_rows(X), 0))
+        return self._hstack(Xs)
+
+
+class InstrumentedFeatureUnion(InstrumentedUnionMixin, FeatureUnion):
+    pass
+
+
+class InstrumentedSparseFeatureUnion(InstrumentedUnionMixin, SparseFeatureUnion):
+    pass
+
+
+_INSTRUMENTED = {FeatureUnion: InstrumentedFeatureUnion, SparseFeatureUnion: InstrumentedSparseFeatureUnion}
+
+
+def _swap_class(union, cls):
+    swapped = cls.__new__(cls)
+    swapped.__dict__.update(union.__dict__)
+    return swapped
+
+
+def instrument_union(union):
+    """ An instrumented copy of a (fitted or unfitted) feature union, with the
+        same parameters and transformers.
+    """
+    if isinstance(union, InstrumentedUnionMixin):
+        return union
+    return _swap_class(union, _INSTRUMENTED[type(union)])
+
+
+def uninstrument_union(union):
+    """ The plain feature union an instrumented one was made from, e.g. before
+        a model is saved.
+    """
+    for plain, instrumented in _INSTRUMENTED.items():
+        if type(union) is instrumented:
+            return _swap_class(union, plain)
+    return union
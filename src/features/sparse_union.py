@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import logging
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.pipeline import FeatureUnion, Pipeline, _name_estimators
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+logger = logging.getLogger(__name__)
+
+
+def _makes_sparse(step):
+    if isinstance(step, (CountVectorizer, HashingVectorizer)):
+        return True
+    if isinstance(step, OneHotEncoder):
+        # renamed sparse_output in newer sklearn
+        return getattr(step, 'sparse_output', getattr(step, 'sparse', True)) is not False
+    return False
+
+
+def _steps(transformer):
+    return transformer.steps if isinstance(transformer, Pipeline) else [(None, transformer)]
+
+
+def expects_sparse(transformer):
+    """ Whether a transformer (or pipeline) of the union emits sparse output."""
+    return any(_makes_sparse(step) for _, step in _steps(transformer))
+
+
+def uncenter_sparse_scalers(transformer):
+    """ Sets with_mean=False on every StandardScaler that follows a sparse step.
+
+        Centering would densify those columns, and the models don't need it: a
+        shift of a feature moves the intercept of the linear models and leaves
+        trees and euclidean (knn, rbf svm) distances unchanged. The dense
+        numeric columns are still centred.
+    """
+    sparse = False
+    for _, step in _steps(transformer):
+        sparse = sparse or _makes_sparse(step)
+        if sparse and isinstance(step, StandardScaler):
+            step.set_params(with_mean=False)
+    return transformer
+
+
+class SparseFeatureUnion(FeatureUnion):
+    """ FeatureUnion whose output is always a single CSR matrix of `dtype`.
+
+        A transformer whose steps produce sparse output (vectorizers, one-hot
+        encoders) but which returns a dense block has densified somewhere on
+        the way; that is logged, or raised with `strict`.
+    """
+    def __init__(self, transformer_list, *, n_jobs=None, transformer_weights=None, verbose=False,
+                 dtype=np.float32, strict=False):
+        super().__init__(transformer_list, n_jobs=n_jobs, transformer_weights=transformer_weights,
+                         verbose=verbose)
+        self.dtype = dtype
+        self.strict = strict
+
+    def _hstack(self, Xs):
+        blocks = []
+        for (name, transformer, _), X in zip(self._iter(), Xs):
+            if not sp.issparse(X) and expects_sparse(transformer):
+                message = f'{name} densified its sparse output to a {X.shape} {X.dtype} array'
+                if self.strict:
+                    raise ValueError(message)
+                logger.warning(message)
+            blocks.append(sp.csr_matrix(X, dtype=self.dtype))
+        return sp.hstack(blocks, format='csr', dtype=self.dtype)
+
+
+def make_sparse_union(*transformers, dtype=np.float32, strict=False, n_jobs=None):
+    """ make_union for SparseFeatureUnion, with the same step names, and with
+        centering disabled after the sparse steps.
+    """
+    for transformer in transformers:
+        uncenter_sparse_scalers(transformer)
+    return SparseFeatureUnion(_name_estimators(transformers), dtype=dtype, strict=strict, n_jobs=n_jobs)
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from os.path import join as pj
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.pipeline import Pipeline, FeatureUnion
+from sklearn.preprocessing import normalize
+
+logger = logging.getLogger(__name__)
+
+TEXT_COLUMNS = ['activities', 'objects', 'name', 'self_class']
+TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+# stores opened by this process, so each is memory-mapped once per worker
+_STORES = {}
+
+
+def hash_documents(docs):
+    """ 64-bit hash of every document, the key documents are looked up by."""
+    return pd.util.hash_array(np.asarray(docs, dtype=object))
+
+
+class TokenStore:
+    """ Token ids of every distinct document of a text column: one flat int32
+        array of ids with the offsets of each document, memory-mapped from
+        `path` and looked up by the hash of the document's text.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(pj(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.vocab = np.array(self.meta.pop('vocab'), dtype=object)
+        self.hashes = np.load(pj(path, 'hashes.npy'), mmap_mode='r')
+        self.offsets = np.load(pj(path, 'offsets.npy'), mmap_mode='r')
+        self.ids = np.load(pj(path, 'ids.npy'), mmap_mode='r')
+        self._token_ids = None
+
+    @property
+    def token_ids(self):
+        """ Id of each token in the vocabulary, for tokenizing new documents."""
+        if self._token_ids is None:
+            self._token_ids = dict(zip(self.vocab, range(len(self.vocab))))
+        return self._token_ids
+
+    def __reduce__(self):
+        # pickled (e.g. to parallel workers or the feature cache) as its path
+        return load_token_store, (self.path,)
+
+    def matches(self, vectorizer):
+        """ Whether `vectorizer` would tokenize documents the way the store did."""
+        return (vectorizer.analyzer == 'word'
+                and vectorizer.preprocessor is None
+                and vectorizer.tokenizer is None
+                and vectorizer.lowercase == self.meta['lowercase']
+                and vectorizer.strip_accents == self.meta['strip_accents']
+                and vectorizer.token_pattern == self.meta['token_pattern'])
+
+    def lookup(self, docs):
+        """ Position of each document in the store, -1 where it isn't stored."""
+        hashes = hash_documents(docs)
+        positions = np.searchsorted(self.hashes, hashes)
+        positions[positions == len(self.hashes)] = 0
+        found = (self.hashes[positions] == hashes) if len(self.hashes) else np.zeros(len(hashes), bool)
+        return np.where(found, positions, -1)
+
+    def tokens(self, position):
+        return self.ids[self.offsets[position]:self.offsets[position + 1]]
+
+
+def load_token_store(path):
+    store = _STORES.get(path)
+    if store is None:
+        store = _STORES[path] = TokenStore(path)
+    return store
+
+
+def build_token_store(docs, path, lowercase=True, strip_accents='unicode', token_pattern=TOKEN_PATTERN):
+    """ Normalizes and tokenizes each distinct document of `docs` once and
+        writes the token ids to `path`.
+    """
+    docs = pd.unique(pd.Series(docs).dropna().astype(str))
+    # stored in hash order so documents can be found by binary search
+    hashes = hash_documents(docs)
+    order = np.argsort(hashes, kind='stable')
+    docs, hashes = docs[order], hashes[order]
+
+    analyze = CountVectorizer(lowercase=lowercase, strip_accents=strip_accents,
+                              token_pattern=token_pattern).build_analyzer()
+    vocab = {}
+    ids, offsets = [], [0]
+    for doc in docs:
+        ids.extend(vocab.setdefault(token, len(vocab)) for token in analyze(doc))
+        offsets.append(len(ids))
+
+    os.makedirs(path, exist_ok=True)
+    np.save(pj(path, 'hashes.npy'), hashes)
+    np.save(pj(path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(pj(path, 'ids.npy'), np.asarray(ids, dtype=np.int32))
+    with open(pj(path, 'meta.json'), 'w') as f:
+        json.dump({
+            'lowercase': lowercase,
+            'strip_accents': strip_accents,
+            'token_pattern': token_pattern,
+            'vocab': sorted(vocab, key=vocab.get)
+        }, f)
+    _STORES.pop(path, None)
+    logger.info(f'tokenized {len(docs)} documents into {len(ids)} tokens, {len(vocab)} distinct, at {path}')
+    return path
+
+
+class TokenDocs:
+    """ Documents of a text column as token id arrays from `store`, falling
+        back to the raw text for documents the store doesn't hold.
+    """
+    def __init__(self, store, docs):
+        self.store = store
+        self.docs = docs
+        self.positions = store.lookup(docs)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        for doc, position in zip(self.docs, self.positions):
+            yield doc if position < 0 else self.store.tokens(position)
+
+
+def _ngram_codes(id_arrays, n_vocab, ngram_range):
+    """ Every n-gram of the token id arrays as one int64 code: the ids in base
+        `n_vocab`, offset per n so n-grams of different lengths never collide.
+        Returns the codes and the document each came from.
+    """
+    lengths = np.fromiter((len(ids) for ids in id_arrays), dtype=np.int64, count=len(id_arrays))
+    ids = np.concatenate(id_arrays).astype(np.int64) if lengths.sum() else np.zeros(0, np.int64)
+    doc = np.repeat(np.arange(len(id_arrays)), lengths)
+    # position of each token within its document
+    position = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    codes, docs = [], []
+    offset = 0
+    min_n, max_n = ngram_range
+    for n in range(1, max_n + 1):
+        if n >= min_n:
+            start = np.flatnonzero(position + n <= lengths[doc])
+            code = np.zeros(len(start), np.int64)
+            for k in range(n):
+                code = code * n_vocab + ids[start + k]
+            codes.append(code + offset)
+            docs.append(doc[start])
+        offset += n_vocab ** n
+    return np.concatenate(codes), np.concatenate(docs)
+
+
+def _ngram_strings(codes, vocab, ngram_range):
+    """ Inverse of _ngram_codes for (unique) codes: the n-grams as sklearn
+        spells them, tokens joined by single spaces.
+    """
+    n_vocab = len(vocab)
+    strings = np.empty(len(codes), dtype=object)
+    offset = 0
+    for n in range(1, ngram_range[1] + 1):
+        in_n = (codes >= offset) & (codes < offset + n_vocab ** n)
+        if n >= ngram_range[0] and in_n.any():
+            rest = codes[in_n] - offset
+            digits = []
+            for _ in range(n):
+                rest, digit = np.divmod(rest, n_vocab)
+                digits.append(vocab[digit])
+            strings[in_n] = [' '.join(tokens) for tokens in zip(*reversed(digits))]
+        offset += n_vocab ** n
+    return strings
+
+
+class PreTokenizedMixin:
+    """ Vectorizer that counts n-grams of TokenDocs from their token ids in bulk:
+        decoding, normalization and tokenization were done once by the store,
+        and n-grams are built and counted as integer codes, so strings are only
+        formed once per distinct n-gram. Any other input is vectorized as usual.
+    """
+    _token_store = None
+
+    def _with_tokens(self, method, X, *args, **kwargs):
+        store = None
+        if isinstance(X, TokenDocs):
+            if X.store.matches(self):
+                store = X.store
+            else:
+                X = X.docs
+        self._token_store = store
+        try:
+            return method(X, *args, **kwargs)
+        finally:
+            # not pickled with the model, which must vectorize new raw text
+            self._token_store = None
+
+    def fit(self, X, y=None):
+        return self._with_tokens(super().fit, X, y)
+
+    def fit_transform(self, X, y=None):
+        return self._with_tokens(super().fit_transform, X, y)
+
+    def transform(self, X):
+        return self._with_tokens(super().transform, X)
+
+    def _token_counts(self, docs):
+        """ Distinct n-grams of `docs` and a (documents x n-grams) count matrix,
+            or None if the vocabulary is too large to code n-grams in an int64.
+        """
+        store = self._token_store
+        vocab = list(store.vocab)
+        stop_words = self.get_stop_words()
+        keep = ~np.isin(store.vocab, list(stop_words)) if stop_words else np.ones(len(vocab), bool)
+
+        # documents missing from the store are tokenized here, new tokens
+        # getting ids after the store's vocabulary
+        tokenize, preprocess = self.build_tokenizer(), self.build_preprocessor()
+        extra, id_arrays = {}, []
+        for doc, position in zip(docs.docs, docs.positions):
+            if position >= 0:
+                ids = store.tokens(position)
+                id_arrays.append(ids[keep[ids]])
+                continue
+            tokens = [token for token in tokenize(preprocess(self.decode(doc)))
+                      if not stop_words or token not in stop_words]
+            id_arrays.append(np.array([
+                store.token_ids[token] if token in store.token_ids
+                else extra.setdefault(token, len(vocab) + len(extra)) for token in tokens
+            ], dtype=np.int64))
+        vocab = np.array(vocab + list(extra), dtype=object)
+        if sum(len(vocab) ** n for n in range(1, self.ngram_range[1] + 1)) >= 2 ** 62:
+            return None
+
+        codes, doc_index = _ngram_codes(id_arrays, len(vocab), self.ngram_range)
+        unique, column = np.unique(codes, return_inverse=True)
+        counts = sp.csr_matrix((np.ones(len(codes), dtype=np.intc), (doc_index, column)),
+                               shape=(len(id_arrays), len(unique)))
+        counts.sum_duplicates()
+        return _ngram_strings(unique, vocab, self.ngram_range), counts
+
+
+class TokenCountVectorizer(PreTokenizedMixin, CountVectorizer):
+    def _count_vocab(self, raw_documents, fixed_vocab):
+        if self._token_store is None:
+            return super()._count_vocab(raw_documents, fixed_vocab)
+
+        token_counts = self._token_counts(raw_documents)
+        if token_counts is None:
+            return super()._count_vocab(raw_documents.docs, fixed_vocab)
+        ngrams, counts = token_counts
+        if fixed_vocab:
+            vocabulary = self.vocabulary_
+            column = np.array([vocabulary.get(ngram, -1) for ngram in ngrams], dtype=np.int64)
+            known = np.flatnonzero(column >= 0)
+            # select the known n-grams and put them in the fitted columns
+            mapping = sp.csr_matrix((np.ones(len(known), dtype=np.intc), (known, column[known])),
+                                    shape=(len(ngrams), len(vocabulary)))
+            X = counts @ mapping
+        else:
+            if not len(ngrams):
+                raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+            vocabulary = dict(zip(ngrams, range(len(ngrams))))
+            X = counts
+        X = sp.csr_matrix(X, dtype=self.dtype)
+        X.sort_indices()
+        return vocabulary, X
+
+
+class TokenHashingVectorizer(PreTokenizedMixin, HashingVectorizer):
+    def transform(self, X):
+        if not isinstance(X, TokenDocs):
+            return super().transform(X)
+        return self._with_tokens(self._transform_tokens, X)
+
+    def _transform_tokens(self, X):
+        if self._token_store is None:
+            return HashingVectorizer.transform(self, X)
+
+        self._validate_params()
+        token_counts = self._token_counts(X)
+        if token_counts is None:
+            return HashingVectorizer.transform(self, X.docs)
+        ngrams, counts = token_counts
+        # each distinct n-gram is hashed once; collisions add up in the product
+        hashed = self._get_hasher().transform([ngram] for ngram in ngrams)
+        X = sp.csr_matrix(counts @ hashed, dtype=self.dtype)
+        X.sort_indices()
+        if self.binary:
+            X.data.fill(1)
+        if self.norm is not None:
+            X = normalize(X, norm=self.norm, copy=False)
+        return X
+
+
+def set_token_store(estimator, tokens_dir):
+    """ Points the text extractors in front of the token-aware vectorizers of a
+        feature union (or a pipeline holding one) at the stores in `tokens_dir`,
+        or back to raw text if it is None.
+    """
+    from src.features.custom_transformers import FeatureExtractorText
+
+    steps = estimator.steps if isinstance(estimator, Pipeline) else [(None, estimator)]
+    for _, step in steps:
+        if isinstance(step, FeatureUnion):
+            for _, transformer in step.transformer_list:
+                set_token_store(transformer, tokens_dir)
+        elif isinstance(step, Pipeline):
+            set_token_store(step, tokens_dir)
+
+    if isinstance(estimator, Pipeline):
+        for (_, step), (_, next_step) in zip(estimator.steps, estimator.steps[1:]):
+            if isinstance(step, FeatureExtractorText) and isinstance(next_step, PreTokenizedMixin):
+                step.tokens = tokens_dir
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+""" A k-nearest-neighbours classifier that searches an approximate index
+    rather than every training row.
+
+    The sparse feature union output is reduced with TruncatedSVD and the
+    reduced rows are partitioned into `n_lists` k-means cells (an inverted
+    file index). A query is only compared with the rows of the `n_probe`
+    cells whose centroids are nearest to it, so its cost grows with the size
+    of a cell rather than with the training set. More components and more
+    probed cells raise the recall of the true neighbours at the cost of
+    latency; n_probe = n_lists compares every row, like brute force.
+"""
+import logging
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+from sklearn.utils import check_array
+from sklearn.utils.validation import check_is_fitted
+import scipy.sparse as sp
+
+logger = logging.getLogger(__name__)
+
+# query x candidate distances computed at a time
+BLOCK_ENTRIES = 2 ** 22
+
+
+def _sq_norms(Z):
+    return np.einsum('ij,ij->i', Z, Z)
+
+
+class ApproximateKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """ k-nearest-neighbours vote over an SVD-reduced, k-means partitioned
+        copy of the training rows.
+
+        metric is 'euclidean' (in the reduced space) or 'cosine'; weights is
+        'uniform' or 'distance', as for KNeighborsClassifier. `n_lists`
+        defaults to the square root of the number of training rows.
+    """
+    def __init__(self, n_neighbors=5, weights='uniform', metric='euclidean', n_components=100, n_lists=None,
+                 n_probe=8, random_state=None):
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.metric = metric
+        self.n_components = n_components
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.random_state = random_state
+
+    def _reduce(self, X):
+        X = self.svd_.transform(X) if self.svd_ is not None else (X.toarray() if sp.issparse(X) else X)
+        X = np.asarray(X, dtype=np.float32)
+        return normalize(X) if self.metric == 'cosine' else X
+
+    def fit(self, X, y):
+        if self.metric not in ('euclidean', 'cosine'):
+            raise ValueError(f'unsupported metric {self.metric!r}')
+        if self.weights not in ('uniform', 'distance'):
+            raise ValueError(f'unsupported weights {self.weights!r}')
+        X = check_array(X, accept_sparse='csr')
+        self.classes_, y = np.unique(np.asarray(y), return_inverse=True)
+        n_rows, n_features = X.shape
+
+        # TruncatedSVD needs fewer components than features; narrow inputs are kept as they are
+        self.svd_ = None
+        if self.n_components and self.n_components < n_features:
+            self.svd_ = TruncatedSVD(self.n_components, random_state=self.random_state).fit(X)
+        Z = self._reduce(X)
+
+        n_lists = min(self.n_lists or max(1, int(round(np.sqrt(n_rows)))), n_rows)
+        kmeans = MiniBatchKMeans(n_lists, batch_size=1024, n_init=3, random_state=self.random_state).fit(Z)
+        cells = kmeans.predict(Z)
+        self.centroids_ = kmeans.cluster_centers_.astype(np.float32)
+
+        # the rows stored cell by cell, so a cell is a contiguous slice
+        order = np.argsort(cells, kind='stable')
+        self.index_ = order
+        self.vectors_ = Z[order]
+        self.sq_norms_ = _sq_norms(self.vectors_)
+        self.targets_ = y[order]
+        self.offsets_ = np.r_[0, np.cumsum(np.bincount(cells, minlength=n_lists))]
+        self.prior_ = np.bincount(y, minlength=len(self.classes_)) / n_rows
+        return self
+
+    def _search(self, X, k):
+        # squared distances and stored positions of the k nearest probed rows of
+        # each query; -1 (at an infinite distance) where the probed cells hold fewer
+        Q = self._reduce(check_array(X, accept_sparse='csr'))
+        sq_q = _sq_norms(Q)
+        n_lists = len(self.centroids_)
+        n_probe = min(self.n_probe, n_lists)
+        to_centroids = _sq_norms(self.centroids_)[None, :] - 2 * Q @ self.centroids_.T
+        probes = np.argpartition(to_centroids, n_probe - 1, axis=1)[:, :n_probe] \
+            if n_probe < n_lists else np.tile(np.arange(n_lists), (len(Q), 1))
+
+        best_d = np.full((len(Q), k), np.inf, dtype=np.float32)
+        best_i = np.full((len(Q), k), -1)
+        # the queries probing each cell
+        cells, queries = probes.ravel(), np.repeat(np.arange(len(Q)), n_probe)
+        order = np.argsort(cells, kind='stable')
+        cells, queries = cells[order], queries[order]
+        bounds = np.r_[0, np.cumsum(np.bincount(cells, minlength=n_lists))]
+        for cell in range(n_lists):
+            start, stop = self.offsets_[cell], self.offsets_[cell + 1]
+            cell_queries = queries[bounds[cell]:bounds[cell + 1]]
+            if start == stop or not len(cell_queries):
+                continue
+            block = max(1, BLOCK_ENTRIES // (stop - start))
+            for b in range(0, len(cell_queries), block):
+                qs = cell_queries[b:b + block]
+                d = sq_q[qs, None] - 2 * Q[qs] @ self.vectors_[start:stop].T + self.sq_norms_[None, start:stop]
+                d = np.hstack([best_d[qs], d])
+                i = np.hstack([best_i[qs], np.broadcast_to(np.arange(start, stop), (len(qs), stop - start))])
+                nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+                best_d[qs] = np.take_along_axis(d, nearest, axis=1)
+                best_i[qs] = np.take_along_axis(i, nearest, axis=1)
+
+        order = np.argsort(best_d, axis=1)
+        return np.maximum(np.take_along_axis(best_d, order, axis=1), 0), np.take_along_axis(best_i, order, axis=1)
+
+    def _distances(self, sq_d):
+        # for unit vectors |a - b| ** 2 = 2 - 2 cos(a, b)
+        return sq_d / 2 if self.metric == 'cosine' else np.sqrt(sq_d)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """ Distances to and training row positions of the nearest probed
+            neighbours of each row of `X`, nearest first.
+        """
+        check_is_fitted(self)
+        k = min(n_neighbors or self.n_neighbors, len(self.vectors_))
+        sq_d, positions = self._search(X, k)
+        found = positions >= 0
+        neighbors = np.where(found, self.index_[np.maximum(positions, 0)], -1)
+        return (self._distances(sq_d), neighbors) if return_distance else neighbors
+
+    def predict_proba(self, X):
+        check_is_fitted(self)
+        k = min(self.n_neighbors, len(self.vectors_))
+        sq_d, positions = self._search(X, k)
+        found = positions >= 0
+        if self.weights == 'distance':
+            distances = self._distances(sq_d)
+            with np.errstate(divide='ignore'):
+                weights = 1 / distances
+            # an exact match outweighs every other neighbour, as in sklearn
+            exact = np.isinf(weights).any(axis=1)
+            weights[exact] = distances[exact] == 0
+        else:
+            weights = np.ones(positions.shape)
+        weights = np.where(found, weights, 0)
+
+        n_classes = len(self.classes_)
+        rows = np.repeat(np.arange(len(positions)), k)
+        targets = self.targets_[np.maximum(positions, 0)].ravel()
+        proba = np.bincount(rows * n_classes + targets, weights=weights.ravel(),
+                            minlength=len(positions) * n_classes).reshape(-1, n_classes)
+        totals = proba.sum(axis=1, keepdims=True)
+        # a query whose probed cells were empty gets the class prior
+        return np.where(totals > 0, proba / np.where(totals > 0, totals, 1), self.prior_)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
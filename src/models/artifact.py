@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+""" Slim model artifacts: the fitted best estimator alone, pickled uncompressed
+    so that its numpy arrays can be memory-mapped when loaded, next to a small
+    json sidecar holding the search's metadata and cv_results_.
+"""
+import json
+import logging
+import os
+from os.path import join as pj
+import joblib
+import numpy as np
+from src.data.s3_transfer import upload_file
+
+logger = logging.getLogger(__name__)
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        # masked entries (parameters a candidate didn't set) become None
+        return _jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return repr(value)
+
+
+def search_metadata(searchcv, **extra):
+    """ JSON-safe description of a fitted search (or plain estimator): its
+        best parameters and score and the full cv_results_, plus `extra`.
+    """
+    meta = {'estimator_class': type(getattr(searchcv, 'best_estimator_', searchcv)).__name__}
+    for attr in ('best_params_', 'best_score_', 'best_index_', 'n_splits_', 'refit_time_', 'cv_results_'):
+        if hasattr(searchcv, attr):
+            meta[attr.rstrip('_')] = _jsonable(getattr(searchcv, attr))
+    meta.update(_jsonable(extra))
+    return meta
+
+
+def save_artifact(model, meta, path):
+    """ Writes `model` (a search's best_estimator_ if given a search) to
+        `path`.jlib and `meta` to `path`.json, returning both paths.
+
+        The pickle is streamed to disk uncompressed, never held in memory as a
+        whole, and joblib aligns its arrays so load_artifact can map them.
+    """
+    model = getattr(model, 'best_estimator_', model)
+    model_path, meta_path = f'{path}.jlib', f'{path}.json'
+    joblib.dump(model, model_path, compress=0)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f'saved {type(model).__name__} to {model_path} ({os.path.getsize(model_path)} bytes)')
+    return model_path, meta_path
+
+
+def load_artifact(path, mmap_mode='r'):
+    """ Loads a model saved by save_artifact with its arrays memory-mapped,
+        so that processes loading the same file share its pages.
+    """
+    return joblib.load(path, mmap_mode=mmap_mode)
+
+
+def load_metadata(path):
+    """ The json sidecar of the model at `path`."""
+    with open(f'{os.path.splitext(path)[0]}.json') as f:
+        return json.load(f)
+
+
+def upload_artifact(client, bucket_name, paths, prefix):
+    """ Streams the artifact's files to `prefix` in the bucket, as multipart
+        uploads for the large ones, and returns their keys.
+    """
+    return [upload_file(client, bucket_name, path, pj(prefix, os.path.basename(path))) for path in paths]
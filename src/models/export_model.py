@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import time
+from os.path import join as pj
+from pathlib import Path
+import click
+import joblib
+import numpy as np
+import pandas as pd
+from dotenv import find_dotenv, load_dotenv
+from sklearn.ensemble import (
+    AdaBoostClassifier,
+    BaggingClassifier,
+    ExtraTreesClassifier,
+    RandomForestClassifier
+)
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.pipeline import FeatureUnion, Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.svm import LinearSVC, SVC
+from sklearn.tree import DecisionTreeClassifier
+from src.features.custom_transformers import (
+    FeatureExtractorText,
+    FeatureExtractorOHE,
+    FeatureExtractorNumber,
+    CustomImputer
+)
+from src.features.sparse_union import SparseFeatureUnion
+from src.models.predict_model import load_model
+
+logger = logging.getLogger(__name__)
+
+
+def _save(out_dir, filename, array):
+    np.save(pj(out_dir, filename), array)
+    return filename
+
+
+def _scaler_arrays(name, scaler, out_dir):
+    arrays = {}
+    if scaler is None:
+        return arrays
+    if scaler.with_mean:
+        arrays['mean'] = _save(out_dir, f'{name}_mean.npy', scaler.mean_.astype(np.float64))
+    if scaler.with_std:
+        arrays['scale'] = _save(out_dir, f'{name}_scale.npy', scaler.scale_.astype(np.float64))
+    return arrays
+
+
+def _analyzer(vectorizer):
+    if (vectorizer.analyzer != 'word' or vectorizer.preprocessor is not None
+            or vectorizer.tokenizer is not None or vectorizer.input != 'content'):
+        raise ValueError(f'cannot export {type(vectorizer).__name__}: only the default word analyzer is supported')
+    stop_words = vectorizer.get_stop_words()
+    return {
+        'lowercase': vectorizer.lowercase,
+        'strip_accents': vectorizer.strip_accents,
+        'token_pattern': vectorizer.token_pattern,
+        'stop_words': sorted(stop_words) if stop_words else None,
+        'ngram_range': list(vectorizer.ngram_range)
+    }
+
+
+def export_block(name, transformer, out_dir):
+    """ Describes one fitted pipeline of the feature union as a block of
+        columns the exported predictors can rebuild, saving its arrays to `out_dir`.
+    """
+    steps = [step for _, step in transformer.steps] if isinstance(transformer, Pipeline) else [transformer]
+    extractor, steps = steps[0], steps[1:]
+    scaler = steps.pop() if steps and isinstance(steps[-1], StandardScaler) else None
+    if scaler is not None and scaler.with_mean and not isinstance(extractor, FeatureExtractorNumber):
+        raise ValueError(f'cannot export {name}: only the numeric columns can be centred')
+
+    if isinstance(extractor, FeatureExtractorText) and len(steps) == 1:
+        vectorizer = steps[0]
+        if isinstance(vectorizer, HashingVectorizer):
+            block = {
+                'type': 'hashing',
+                'n_features': vectorizer.n_features,
+                'alternate_sign': vectorizer.alternate_sign,
+                'norm': vectorizer.norm,
+                'dtype': np.dtype(vectorizer.dtype).name,
+                'arrays': {}
+            }
+        elif isinstance(vectorizer, CountVectorizer):
+            terms = sorted(vectorizer.vocabulary_, key=lambda term: term.encode('utf-8'))
+            # CountVectorizer output is integer counts, which the scaler makes float64
+            dtype = np.dtype(vectorizer.dtype)
+            block = {
+                'type': 'count',
+                'n_features': len(terms),
+                'dtype': dtype.name if dtype.kind == 'f' else 'float64',
+                'arrays': {
+                    'vocab': _save(out_dir, f'{name}_vocab.npy', np.array([t.encode('utf-8') for t in terms])),
+                    'columns': _save(out_dir, f'{name}_columns.npy',
+                                     np.array([vectorizer.vocabulary_[t] for t in terms], dtype=np.int64))
+                }
+            }
+        else:
+            raise ValueError(f'cannot export {name}: unsupported vectorizer {type(vectorizer).__name__}')
+        block['binary'] = vectorizer.binary
+        block['analyzer'] = _analyzer(vectorizer)
+    elif isinstance(extractor, FeatureExtractorOHE) and len(steps) == 1 and isinstance(steps[0], OneHotEncoder):
+        encoder = steps[0]
+        if any(c is not None for c in getattr(encoder, 'infrequent_categories_', [])):
+            raise ValueError(f'cannot export {name}: infrequent categories are not supported')
+        drop = None if encoder.drop_idx_ is None or encoder.drop_idx_[0] is None else int(encoder.drop_idx_[0])
+        categories = encoder.categories_[0].tolist()
+        block = {
+            'type': 'onehot',
+            'categories': categories,
+            'drop': drop,
+            'handle_unknown': encoder.handle_unknown,
+            'n_features': len(categories) - (drop is not None),
+            'dtype': np.dtype(encoder.dtype).name,
+            'binary': False,
+            'arrays': {}
+        }
+    elif isinstance(extractor, FeatureExtractorNumber) and all(isinstance(s, CustomImputer) for s in steps):
+        block = {
+            'type': 'number',
+            'impute': bool(steps),
+            'n_features': 1,
+            'dtype': 'float64',
+            'arrays': {}
+        }
+    else:
+        raise ValueError(f'cannot export {name}: unsupported steps {[type(s).__name__ for s in steps]}')
+
+    block['name'] = name
+    block['column'] = extractor.columns
+    block['arrays'].update(_scaler_arrays(name, scaler, out_dir))
+    return block
+
+
+def _classifier(clf):
+    """ Coefficients, intercepts and prediction rule of a linear classifier."""
+    if isinstance(clf, LogisticRegression):
+        ovr = clf.multi_class == 'ovr' or (clf.multi_class == 'auto' and (
+            len(clf.classes_) <= 2 or clf.solver == 'liblinear'))
+        return clf.coef_, clf.intercept_, 'linear', 'ovr' if ovr else 'softmax'
+    if isinstance(clf, SGDClassifier):
+        proba = 'ovr' if clf.loss in ('log', 'log_loss') else None
+        return clf.coef_, clf.intercept_, 'linear', proba
+    if isinstance(clf, LinearSVC):
+        return clf.coef_, clf.intercept_, 'linear', None
+    if isinstance(clf, SVC) and clf.kernel == 'linear':
+        coef = clf.coef_.toarray() if hasattr(clf.coef_, 'toarray') else clf.coef_
+        # one-vs-one votes between every pair of classes, as libsvm predicts
+        return coef, clf.intercept_, 'ovo' if len(clf.classes_) > 2 else 'linear', None
+    raise ValueError(f'cannot export {type(clf).__name__}: only linear classifiers are supported')
+
+
+def _split_model(model):
+    model = getattr(model, 'best_estimator_', model)
+    if not isinstance(model, Pipeline) or len(model.steps) != 2 or not isinstance(model.steps[0][1], FeatureUnion):
+        raise ValueError('expected a Pipeline of a feature union and a classifier')
+    return model.steps[0][1], model.steps[1][1]
+
+
+def export_union(union, out_dir):
+    """ Exports every pipeline of a fitted feature union as a block of columns.
+
+        Returns the blocks, the number of columns and the union's output dtype.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    weights = union.transformer_weights or {}
+    blocks, offset = [], 0
+    for name, transformer in union.transformer_list:
+        if transformer == 'drop':
+            continue
+        block = export_block(name, transformer, out_dir)
+        block['offset'] = offset
+        block['weight'] = weights.get(name)
+        offset += block['n_features']
+        blocks.append(block)
+    dtype = np.dtype(union.dtype).name if isinstance(union, SparseFeatureUnion) else None
+    return blocks, offset, dtype
+
+
+def _write_meta(out_dir, meta):
+    with open(pj(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def export_linear(model, out_dir):
+    """ Compiles a fitted Pipeline(featureunion, linear clf), or a search whose
+        best estimator is one, into `out_dir` for LinearPredictor.
+    """
+    union, clf = _split_model(model)
+    coef, intercept, kind, proba = _classifier(clf)
+    blocks, n_features, dtype = export_union(union, out_dir)
+    if n_features != coef.shape[1]:
+        raise ValueError(f'the feature union has {n_features} columns, the classifier {coef.shape[1]}')
+
+    _save(out_dir, 'coef.npy', np.ascontiguousarray(coef.T, dtype=np.float64))
+    _save(out_dir, 'intercept.npy', np.asarray(intercept, dtype=np.float64))
+    _write_meta(out_dir, {
+        'model': 'linear',
+        'classes': clf.classes_.tolist(),
+        'kind': kind,
+        'proba': proba,
+        'dtype': dtype,
+        'blocks': blocks
+    })
+    logger.info(f'exported {type(clf).__name__} with {n_features} features to {out_dir}')
+    return out_dir
+
+
+def _tree_proba(tree):
+    """ Per-node class probabilities of a tree, normalized as its predict_proba does."""
+    value = tree.tree_.value[:, 0, :].copy()
+    normalizer = value.sum(axis=1)[:, np.newaxis]
+    normalizer[normalizer == 0.0] = 1.0
+    value /= normalizer
+    return value
+
+
+def _scatter(value, tree_classes, classes):
+    """ Spreads the columns of a tree fitted on a subset of the classes over all of them."""
+    if len(tree_classes) == len(classes):
+        return value
+    out = np.zeros((len(value), len(classes)))
+    out[:, np.searchsorted(classes, tree_classes)] = value
+    return out
+
+
+def _ensemble(clf):
+    """ Trees of a fitted tree classifier with, for each, the columns its
+        features index (None for all of them) and its per-node values, plus
+        the prediction rule and the divisor of the summed values.
+    """
+    n_classes = len(clf.classes_)
+    if isinstance(clf, DecisionTreeClassifier):
+        # predict is the argmax of the raw (weighted count) values
+        return [clf], [None], [clf.tree_.value[:, 0, :]], 'tree', 1.0
+    if isinstance(clf, (RandomForestClassifier, ExtraTreesClassifier)):
+        values = [_tree_proba(tree) for tree in clf.estimators_]
+        return clf.estimators_, [None] * len(values), values, 'forest', float(len(values))
+    if isinstance(clf, BaggingClassifier) and all(isinstance(e, DecisionTreeClassifier) for e in clf.estimators_):
+        # the estimators are fitted on the encoded labels, possibly a subset of them
+        values = [_scatter(_tree_proba(tree), tree.classes_, np.arange(n_classes)) for tree in clf.estimators_]
+        return clf.estimators_, clf.estimators_features_, values, 'forest', float(len(values))
+    if isinstance(clf, AdaBoostClassifier) and all(isinstance(e, DecisionTreeClassifier) for e in clf.estimators_):
+        values = []
+        for tree, weight in zip(clf.estimators_, clf.estimator_weights_):
+            if clf.algorithm == 'SAMME.R':
+                # _samme_proba of every leaf
+                proba = np.clip(_tree_proba(tree), np.finfo(np.float64).eps, None)
+                log_proba = np.log(proba)
+                value = (n_classes - 1) * (log_proba - (1.0 / n_classes) * log_proba.sum(axis=1)[:, np.newaxis])
+                value = _scatter(value, tree.classes_, clf.classes_)
+            else:
+                # weighted vote for the class each leaf predicts
+                label = tree.classes_.take(np.argmax(tree.tree_.value[:, 0, :], axis=1))
+                value = (label[:, np.newaxis] == clf.classes_).astype(np.float64) * weight
+            values.append(value)
+        return clf.estimators_, [None] * len(values), values, clf.algorithm.lower(), float(clf.estimator_weights_.sum())
+    raise ValueError(f'cannot export {type(clf).__name__}: only decision trees and their forests, '
+                     'bagging and AdaBoost ensembles are supported')
+
+
+def _breadth_first(nodes):
+    """ Node ids of a tree in breadth-first order, each split's children side by side."""
+    order, level = [np.array([0])], np.array([0])
+    while level.size:
+        level = level[nodes.children_left[level] != -1]
+        level = np.column_stack([nodes.children_left[level], nodes.children_right[level]]).ravel()
+        order.append(level)
+    return np.concatenate(order)
+
+
+def export_trees(model, out_dir):
+    """ Compiles a fitted Pipeline(featureunion, tree clf), or a search whose best
+        estimator is one, into `out_dir` for TreeEnsemblePredictor.
+
+        The nodes of all the trees are flattened, breadth first, into global
+        arrays: the feature (as an index into the columns any tree splits on),
+        threshold and first child of every split, whose right child follows
+        it, and the index of every leaf into the leaf values.
+    """
+    union, clf = _split_model(model)
+    trees, features, values, kind, divisor = _ensemble(clf)
+    if any(tree.n_outputs_ != 1 for tree in trees):
+        raise ValueError('cannot export multi-output trees')
+    blocks, n_features, dtype = export_union(union, out_dir)
+    if n_features != clf.n_features_in_:
+        raise ValueError(f'the feature union has {n_features} columns, the classifier {clf.n_features_in_}')
+
+    feature, threshold, children, leaf, leaf_values, roots = [], [], [], [], [], []
+    n_nodes, n_leaves, max_depth = 0, 0, 0
+    for tree, columns, value in zip(trees, features, values):
+        nodes = tree.tree_
+        order = _breadth_first(nodes)
+        renumber = np.empty_like(order)
+        renumber[order] = np.arange(len(order))
+        is_leaf = nodes.children_left[order] == -1
+        columns = np.arange(n_features) if columns is None else np.asarray(columns)
+        feature.append(np.where(is_leaf, -1, columns[np.maximum(nodes.feature[order], 0)]))
+        threshold.append(nodes.threshold[order])
+        children.append(np.where(is_leaf, -1, renumber[nodes.children_left[order]] + n_nodes))
+        leaf.append(np.where(is_leaf, np.cumsum(is_leaf) - 1 + n_leaves, -1))
+        leaf_values.append(value[order][is_leaf])
+        roots.append(n_nodes)
+        n_nodes += nodes.node_count
+        n_leaves += is_leaf.sum()
+        max_depth = max(max_depth, nodes.max_depth)
+
+    feature = np.concatenate(feature)
+    # the predictor gathers only the columns some tree splits on
+    used = np.unique(feature[feature >= 0])
+    feature = np.where(feature >= 0, np.searchsorted(used, feature), 0)
+    _save(out_dir, 'trees_used.npy', used.astype(np.int64))
+    _save(out_dir, 'trees_feature.npy', feature.astype(np.int32))
+    _save(out_dir, 'trees_threshold.npy', np.concatenate(threshold).astype(np.float64))
+    _save(out_dir, 'trees_children.npy', np.concatenate(children).astype(np.int32))
+    _save(out_dir, 'trees_leaf.npy', np.concatenate(leaf).astype(np.int32))
+    _save(out_dir, 'trees_values.npy', np.concatenate(leaf_values).astype(np.float64))
+    _save(out_dir, 'trees_roots.npy', np.asarray(roots, dtype=np.int32))
+    _write_meta(out_dir, {
+        'model': 'trees',
+        'classes': clf.classes_.tolist(),
+        'kind': kind,
+        'divisor': divisor,
+        'max_depth': int(max_depth),
+        'dtype': dtype,
+        'blocks': blocks
+    })
+    logger.info(f'exported {type(clf).__name__} with {len(trees)} trees, {n_nodes} nodes '
+                f'and {len(used)} of {n_features} features to {out_dir}')
+    return out_dir
+
+
+def export(model, out_dir):
+    """ Exports a linear or tree model, whichever the pipeline's classifier is."""
+    _, clf = _split_model(model)
+    if isinstance(clf, (DecisionTreeClassifier, RandomForestClassifier, ExtraTreesClassifier,
+                        BaggingClassifier, AdaBoostClassifier)):
+        return export_trees(model, out_dir)
+    return export_linear(model, out_dir)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark(model, out_dir, data, n_rows=None, n_single=20):
+    """ Times the sklearn model's predict against the exported predictor's, on
+        the rows of `data` as one batch and on `n_single` rows one at a time,
+        and checks the two agree.
+    """
+    model = getattr(model, 'best_estimator_', model)
+    data = data if n_rows is None else data.head(n_rows)
+    predictor, load_s = _timed(load_model, out_dir)
+    expected, sklearn_s = _timed(model.predict, data)
+    predicted, export_s = _timed(predictor.predict, data)
+    mismatches = int((predicted != expected).sum())
+    singles = [data.iloc[[i]] for i in range(min(n_single, len(data)))]
+    sklearn_row_s = min(_timed(model.predict, row)[1] for row in singles)
+    export_row_s = min(_timed(predictor.predict, row)[1] for row in singles)
+    logger.info(f'{len(data)} rows: model.predict {sklearn_s:.3f}s, exported predict {export_s:.3f}s '
+                f'({sklearn_s / export_s:.1f}x), {mismatches} mismatches; one row: '
+                f'{sklearn_row_s * 1000:.1f}ms vs {export_row_s * 1000:.1f}ms '
+                f'({sklearn_row_s / export_row_s:.1f}x); load {load_s * 1000:.1f}ms')
+    return {'rows': len(data), 'sklearn_s': sklearn_s, 'export_s': export_s, 'mismatches': mismatches,
+            'sklearn_row_s': sklearn_row_s, 'export_row_s': export_row_s, 'load_s': load_s}
+
+
+@click.command()
+@click.option('--model-path', 'model_path', required=True, help='A searchcv or pipeline saved by train_model.')
+@click.option('--output-dir', 'output_dir', required=True)
+@click.option('--benchmark-data', 'benchmark_data', default=None,
+              help='A processed data.pkl to time the export against model.predict on.')
+@click.option('--benchmark-rows', 'benchmark_rows', type=int, default=None)
+def main(model_path, output_dir, benchmark_data, benchmark_rows):
+    """ Exports a linear or tree model for the numpy-only predictors."""
+    model = joblib.load(model_path)
+    export(model, output_dir)
+    if benchmark_data is not None:
+        benchmark(model, output_dir, pd.read_pickle(benchmark_data), benchmark_rows)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
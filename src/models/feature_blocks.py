@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+""" Feature assembly for the models exported by export_model.py.
+
+    Rebuilds the columns of a fitted feature union from the arrays export_model
+    saved, with numpy only, in the same order and dtype as the union.
+"""
+import json
+import re
+import unicodedata
+from os.path import join as pj
+import numpy as np
+
+# rows whose features are assembled at once, which bounds the predictors' memory
+BATCH_ROWS = 10000
+
+
+def murmurhash3_32(data, seed=0):
+    """ Signed 32-bit MurmurHash3 (x86) of `data` bytes, as sklearn's FeatureHasher computes it."""
+    c1, c2, mask = 0xcc9e2d51, 0x1b873593, 0xffffffff
+    h = seed & mask
+    n_blocks = len(data) // 4
+    for i in range(n_blocks):
+        k = int.from_bytes(data[4 * i:4 * i + 4], 'little')
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        h ^= (k * c2) & mask
+        h = ((h << 13) | (h >> 19)) & mask
+        h = (h * 5 + 0xe6546b64) & mask
+    tail = data[4 * n_blocks:]
+    k = 0
+    if len(tail) >= 3:
+        k ^= tail[2] << 16
+    if len(tail) >= 2:
+        k ^= tail[1] << 8
+    if len(tail) >= 1:
+        k ^= tail[0]
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        h ^= (k * c2) & mask
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & mask
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & mask
+    h ^= h >> 16
+    return h - (1 << 32) if h & 0x80000000 else h
+
+
+def _strip_accents_unicode(s):
+    try:
+        s.encode('ASCII', errors='strict')
+        return s
+    except UnicodeEncodeError:
+        normalized = unicodedata.normalize('NFKD', s)
+        return ''.join([c for c in normalized if not unicodedata.combining(c)])
+
+
+def _strip_accents_ascii(s):
+    return unicodedata.normalize('NFKD', s).encode('ASCII', 'ignore').decode('ASCII')
+
+
+class TextAnalyzer:
+    """ sklearn's word analyzer: preprocessing, tokenization, stop words and n-grams."""
+    def __init__(self, lowercase, strip_accents, token_pattern, stop_words, ngram_range):
+        self.lowercase = lowercase
+        self.strip_accents = {'unicode': _strip_accents_unicode, 'ascii': _strip_accents_ascii}.get(strip_accents)
+        self.token_pattern = re.compile(token_pattern)
+        self.stop_words = frozenset(stop_words) if stop_words else None
+        self.min_n, self.max_n = ngram_range
+
+    def __call__(self, doc):
+        if not isinstance(doc, str):
+            raise ValueError(f'{doc!r} is an invalid document, expected a string')
+        if self.lowercase:
+            doc = doc.lower()
+        if self.strip_accents is not None:
+            doc = self.strip_accents(doc)
+        tokens = self.token_pattern.findall(doc)
+        if self.stop_words is not None:
+            tokens = [w for w in tokens if w not in self.stop_words]
+        if self.max_n == 1:
+            return tokens
+        min_n = self.min_n
+        ngrams = []
+        if min_n == 1:
+            ngrams = list(tokens)
+            min_n += 1
+        for n in range(min_n, min(self.max_n + 1, len(tokens) + 1)):
+            for i in range(len(tokens) - n + 1):
+                ngrams.append(' '.join(tokens[i:i + n]))
+        return ngrams
+
+
+def batches(rows, batch_rows=BATCH_ROWS):
+    """ Consecutive slices of at most `batch_rows` of a DataFrame or list of dicts."""
+    for start in range(0, len(rows), batch_rows):
+        yield rows.iloc[start:start + batch_rows] if hasattr(rows, 'iloc') else rows[start:start + batch_rows]
+
+
+def _column(rows, name):
+    if hasattr(rows, 'columns'):
+        return rows[name].tolist()
+    return [row.get(name) for row in rows]
+
+
+class FeatureBlocks:
+    """ The feature union of an export directory, loaded from its meta.json
+        with every array memory-mapped.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(pj(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.blocks = []
+        for block in self.meta['blocks']:
+            arrays = {name: np.load(pj(path, filename), mmap_mode='r')
+                      for name, filename in block.get('arrays', {}).items()}
+            analyzer = TextAnalyzer(**block['analyzer']) if 'analyzer' in block else None
+            self.blocks.append((block, arrays, analyzer))
+        self.n_features = sum(block['n_features'] for block in self.meta['blocks'])
+
+    def _text_entries(self, block, arrays, analyzer, docs):
+        rows, terms = [], []
+        for i, doc in enumerate(docs):
+            ngrams = analyzer(doc)
+            rows.extend([i] * len(ngrams))
+            terms.extend(ngrams)
+        rows = np.asarray(rows, dtype=np.int64)
+        if block['type'] == 'hashing':
+            n_features = block['n_features']
+            hashes = np.array([murmurhash3_32(term.encode('utf-8')) for term in terms], dtype=np.int64)
+            cols = np.where(hashes == -2 ** 31, (2 ** 31 - 1 - (n_features - 1)) % n_features,
+                            np.abs(hashes) % n_features)
+            values = np.where(hashes < 0, -1.0, 1.0) if block['alternate_sign'] else np.ones(len(hashes))
+        else:
+            vocab = arrays['vocab']
+            encoded = [term.encode('utf-8') for term in terms]
+            queries = np.array(encoded) if encoded else np.zeros(0, dtype=vocab.dtype)
+            position = np.searchsorted(vocab, queries)
+            found = position < len(vocab)
+            found[found] = vocab[position[found]] == queries[found]
+            rows, cols, values = rows[found], arrays['columns'][position[found]], np.ones(found.sum())
+
+        # one entry per (row, column), counts summed as the vectorizers do
+        n_cols = block['n_features']
+        code, inverse = np.unique(rows * n_cols + cols, return_inverse=True)
+        counts = np.bincount(inverse, weights=values, minlength=len(code))
+        rows, cols = code // n_cols, code % n_cols
+        values = counts.astype(block['dtype'])
+        if block['binary']:
+            values = np.ones_like(values)
+        if block.get('norm') is not None:
+            values = self._normalize(rows, values, block['norm'], len(docs))
+        return rows, cols, values
+
+    @staticmethod
+    def _normalize(rows, values, norm, n_rows):
+        power = 1 if norm == 'l1' else 2
+        norms = np.bincount(rows, weights=np.abs(values) ** power, minlength=n_rows)
+        norms = norms if norm == 'l1' else np.sqrt(norms)
+        norms[norms == 0.0] = 1.0
+        return (values / norms[rows]).astype(values.dtype)
+
+    def _onehot_entries(self, block, values):
+        categories = {c: i for i, c in enumerate(block['categories'])}
+        rows, cols = [], []
+        for i, value in enumerate(values):
+            index = categories.get(value)
+            if index is None:
+                if block['handle_unknown'] == 'error':
+                    raise ValueError(f'unknown category {value!r} in column {block["column"]}')
+                continue
+            if index == block['drop']:
+                continue
+            rows.append(i)
+            cols.append(index - (block['drop'] is not None and index > block['drop']))
+        return (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64),
+                np.ones(len(rows), dtype=block['dtype']))
+
+    def _block_entries(self, block, arrays, analyzer, rows):
+        values = _column(rows, block['column'])
+        if block['type'] in ('count', 'hashing'):
+            rows, cols, values = self._text_entries(block, arrays, analyzer, values)
+        elif block['type'] == 'onehot':
+            rows, cols, values = self._onehot_entries(block, values)
+        else:
+            values = np.asarray(values, dtype=np.float64)
+            if block['impute']:
+                values = np.where(np.isnan(values), 0.0, values)
+            if 'mean' in arrays:
+                values = values - arrays['mean'][0]
+            if 'scale' in arrays:
+                values = values / arrays['scale'][0]
+            rows, cols = np.flatnonzero(values != 0), np.zeros((values != 0).sum(), dtype=np.int64)
+            values = values[rows]
+
+        if block['type'] != 'number' and 'scale' in arrays:
+            # StandardScaler scales sparse input by the reciprocal
+            values = (values.astype(np.float64) * (1 / arrays['scale'])[cols]).astype(values.dtype)
+        if block['weight'] is not None:
+            values = values * block['weight']
+        return rows, cols + block['offset'], values
+
+    def entries(self, rows):
+        """ Non-zero (row, column, value) entries of the union's output for
+            `rows`, sorted by row then column, with values in the union's dtype
+            (returned as float64).
+        """
+        entries = [self._block_entries(block, arrays, analyzer, rows) for block, arrays, analyzer in self.blocks]
+        row = np.concatenate([e[0] for e in entries])
+        col = np.concatenate([e[1] for e in entries])
+        dtype = self.meta['dtype']
+        value = np.concatenate([e[2].astype(dtype or e[2].dtype) for e in entries]).astype(np.float64)
+        order = np.lexsort((col, row))
+        return row[order], col[order], value[order]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import logging
+import numpy as np
+from joblib import Memory
+from sklearn.model_selection import GridSearchCV, ParameterGrid
+
+logger = logging.getLogger(__name__)
+
+
+def feature_memory(cache_dir):
+    """ joblib store for Pipeline(memory=...): each fitted feature union is
+        cached on disk keyed by its parameters and the fold it was fitted on.
+    """
+    return Memory(location=cache_dir, verbose=0)
+
+
+def trim_memory(memory, bytes_limit):
+    """ Evicts the least recently used cache entries beyond `bytes_limit`."""
+    try:
+        memory.reduce_size(bytes_limit=bytes_limit)
+    except TypeError:
+        # joblib < 1.3 takes the limit on the Memory itself
+        memory.bytes_limit = bytes_limit
+        memory.reduce_size()
+
+
+class CachedGridSearchCV(GridSearchCV):
+    """ GridSearchCV for a Pipeline with a feature cache (`memory`).
+
+        ParameterGrid varies the vectorizer parameters fastest, so the cache
+        would have to hold every featurization at once to be reused. Here the
+        candidates are evaluated in groups sharing the same non-classifier
+        parameters: the feature union is fitted once per fold for a group,
+        every classifier setting in it reuses that output, and the cache is
+        trimmed to `bytes_limit` (least recently used first) as each group
+        finishes, while the next group is being warmed.
+    """
+    def __init__(self, estimator, param_grid, *, bytes_limit=None, scoring=None, n_jobs=None,
+                 refit=True, cv=None, verbose=0, pre_dispatch='2*n_jobs', error_score=np.nan,
+                 return_train_score=False):
+        super().__init__(estimator, param_grid, scoring=scoring, n_jobs=n_jobs, refit=refit, cv=cv,
+                         verbose=verbose, pre_dispatch=pre_dispatch, error_score=error_score,
+                         return_train_score=return_train_score)
+        self.bytes_limit = bytes_limit
+
+    def _run_search(self, evaluate_candidates):
+        clf_prefix = self.estimator.steps[-1][0] + '__'
+        groups = {}
+        for params in ParameterGrid(self.param_grid):
+            key = repr(sorted((k, v) for k, v in params.items() if not k.startswith(clf_prefix)))
+            groups.setdefault(key, []).append(params)
+
+        logger.info(f'{len(groups)} featurizations, '
+                    f'{sum(len(g) for g in groups.values()) // len(groups)} classifier settings each')
+        # a group's first candidate fills the cache for every fold before the rest
+        # of the group is dispatched, so parallel workers don't race to fit it; it
+        # runs alongside the previous group's remainder to keep the workers busy
+        groups = list(groups.values())
+        evaluate_candidates(groups[0][:1])
+        for i, candidates in enumerate(groups):
+            batch = candidates[1:] + (groups[i + 1][:1] if i + 1 < len(groups) else [])
+            if batch:
+                evaluate_candidates(batch)
+            memory = self.estimator.memory
+            if isinstance(memory, Memory) and self.bytes_limit is not None:
+                trim_memory(memory, self.bytes_limit)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Predictor for linear models exported by export_model.py.
+
+    Only needs numpy: the vocabularies, scaler factors and coefficients are
+    memory-mapped from the export directory, so a process starts in
+    milliseconds and every worker on a machine shares the same pages.
+"""
+from os.path import join as pj
+import numpy as np
+from src.models.feature_blocks import BATCH_ROWS, FeatureBlocks, batches
+
+
+class LinearPredictor:
+    """ Pure numpy equivalent of an exported Pipeline(featureunion, linear clf).
+
+        Rows are a DataFrame or a list of dicts with the dataset's columns.
+        Features are assembled in the feature union's column order and dotted
+        with the coefficients in the same summation order as scipy's sparse
+        product, so decisions and predictions match the sklearn pipeline.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.features = FeatureBlocks(path)
+        self.meta = self.features.meta
+        self.classes_ = np.array(self.meta['classes'])
+        self.coef = np.load(pj(path, 'coef.npy'), mmap_mode='r')
+        self.intercept = np.load(pj(path, 'intercept.npy'), mmap_mode='r')
+
+    def decision_function(self, rows):
+        if len(rows) > BATCH_ROWS:
+            return np.concatenate([self.decision_function(batch) for batch in batches(rows, BATCH_ROWS)])
+        n_rows = len(rows)
+        row, col, value = self.features.entries(rows)
+
+        n_outputs = self.coef.shape[1]
+        decision = np.empty((n_rows, n_outputs))
+        for k in range(n_outputs):
+            # accumulated row by row in column order, like a CSR product
+            decision[:, k] = np.bincount(row, weights=value * self.coef[col, k], minlength=n_rows)
+        decision += self.intercept
+        return decision.ravel() if n_outputs == 1 else decision
+
+    def predict(self, rows):
+        decision = self.decision_function(rows)
+        if self.meta['kind'] == 'ovo':
+            n_classes = len(self.classes_)
+            votes = np.zeros((len(decision), n_classes), dtype=np.int64)
+            pairs = [(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)]
+            decision = decision.reshape(len(decision), -1)
+            for p, (i, j) in enumerate(pairs):
+                votes[:, i] += decision[:, p] > 0
+                votes[:, j] += decision[:, p] <= 0
+            return self.classes_[votes.argmax(axis=1)]
+        if decision.ndim == 1:
+            return self.classes_[(decision > 0).astype(int)]
+        return self.classes_[decision.argmax(axis=1)]
+
+    @property
+    def predict_proba(self):
+        if self.meta['proba'] is None:
+            raise AttributeError('the exported classifier has no predict_proba')
+        return self._predict_proba
+
+    def _predict_proba(self, rows):
+        decision = self.decision_function(rows)
+        if self.meta['proba'] == 'softmax':
+            if decision.ndim == 1:
+                decision = np.c_[-decision, decision]
+            decision = decision - decision.max(axis=1, keepdims=True)
+            np.exp(decision, out=decision)
+            return decision / decision.sum(axis=1, keepdims=True)
+        # one-vs-rest logistic
+        proba = 1 / (1 + np.exp(-decision))
+        if proba.ndim == 1:
+            return np.vstack([1 - proba, proba]).T
+        return proba / proba.sum(axis=1).reshape((proba.shape[0], -1))
@@ -7,9 +7,28 @@ from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
 from sklearn.svm import SVC
 import numpy as np
+from src.models.approximate_knn import ApproximateKNeighborsClassifier
 
+# feature union steps holding the activities, objects and name vectorizers
+TEXT_PIPELINES = ['pipeline-1', 'pipeline-2', 'pipeline-4']
 
-def parameters():
+
+def text_grid(vectorizer='countvectorizer', max_features=True):
+    """ Grid over the text vectorizers. The hashing vectorizer has no
+        vocabulary to cap, so its hash width is searched in place of max_features.
+    """
+    grid = {}
+    for pipeline in TEXT_PIPELINES:
+        prefix = f'featureunion__{pipeline}__{vectorizer}__'
+        if max_features and vectorizer == 'hashingvectorizer':
+            grid[prefix + 'n_features'] = [2 ** 16, 2 ** 18]
+        elif max_features:
+            grid[prefix + 'max_features'] = [1000, 5000]
+        grid[prefix + 'ngram_range'] = [(1,3), (2,2)]
+    return grid
+
+
+def parameters(vectorizer='countvectorizer'):
 
     model_params_dict = {}
     kwargs_dict = {}
@@ -17,12 +36,7 @@ def parameters():
     model_params_dict['logit'] = {
         'estimator': LogisticRegression(),
         'param_grid': {
-                'featureunion__pipeline-1__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-1__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-2__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-2__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-4__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-4__countvectorizer__ngram_range': [(1,3), (2,2)],
+                **text_grid(vectorizer),
                 'clf__penalty': ['l1','l2'],
                 'clf__solver': ['saga'],                                      
                 'clf__C': np.logspace(-1, 4, 10)
@@ -32,52 +46,46 @@ def parameters():
     model_params_dict['knn'] = {
         'estimator': KNeighborsClassifier(),
         'param_grid': {
-                'featureunion__pipeline-1__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-1__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-2__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-2__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-4__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-4__countvectorizer__ngram_range': [(1,3), (2,2)],
+                **text_grid(vectorizer),
                 'clf__n_neighbors': list(range(1, 50, 4))
         }
     }
 
+    # knn over an approximate index of SVD-reduced rows; n_probe (recall against
+    # latency) is left out of the grid, which would always pick the most probes
+    model_params_dict['knn_ann'] = {
+        'estimator': ApproximateKNeighborsClassifier(random_state=1),
+        'param_grid': {
+                **text_grid(vectorizer),
+                'clf__n_neighbors': list(range(1, 50, 4)),
+                'clf__n_components': [100, 300]
+        }
+    }
+
     model_params_dict['cart'] = {
         'estimator': DecisionTreeClassifier(),
         'param_grid': {
-                'featureunion__pipeline-1__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-1__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-2__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-2__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-4__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-4__countvectorizer__ngram_range': [(1,3), (2,2)],
+                **text_grid(vectorizer),
                 'clf__min_samples_leaf': np.linspace(0.1, 0.5, 5, endpoint=True),
                 'clf__min_samples_split': np.linspace(0.1, 1.0, 10, endpoint=True),
-                'clf__max_depth': np.linspace(1, 32, 32, endpoint=True)
+                'clf__max_depth': list(range(1, 33))
             }
     }
 
     model_params_dict['cart_bag'] = {
         'estimator': RandomForestClassifier(),
         'param_grid': {
-                'featureunion__pipeline-1__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-2__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-4__countvectorizer__ngram_range': [(1,3), (2,2)],
+                **text_grid(vectorizer, max_features=False),
                 'clf__n_estimators': [10, 500, 500, 1000, 5000],
-                'clf__max_features': ['auto', 'sqrt', 'log2'],
-                'clf__max_samples': [0.1, 0.5, 1.1]
+                'clf__max_features': ['sqrt', 'log2'],
+                'clf__max_samples': [0.1, 0.5]
             }
     }
 
     model_params_dict['cart_boost'] = {
         'estimator': AdaBoostClassifier(),
         'param_grid': {
-                'featureunion__pipeline-1__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-1__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-2__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-2__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-4__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-4__countvectorizer__ngram_range': [(1,3), (2,2)],
+                **text_grid(vectorizer),
                 'clf__base_estimator': [DecisionTreeClassifier(max_depth=3)],
                 'clf__n_estimators': [10, 500, 500, 1000, 5000]
             }
@@ -86,12 +94,7 @@ def parameters():
     model_params_dict['svm'] = {
         'estimator': SVC(),
         'param_grid': {
-                'featureunion__pipeline-1__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-1__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-2__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-2__countvectorizer__ngram_range': [(1,3), (2,2)],
-                'featureunion__pipeline-4__countvectorizer__max_features': [1000, 5000],
-                'featureunion__pipeline-4__countvectorizer__ngram_range': [(1,3), (2,2)],
+                **text_grid(vectorizer),
                 'clf__C': np.logspace(-2, 2, 11),
                 'clf__kernel': ['linear', 'poly', 'rbf', 'sigmoid'],
                 'clf__gamma': ['scale'],
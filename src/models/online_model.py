@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+""" Incremental training for the monthly register drops.
+
+    A fixed-width featurizer (hashed text, one-hot encoders that ignore unseen
+    categories, scaled numbers) is fitted once and then frozen, so an
+    SGDClassifier can keep learning from new or changed charities with
+    partial_fit instead of a grid search over the full dataset. The dataset
+    is read in batches, memory-mapped from the feather format, rather than
+    held whole.
+"""
+import json
+import logging
+import os
+import pickle as pkl
+import time
+from datetime import datetime
+from os.path import join as pj
+from pathlib import Path
+import click
+import numpy as np
+import pandas as pd
+from dotenv import find_dotenv, load_dotenv
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.utils import class_weight
+from src.data.incremental import regno_hashes
+from src.features.build_features import make_text_vectorizer
+from src.features.custom_transformers import (
+    FeatureExtractorText,
+    FeatureExtractorOHE,
+    FeatureExtractorNumber,
+    CustomImputer
+)
+from src.features.sparse_union import make_sparse_union
+from src.features.tokens import TEXT_COLUMNS
+from src.models.artifact import load_artifact, load_metadata, save_artifact
+
+logger = logging.getLogger(__name__)
+
+CATEGORICAL_COLUMNS = ['EER', 'RU']
+NUMBER_COLUMNS = ['income_3y_mean', 'Trustees']
+
+
+def make_online_union(n_features=2 ** 16):
+    """ Feature union whose width never changes after the first fit: hashed
+        text, one-hot categories (unseen ones are ignored) and scaled numbers.
+    """
+    pipes = []
+    for column in TEXT_COLUMNS:
+        vectorizer = make_text_vectorizer('hashing', n_features)
+        # stateless scaling of the counts, which a frozen StandardScaler can't give new tokens
+        vectorizer.set_params(norm='l2', lowercase=True, strip_accents='unicode')
+        pipes.append(make_pipeline(FeatureExtractorText(column), vectorizer))
+    for column in CATEGORICAL_COLUMNS:
+        pipes.append(make_pipeline(FeatureExtractorOHE(column), OneHotEncoder(handle_unknown='ignore')))
+    for column in NUMBER_COLUMNS:
+        pipes.append(make_pipeline(FeatureExtractorNumber(column), CustomImputer(), StandardScaler()))
+    return make_sparse_union(*pipes)
+
+
+def make_online_model(classes, y, n_features=2 ** 16, random_state=1):
+    """ Pipeline of the online feature union and an averaged log-loss SGD,
+        with the balanced class weights of `y` fixed up front (partial_fit
+        can't compute them).
+    """
+    weights = class_weight.compute_class_weight(class_weight='balanced', classes=classes, y=y)
+    clf = SGDClassifier(loss='log_loss', alpha=1e-5, average=True, random_state=random_state,
+                        class_weight=dict(zip(classes, weights)))
+    return Pipeline([('featureunion', make_online_union(n_features)), ('clf', clf)])
+
+
+def holdout_mask(data, test_size):
+    """ A holdout of about `test_size` percent of the charities chosen by a
+        hash of their regno, so the same charities are held out every month.
+    """
+    bucket = pd.util.hash_array(data['regno'].astype(str).to_numpy()) % 100
+    return bucket < test_size
+
+
+def partial_fit_chunks(model, X, y, chunksize, epochs, classes, random_state=1):
+    """ Streams (X, y) through the frozen feature union in shuffled chunks
+        of `chunksize` rows and updates the classifier with partial_fit.
+    """
+    union, clf = model.steps[0][1], model.steps[1][1]
+    rng = np.random.RandomState(random_state)
+    for epoch in range(epochs):
+        order = rng.permutation(len(X))
+        for start in range(0, len(X), chunksize):
+            rows = order[start:start + chunksize]
+            clf.partial_fit(union.transform(X.iloc[rows]), y.iloc[rows].to_numpy(), classes=classes)
+        logger.info(f'epoch {epoch + 1}/{epochs}: {len(X)} rows')
+    return model
+
+
+def read_batches(processed_dir, data_format, chunksize):
+    """ The processed dataset as batches of up to `chunksize` rows, converted
+        to frames by `frames` one at a time. The feather file is memory-mapped,
+        so only the batch being converted is read into memory; a pickle can't
+        be read in part and is loaded whole.
+    """
+    if data_format == 'feather':
+        import pyarrow.feather as feather
+
+        table = feather.read_table(pj(processed_dir, 'data.feather'), memory_map=True)
+        return table.to_batches(max_chunksize=chunksize)
+    with open(pj(processed_dir, 'data.pkl'), 'rb') as f:
+        data = pkl.load(f)
+    return [data.iloc[start:start + chunksize] for start in range(0, len(data), chunksize)]
+
+
+def frames(batches, order=None):
+    """ Each of `batches` (in `order` if given) as a DataFrame."""
+    for i in range(len(batches)) if order is None else order:
+        batch = batches[i]
+        if isinstance(batch, pd.DataFrame):
+            yield batch
+            continue
+        frame = batch.to_pandas()
+        # dictionary-encoded in the feather file
+        frame['icnpo'] = frame['icnpo'].astype(object)
+        yield frame
+
+
+def fit_online(batches, sample, y, test_size, epochs=5, n_features=2 ** 16, random_state=1):
+    """ Trains an online model from scratch: the class weights come from all
+        the training labels `y` and the featurizer is fitted once on `sample`
+        of the training rows; the classifier then takes partial_fit over the
+        training rows of every batch, in a new order each epoch.
+    """
+    classes = np.unique(y)
+    model = make_online_model(classes, y, n_features, random_state)
+    union, clf = model.steps[0][1], model.steps[1][1]
+    union.fit(sample.drop(columns='icnpo'))
+    rng = np.random.RandomState(random_state)
+    for epoch in range(epochs):
+        for frame in frames(batches, rng.permutation(len(batches))):
+            X = frame[~holdout_mask(frame, test_size)]
+            X = X.iloc[rng.permutation(len(X))]
+            clf.partial_fit(union.transform(X), X['icnpo'].to_numpy(), classes=classes)
+        logger.info(f'epoch {epoch + 1}/{epochs}: {len(y)} rows')
+    return model
+
+
+def changed_rows(data, hashes, previous_hashes):
+    """ Mask of the rows of charities that are new or changed since the
+        regno hashes of the previous training.
+    """
+    previous, current = previous_hashes.align(hashes)
+    changed = previous.index[previous.ne(current).values & current.notna().values]
+    return data['regno'].isin(changed).to_numpy()
+
+
+def accuracy(model, batches, test_size):
+    """ Accuracy of `model` on the holdout rows of every batch."""
+    correct = n_rows = 0
+    for frame in frames(batches):
+        X = frame[holdout_mask(frame, test_size)]
+        if len(X):
+            correct += int((model.predict(X) == X['icnpo'].to_numpy()).sum())
+            n_rows += len(X)
+    return correct / n_rows if n_rows else float('nan')
+
+
+@click.command()
+@click.option('--model-dir', 'model_dir', required=True,
+              help='Directory of the online model; created by the first run, updated by the next ones.')
+@click.option('--data-format', 'data_format', default='pickle', type=click.Choice(['pickle', 'feather']))
+@click.option('--test-size', 'test_size', default=20, type=click.IntRange(1, 99),
+              help='Percent of charities held out, chosen by regno so they stay the same across updates.')
+@click.option('--chunksize', 'chunksize', default=10000, type=int,
+              help='Rows read and learned from at a time.')
+@click.option('--epochs', 'epochs', default=5, type=int, help='Passes over the new or changed rows.')
+@click.option('--hash-features', 'hash_features', default=2 ** 16, type=int)
+@click.option('--fit-rows', 'fit_rows', default=50000, type=int,
+              help='Training rows sampled to fit the featurizer (the scaling and categories) on.')
+@click.option('--compare-full', 'compare_full', is_flag=True, default=False,
+              help='Also retrain from scratch on the whole dataset and report the accuracy drift.')
+@click.option('--max-drift', 'max_drift', default=0.02, type=float,
+              help='Warn when the updated model trails the full retrain by more than this accuracy.')
+def main(model_dir, data_format, test_size, chunksize, epochs, hash_features, fit_rows, compare_full,
+         max_drift):
+    """ Trains the online model, or updates it with the charities that are new
+        or changed in the processed dataset since its last run.
+    """
+    processed_dir = pj(project_dir, 'data', os.environ.get('PROCESSED_DIR'))
+    batches = read_batches(processed_dir, data_format, chunksize)
+    model_path = pj(model_dir, 'model.jlib')
+    hashes_path = pj(model_dir, 'regno_hashes.pkl')
+    update = os.path.exists(model_path)
+    previous_hashes = pd.read_pickle(hashes_path) if update else None
+
+    # one pass for the training rows' regno hashes and labels, and a sample to
+    # fit the featurizer on (first run) or the new or changed rows (update)
+    start = time.perf_counter()
+    hashes, labels, rows = [], [], []
+    fraction = min(1, fit_rows / max(sum(len(batch) for batch in batches), 1))
+    for frame in frames(batches):
+        X = frame[~holdout_mask(frame, test_size)]
+        # hashed with the labels, so relabelled charities count as changed; the row
+        # position finalise() adds shifts whenever a charity is added or removed
+        hashes.append(regno_hashes(X.drop(columns=['index'], errors='ignore')))
+        labels.append(X['icnpo'])
+        if update:
+            rows.append(X[changed_rows(X, hashes[-1], previous_hashes)])
+        else:
+            rows.append(X.sample(frac=fraction, random_state=len(rows)))
+    hashes, y_train, rows = pd.concat(hashes), pd.concat(labels), pd.concat(rows)
+
+    if update:
+        model = load_artifact(model_path, mmap_mode=None)
+        meta = load_metadata(model_path)
+        y_changed = rows.pop('icnpo')
+        classes = model.steps[1][1].classes_
+        # partial_fit can't add classes; those rows wait for a full retrain
+        known = y_changed.isin(classes).to_numpy()
+        if (~known).any():
+            logger.warning(f'skipping {(~known).sum()} rows of classes the model has not seen')
+            # their previous hashes are kept (new charities get none), so they
+            # still count as changed next time
+            skipped = pd.Index(rows['regno'][~known].unique())
+            hashes = hashes.drop(skipped)
+            kept = skipped.intersection(previous_hashes.index)
+            hashes = pd.concat([hashes, previous_hashes[kept]])
+        logger.info(f'updating with {known.sum()} new or changed of {len(y_train)} charities')
+        partial_fit_chunks(model, rows[known], y_changed[known], chunksize, epochs, classes)
+        n_rows, mode = int(known.sum()), 'update'
+    else:
+        os.makedirs(model_dir, exist_ok=True)
+        model = fit_online(batches, rows, y_train, test_size, epochs, hash_features)
+        meta = {'created': datetime.now().isoformat(), 'hash_features': hash_features, 'updates': []}
+        n_rows, mode = len(y_train), 'full'
+    seconds = time.perf_counter() - start
+
+    report = {
+        'date': datetime.now().isoformat(),
+        'mode': mode,
+        'rows': n_rows,
+        'seconds': seconds,
+        'accuracy': accuracy(model, batches, test_size)
+    }
+    if compare_full and mode == 'update':
+        start = time.perf_counter()
+        sample = pd.concat([frame[~holdout_mask(frame, test_size)].sample(frac=fraction, random_state=i)
+                            for i, frame in enumerate(frames(batches))])
+        full = fit_online(batches, sample, y_train, test_size, epochs, meta['hash_features'])
+        report['full_seconds'] = time.perf_counter() - start
+        report['full_accuracy'] = accuracy(full, batches, test_size)
+        report['drift'] = report['full_accuracy'] - report['accuracy']
+        if report['drift'] > max_drift:
+            logger.warning(f'the updated model trails a full retrain by {report["drift"]:.4f} accuracy; '
+                           'consider retraining from scratch')
+    logger.info(f'{mode}: {n_rows} rows in {seconds:.1f}s, holdout accuracy {report["accuracy"]:.4f}'
+                + (f', full retrain {report["full_accuracy"]:.4f} in {report["full_seconds"]:.1f}s'
+                   if 'full_accuracy' in report else ''))
+
+    meta['updates'].append(report)
+    save_artifact(model, meta, pj(model_dir, 'model'))
+    hashes.to_pickle(hashes_path)
+    with open(pj(model_dir, f'drift_report_{datetime.now().strftime("%Y_%m_%d_%H_%M")}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import find_dotenv, load_dotenv
+import click
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from src.models.predict_model import load_model
+
+logger = logging.getLogger(__name__)
+
+_model = None
+_index = None
+
+
+def _init_worker(model_path, model=None, index=None):
+    # each worker process loads the model (and index) once and reuses it for every chunk
+    global _model, _index
+    load_dotenv(find_dotenv())
+    _model = model if model is not None else load_model(model_path)
+    _index = index
+
+
+def predict_chunk(chunk, model=None, index=None):
+    """ Predicts a chunk of charities in one vectorized call, returning the
+        predictions and, where the model supports it, class probabilities.
+
+        With a NearDuplicateIndex, charities with an already classified
+        near-duplicate take its class (source 'index', no probabilities) and
+        only the others go through the model.
+    """
+    model = model if model is not None else _model
+    # a fitted search predicts through its best estimator, so featurize through that
+    model = getattr(model, 'best_estimator_', model)
+    index = index if index is not None else _index
+    result = pd.DataFrame(index=chunk.index)
+    if 'regno' in chunk.columns:
+        result['regno'] = chunk['regno'].values
+    clf = model.steps[-1][1] if isinstance(model, Pipeline) else model
+    pending = np.ones(len(chunk), dtype=bool)
+    if index is not None:
+        labels = index.lookup(chunk)
+        pending = labels.isna().values
+        result['prediction'] = labels.values
+    proba = None
+    if pending.any():
+        # featurize once and share the matrix between predict and predict_proba
+        X = model[:-1].transform(chunk[pending]) if isinstance(model, Pipeline) else chunk[pending]
+        result.loc[pending, 'prediction'] = clf.predict(X)
+        if hasattr(clf, 'predict_proba'):
+            proba = clf.predict_proba(X)
+    if hasattr(clf, 'predict_proba'):
+        # every chunk has the same columns, answered from the index or not
+        for i, label in enumerate(clf.classes_):
+            result[f'proba_{label}'] = np.nan
+            if proba is not None:
+                result.loc[pending, f'proba_{label}'] = proba[:, i]
+    if index is not None:
+        result['source'] = np.where(pending, 'model', 'index')
+    return result
+
+
+def read_chunks(path, chunksize):
+    """ Yields DataFrames of at most `chunksize` rows from a csv, parquet or pickle file."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif path.endswith('.pkl'):
+        data = pd.read_pickle(path)
+        for start in range(0, len(data), chunksize):
+            yield data.iloc[start:start + chunksize]
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize, dtype={'regno': str})
+
+
+class ChunkWriter:
+    """ Appends prediction chunks to a csv or parquet file as they arrive."""
+    def __init__(self, path):
+        self.path = path
+        self._parquet_writer = None
+        self._header = True
+
+    def write(self, result):
+        if self.path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(result, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            result.to_csv(self.path, mode='w' if self._header else 'a',
+                          header=self._header, index=False)
+        self._header = False
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def predict_file(input_path, output_path, model=None, model_path=None, chunksize=10000, n_jobs=1, index=None):
+    """ Streams `input_path` through the model chunk by chunk and writes the
+        results to `output_path`. With n_jobs > 1 chunks are fanned out over a
+        process pool; output order always follows the input. Near-duplicates
+        of the charities in `index` are answered from it.
+    """
+    writer = ChunkWriter(output_path)
+    n_rows = 0
+    start = time.perf_counter()
+    try:
+        if n_jobs == 1:
+            model = model if model is not None else load_model(model_path)
+            for chunk in read_chunks(input_path, chunksize):
+                writer.write(predict_chunk(chunk, model, index))
+                n_rows += len(chunk)
+                logger.info(f'{n_rows} rows predicted')
+        else:
+            with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                     initargs=(model_path, model, index)) as pool:
+                # bound the chunks in flight so memory stays flat
+                pending = deque()
+                for chunk in read_chunks(input_path, chunksize):
+                    pending.append(pool.submit(predict_chunk, chunk))
+                    if len(pending) >= 2 * n_jobs:
+                        result = pending.popleft().result()
+                        writer.write(result)
+                        n_rows += len(result)
+                        logger.info(f'{n_rows} rows predicted')
+                while pending:
+                    result = pending.popleft().result()
+                    writer.write(result)
+                    n_rows += len(result)
+                    logger.info(f'{n_rows} rows predicted')
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    logger.info(f'predicted {n_rows} rows in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s)')
+    return n_rows
+
+
+@click.command()
+@click.argument('input_path', type=click.Path(exists=True))
+@click.argument('output_path', type=click.Path())
+@click.option('--model-path', 'model_path', default=None, help='Local model file, else the default model on S3.')
+@click.option('--chunksize', 'chunksize', default=10000, type=int)
+@click.option('--n-jobs', 'n_jobs', default=1, type=int)
+@click.option('--index-path', 'index_path', default=None, type=click.Path(exists=True),
+              help='A near-duplicate index (src.data.near_duplicates) to answer known charities from.')
+def main(input_path, output_path, model_path, chunksize, n_jobs, index_path):
+    """ Predicts ICNPO classes for every charity in a csv/parquet/pickle file."""
+    n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+    index = joblib.load(index_path) if index_path else None
+    predict_file(input_path, output_path, model_path=model_path, chunksize=chunksize, n_jobs=n_jobs,
+                 index=index)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
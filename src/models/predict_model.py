@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 import boto3
-import botocore
 import joblib
-from io import BytesIO
+import json
 import logging
 import os
 from pathlib import Path
@@ -14,21 +13,23 @@ from src.features.custom_transformers import (
     FeatureExtractorNumber,
     CustomImputer
 )
+from src.data.artifact_cache import LocalSource, get_artifact_cache
+from src.models.artifact import load_artifact
+from src.models.linear_predictor import LinearPredictor
+from src.models.prediction_cache import CachedPredictor, PredictionCache
+from src.models.tree_predictor import TreeEnsemblePredictor
 
-def get_model_from_s3(bucket_name, filename):
-    s3 = boto3.client('s3')
+DEFAULT_MODEL = "default_cart_bc_2020_08_26_22_06.jlib"
+
+def get_model_from_s3(bucket_name, filename, cache=None):
+    # fetch through the local artifact cache so warm workers skip the download
+    cache = cache or get_artifact_cache(bucket_name)
     try:
-        with BytesIO() as fp:
-            s3.download_fileobj(bucket_name, filename, fp)
-            fp.seek(0)
-            model = joblib.load(fp)
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            print("The object does not exist.")
-            return None
-        else:
-            raise
-    return model
+        path = cache.fetch(filename)
+    except FileNotFoundError:
+        print("The object does not exist.")
+        return None
+    return load_artifact(path)
 
 def list_s3_objects(bucket_name, prefix):
     s3 = boto3.client('s3')
@@ -40,24 +41,47 @@ def list_s3_objects(bucket_name, prefix):
     else:
         print(f"No objects found in s3://{bucket_name}/{prefix}")
 
+def load_model(model_path=None):
+    """ Loads the model from a local file or export_model directory if given,
+        else the default model from S3.
+    """
+    if model_path is not None and os.path.isfile(os.path.join(model_path, 'meta.json')):
+        with open(os.path.join(model_path, 'meta.json')) as f:
+            kind = json.load(f).get('model', 'linear')
+        print(f"Loading exported {kind} model from: {model_path}")
+        return TreeEnsemblePredictor(model_path) if kind == 'trees' else LinearPredictor(model_path)
+    if model_path is not None:
+        print(f"Loading model from file: {model_path}")
+        return load_artifact(model_path)
+    filename = os.path.join(os.environ.get('MODELS_DIR'), DEFAULT_MODEL)
+    bucket_name = os.environ.get('BUCKET')
+    cache = get_artifact_cache(bucket_name)
+    if isinstance(cache.source, LocalSource):
+        # offline: the bucket is stood in for by a local directory
+        print(f"Loading model from {cache.source.root}, file: {filename}")
+    else:
+        list_s3_objects(bucket_name, 'char_class_data/models/')
+        print(f"Loading model from S3 bucket: {bucket_name}, file: {filename}")
+    return get_model_from_s3(bucket_name, filename, cache)
+
 @click.command()
 @click.argument('text')
-def main(text):
+@click.option('--cache-path', 'cache_path', default=None,
+              help='SQLite file of earlier predictions, reused while the model is unchanged.')
+def main(text, cache_path):
     # not used in this stub but often useful for finding various files
     project_dir = Path(__file__).resolve().parents[2]
 
     # find .env automagically by walking up directories until it's found, then
     # load up the .env entries as environment variables
     load_dotenv(find_dotenv())
-    filename = os.path.join(os.environ.get('MODELS_DIR'), "default_cart_bc_2020_08_26_22_06.jlib")
-    bucket_name = os.environ.get('BUCKET')
-    list_s3_objects(bucket_name, 'char_class_data/models/')
-    print(f"Loading model from S3 bucket: {bucket_name}, file: {filename}")
-    model = get_model_from_s3(bucket_name, filename)
+    model = load_model()
     if model is None:
         print("Model could not be loaded. Exiting.")
         return
     print("Model loaded successfully.")
+    if cache_path is not None:
+        model = CachedPredictor(model, PredictionCache(path=cache_path))
 
     prediction = model.predict([text])
     print(f"Prediction: {prediction[0]}")
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+""" Cache of predictions keyed by the hash of a row's normalized features and
+    the version of the model that made them.
+
+    An in-memory LRU tier answers the rows re-queried most often; an optional
+    SQLite tier keeps predictions across restarts and processes. Both are
+    bounded, evicting the least recently used rows. Loading a model with a
+    different version drops everything the previous one predicted.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from src.data.columnar import feature_columns
+
+logger = logging.getLogger(__name__)
+
+# keys per query against the disk tier
+QUERY_KEYS = 500
+
+
+def model_version(model):
+    """ Hash of the fitted model's parameters and arrays."""
+    return joblib.hash(model)
+
+
+def model_columns(model):
+    """ The dataset columns `model` reads, or None if they aren't known."""
+    model = getattr(model, 'best_estimator_', model)
+    if isinstance(model, Pipeline):
+        return feature_columns(model.steps[0][1]) or None
+    if hasattr(model, 'features'):
+        # models exported by export_model.py
+        return sorted({block['column'] for block in model.features.meta['blocks']}) or None
+    return None
+
+
+def _normalize(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, str):
+        # runs of whitespace don't change how a text is tokenized
+        return ' '.join(value.split())
+    if isinstance(value, float):
+        # 3 and 3.0 are the same feature; NaN is a missing value like None
+        return None if value != value else (int(value) if value.is_integer() else value)
+    return value
+
+
+def _records(rows):
+    if isinstance(rows, pd.DataFrame):
+        return rows.to_dict('records')
+    return list(rows)
+
+
+def _subset(rows, positions):
+    if isinstance(rows, pd.DataFrame):
+        return rows.iloc[positions]
+    return [rows[i] for i in positions]
+
+
+def _jsonable(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class PredictionCache:
+    """ Predictions of one model version, in memory (`max_items`) and, if
+        `path` is given, in a SQLite database (`max_disk_items`).
+    """
+    def __init__(self, max_items=100000, path=None, max_disk_items=1000000, timeout=60):
+        self.max_items = max_items
+        self.path = path
+        self.max_disk_items = max_disk_items
+        self.version = None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = self.disk_hits = self.misses = self.evictions = self.disk_evictions = 0
+        self._disk_items = 0
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # the service's threads share the connection under the lock
+            self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                   '(key TEXT PRIMARY KEY, version TEXT, prediction TEXT, used REAL)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)')
+
+    def set_version(self, version):
+        """ Switches to the predictions of model `version`, dropping those of
+            any other version from both tiers.
+        """
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            self._memory.clear()
+            if self._conn is not None:
+                with self._conn:
+                    dropped = self._conn.execute('DELETE FROM predictions WHERE version != ?', (version,)).rowcount
+                self._disk_items = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+                if dropped:
+                    logger.info(f'dropped {dropped} cached predictions of other model versions')
+
+    def key(self, row, columns=None):
+        """ Hash of the model version and the normalized `columns` of `row`
+            (all of them if None), or of the normalized row itself if it isn't
+            a dict.
+        """
+        if isinstance(row, dict):
+            columns = sorted(row) if columns is None else columns
+            values = [[column, _normalize(row.get(column))] for column in columns]
+        else:
+            # a bare text, as predict_model takes
+            values = _normalize(row)
+        return hashlib.sha1(json.dumps([self.version, values], default=str).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """ {key: prediction} for the `keys` in either tier; hits on disk are
+            promoted to memory, and every hit is marked used on disk so the
+            rows queried most often are the last evicted there.
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            self.hits += len(found)
+            missing = [key for key in keys if key not in found]
+            if self._conn is not None:
+                from_disk = {}
+                for start in range(0, len(missing), QUERY_KEYS):
+                    batch = missing[start:start + QUERY_KEYS]
+                    query = (f'SELECT key, prediction FROM predictions WHERE version = ? '
+                             f'AND key IN ({", ".join("?" * len(batch))})')
+                    from_disk.update(self._conn.execute(query, [self.version] + batch).fetchall())
+                if found or from_disk:
+                    now = time.time()
+                    with self._conn:
+                        self._conn.executemany('UPDATE predictions SET used = ? WHERE key = ?',
+                                               [(now, key) for key in list(found) + list(from_disk)])
+                from_disk = {key: json.loads(value) for key, value in from_disk.items()}
+                self.disk_hits += len(from_disk)
+                self._remember(from_disk)
+                found.update(from_disk)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, predictions):
+        """ Adds {key: prediction} to both tiers, evicting the least recently
+            used rows beyond their sizes.
+        """
+        with self._lock:
+            self._remember(predictions)
+            if self._conn is None or not predictions:
+                return
+            now = time.time()
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                       [(key, self.version, json.dumps(_jsonable(value)), now)
+                                        for key, value in predictions.items()])
+                # counted again only once the running count says the table may be full
+                self._disk_items += len(predictions)
+                if self._disk_items > self.max_disk_items:
+                    self._disk_items = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+                    excess = self._disk_items - self.max_disk_items
+                    if excess > 0:
+                        self._conn.execute('DELETE FROM predictions WHERE key IN '
+                                           '(SELECT key FROM predictions ORDER BY used LIMIT ?)', (excess,))
+                        self._disk_items -= excess
+                        self.disk_evictions += excess
+
+    def _remember(self, predictions):
+        # callers hold the lock
+        self._memory.update(predictions)
+        for key in predictions:
+            self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'cache_hits': self.hits, 'cache_disk_hits': self.disk_hits, 'cache_misses': self.misses,
+                    'cache_hit_rate': (self.hits + self.disk_hits) / lookups if lookups else None,
+                    'cache_evictions': self.evictions, 'cache_disk_evictions': self.disk_evictions,
+                    'cache_items': len(self._memory)}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+
+class CachedPredictor:
+    """ A model whose predict answers the rows it has seen from a
+        PredictionCache and only runs the model on the others.
+
+        Rows are a DataFrame or a list of dicts, as for the model.
+    """
+    def __init__(self, model, cache, version=None):
+        self.cache = cache
+        self.set_model(model, version)
+
+    def set_model(self, model, version=None):
+        """ Swaps in `model`; the cache is invalidated if its version (the
+            hash of the model if not given) differs.
+        """
+        self.model = model
+        self.columns = model_columns(model)
+        self.cache.set_version(version or model_version(model))
+        self.classes_ = getattr(model, 'classes_', None)
+
+    def predict(self, rows):
+        keys = [self.cache.key(row, self.columns) for row in _records(rows)]
+        found = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            predicted = self.model.predict(_subset(rows, missing))
+            found.update((keys[i], value) for i, value in zip(missing, predicted))
+            self.cache.put_many({keys[i]: found[keys[i]] for i in missing})
+        return np.array([found[key] for key in keys])
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+""" Grid search whose candidate x fold fits are jobs in a SQLite queue.
+
+    The search writes the estimator, candidates, folds and training data to a
+    queue directory and enqueues one job per fit. Workers, the search's own
+    local processes and any started on other hosts with
+
+        python src/models/queued_search.py QUEUE_DIR
+
+    claim jobs one at a time and store each result as soon as it is scored.
+    A worker that dies loses only the fit it was running: its lease expires
+    and another worker picks the job up. Fitting the search again on the same
+    queue directory skips every finished job, and cv_results_ is assembled
+    from the stored results as GridSearchCV would have built it.
+
+    For workers on several hosts the queue directory has to be on a shared
+    filesystem whose locks SQLite can use (e.g. NFS with lockd), along with
+    any paths the pipeline refers to such as a feature cache or token stores.
+"""
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from os.path import join as pj
+import click
+import joblib
+import numpy as np
+from joblib import effective_n_jobs
+from scipy.stats import rankdata
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import GridSearchCV, ParameterGrid, check_cv
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE = 'pending', 'running', 'done'
+
+
+def _take(a, index):
+    return a.iloc[index] if hasattr(a, 'iloc') else a[index]
+
+
+class JobQueue:
+    """ The candidate x fold jobs of one search in a SQLite database.
+
+        Every change is its own short transaction, so any number of processes
+        can share the database; a job is claimed for `lease_seconds`, which
+        its worker keeps renewing while the fit runs.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            # take the write lock up front so two workers can't claim the same job
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def create(self, fingerprint, n_candidates, n_splits, lease_seconds, max_attempts):
+        """ Creates the queue, or adds the jobs it is missing; jobs that are
+            already finished are kept.
+        """
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'candidate INTEGER, split INTEGER, status TEXT, worker TEXT, lease_until REAL, '
+                         'attempts INTEGER DEFAULT 0, fit_time REAL, score_time REAL, test_score REAL, '
+                         'train_score REAL, error TEXT, finished_at REAL, PRIMARY KEY (candidate, split))')
+            conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [
+                ('fingerprint', fingerprint), ('lease_seconds', lease_seconds), ('max_attempts', max_attempts)])
+            conn.executemany(f"INSERT OR IGNORE INTO jobs (candidate, split, status) VALUES (?, ?, '{PENDING}')",
+                             [(c, s) for c in range(n_candidates) for s in range(n_splits)])
+
+    def fingerprint(self):
+        """ The fingerprint of the search the queue holds, None before one is created."""
+        if not os.path.exists(self.path):
+            return None
+        with self._transaction() as conn:
+            if not conn.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone():
+                return None
+            row = conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        return None if row is None else row[0]
+
+    def meta(self, key):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def claim(self, worker):
+        """ The (candidate, split) of the next pending job, or of a running
+            one whose worker stopped renewing its lease, now leased to
+            `worker`; None if there is none.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            lease, max_attempts = [conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+                                   for key in ('lease_seconds', 'max_attempts')]
+            # a job that keeps killing its workers (e.g. out of memory) is given up on
+            conn.execute(f"UPDATE jobs SET status = '{DONE}', finished_at = ?, "
+                         f"error = 'lost its worker ' || attempts || ' times' "
+                         f"WHERE status = '{RUNNING}' AND lease_until < ? AND attempts >= ?",
+                         (now, now, max_attempts))
+            row = conn.execute(f"SELECT candidate, split FROM jobs WHERE status = '{PENDING}' "
+                               f"OR (status = '{RUNNING}' AND lease_until < ?) "
+                               'ORDER BY candidate, split LIMIT 1', (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(f"UPDATE jobs SET status = '{RUNNING}', worker = ?, lease_until = ?, "
+                         'attempts = attempts + 1 WHERE candidate = ? AND split = ?',
+                         (worker, now + lease, *row))
+        return row
+
+    def renew(self, job, worker):
+        with self._transaction() as conn:
+            lease = conn.execute("SELECT value FROM meta WHERE key = 'lease_seconds'").fetchone()[0]
+            conn.execute(f"UPDATE jobs SET lease_until = ? WHERE candidate = ? AND split = ? "
+                         f"AND worker = ? AND status = '{RUNNING}'", (time.time() + lease, *job, worker))
+
+    def finish(self, job, worker, result):
+        with self._transaction() as conn:
+            conn.execute(f"UPDATE jobs SET status = '{DONE}', worker = ?, fit_time = ?, score_time = ?, "
+                         'test_score = ?, train_score = ?, error = ?, finished_at = ? '
+                         f"WHERE candidate = ? AND split = ? AND status != '{DONE}'",
+                         (worker, result['fit_time'], result['score_time'], result['test_score'],
+                          result.get('train_score'), result.get('error'), time.time(), *job))
+
+    def running_workers(self):
+        with self._transaction() as conn:
+            return [row[0] for row in conn.execute(f"SELECT DISTINCT worker FROM jobs WHERE status = '{RUNNING}'")]
+
+    def release(self, worker):
+        """ Puts the jobs `worker` was running back in the queue."""
+        with self._transaction() as conn:
+            conn.execute(f"UPDATE jobs SET status = '{PENDING}', worker = NULL "
+                         f"WHERE worker = ? AND status = '{RUNNING}'", (worker,))
+
+    def counts(self):
+        with self._transaction() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def results(self):
+        """ Every finished job as a dict, in (candidate, split) order."""
+        with self._transaction() as conn:
+            cursor = conn.execute('SELECT candidate, split, fit_time, score_time, test_score, train_score, '
+                                  f"error FROM jobs WHERE status = '{DONE}' ORDER BY candidate, split")
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+def _fold_params(fit_params, n_rows, index):
+    # per-row fit params (sample weights) follow the rows of the fold
+    return {name: _take(value, index) if hasattr(value, '__len__') and len(value) == n_rows else value
+            for name, value in fit_params.items()}
+
+
+def _paths(queue_dir):
+    return pj(queue_dir, 'queue.sqlite'), pj(queue_dir, 'search.jlib')
+
+
+def run_job(spec, candidate, split):
+    """ Fits candidate `candidate` on fold `split` and scores it, as
+        GridSearchCV's workers do; a failed fit scores `error_score`.
+    """
+    estimator = clone(spec['estimator']).set_params(**spec['candidates'][candidate])
+    train, test = spec['splits'][split]
+    X, y = spec['X'], spec['y']
+    fit_params = _fold_params(spec.get('fit_params', {}), len(y), train)
+    result = {'fit_time': 0.0, 'score_time': 0.0}
+    start = time.time()
+    try:
+        estimator.fit(_take(X, train), _take(y, train), **fit_params)
+        result['fit_time'] = time.time() - start
+        scorer = check_scoring(estimator, spec['scoring'])
+        start = time.time()
+        result['test_score'] = float(scorer(estimator, _take(X, test), _take(y, test)))
+        result['score_time'] = time.time() - start
+        if spec['return_train_score']:
+            result['train_score'] = float(scorer(estimator, _take(X, train), _take(y, train)))
+    except Exception as e:
+        result['fit_time'] = result['fit_time'] or time.time() - start
+        result['error'] = f'{type(e).__name__}: {e}'
+        # with 'raise' the search raises once the results are collected
+        error_score = np.nan if spec['error_score'] == 'raise' else spec['error_score']
+        result['test_score'] = result['train_score'] = error_score
+    return result
+
+
+@contextmanager
+def _renewing(queue, job, worker, lease_seconds):
+    """ Keeps renewing the lease of `job` while the enclosed fit runs."""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease_seconds / 3):
+            try:
+                queue.renew(job, worker)
+            except sqlite3.Error as e:
+                logger.warning(f'could not renew the lease of job {job}: {e}')
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def work(queue_dir, poll_seconds=5):
+    """ Claims and runs jobs from the queue in `queue_dir` until all of them
+        are finished, returning how many this worker ran.
+    """
+    db_path, spec_path = _paths(queue_dir)
+    queue = JobQueue(db_path)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    spec, n_jobs = None, 0
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            counts = queue.counts()
+            if not counts.get(PENDING) and not counts.get(RUNNING):
+                logger.info(f'worker {worker}: queue finished after {n_jobs} jobs')
+                return n_jobs
+            # others are still running; their jobs come back if their leases lapse
+            time.sleep(poll_seconds)
+            continue
+        if spec is None or spec['fingerprint'] != queue.meta('fingerprint'):
+            spec = joblib.load(spec_path, mmap_mode='r')
+        with _renewing(queue, job, worker, queue.meta('lease_seconds')):
+            result = run_job(spec, *job)
+        queue.finish(job, worker, result)
+        n_jobs += 1
+        logger.info(f'worker {worker}: candidate {job[0]} split {job[1]} scored {result["test_score"]} '
+                    f'in {result["fit_time"]:.1f}s' + (f' ({result["error"]})' if 'error' in result else ''))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def release_dead_workers(queue):
+    """ Requeues the jobs of workers on this host that no longer run (say,
+        the local workers of a search that was killed), without waiting for
+        their leases to lapse.
+    """
+    host = socket.gethostname()
+    for worker in queue.running_workers():
+        name, pid = worker.rsplit(':', 1)
+        if name == host and not _pid_alive(int(pid)):
+            logger.info(f'requeueing the jobs of {worker}, which is no longer running')
+            queue.release(worker)
+
+
+def _local_worker(queue_dir, poll_seconds):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    work(queue_dir, poll_seconds)
+
+
+def _rank(means):
+    # failed candidates (nan) rank last, as in GridSearchCV
+    if np.isnan(means).all():
+        return np.ones_like(means, dtype=np.int32)
+    means = np.nan_to_num(means, nan=np.nanmin(means) - 1)
+    return rankdata(-means, method='min').astype(np.int32)
+
+
+def cv_results(candidates, n_splits, rows, return_train_score=False):
+    """ GridSearchCV's cv_results_ for single metric scoring, from the rows
+        of JobQueue.results.
+    """
+    def grid(column):
+        values = np.full((len(candidates), n_splits), np.nan)
+        for row in rows:
+            values[row['candidate'], row['split']] = np.nan if row[column] is None else row[column]
+        return values
+
+    results = {}
+    for name in ('fit_time', 'score_time'):
+        values = grid(name)
+        results[f'mean_{name}'] = values.mean(axis=1)
+        results[f'std_{name}'] = values.std(axis=1)
+    for name in sorted({k for params in candidates for k in params}):
+        column = np.ma.MaskedArray(np.empty(len(candidates), dtype=object), mask=True)
+        for i, params in enumerate(candidates):
+            if name in params:
+                column[i] = params[name]
+        results[f'param_{name}'] = column
+    results['params'] = candidates
+    for kind in ('test', 'train') if return_train_score else ('test',):
+        values = grid(f'{kind}_score')
+        for split in range(n_splits):
+            results[f'split{split}_{kind}_score'] = values[:, split]
+        results[f'mean_{kind}_score'] = values.mean(axis=1)
+        results[f'std_{kind}_score'] = values.std(axis=1)
+        if kind == 'test':
+            results['rank_test_score'] = _rank(results['mean_test_score'])
+    return results
+
+
+class QueuedGridSearchCV(GridSearchCV):
+    """ GridSearchCV whose fits are run from a job queue in `queue_dir` by
+        `n_jobs` local worker processes and any remote workers, and which
+        resumes from the stored results when fitted again after a crash.
+
+        Only single metric scoring is supported.
+    """
+    def __init__(self, estimator, param_grid, *, queue_dir, scoring=None, n_jobs=None, refit=True, cv=None,
+                 verbose=0, pre_dispatch='2*n_jobs', error_score=np.nan, return_train_score=False,
+                 lease_seconds=300, max_attempts=3, poll_seconds=5):
+        super().__init__(estimator, param_grid, scoring=scoring, n_jobs=n_jobs, refit=refit, cv=cv,
+                         verbose=verbose, pre_dispatch=pre_dispatch, error_score=error_score,
+                         return_train_score=return_train_score)
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+
+    def _enqueue(self, X, y, candidates, splits, fit_params):
+        db_path, spec_path = _paths(self.queue_dir)
+        os.makedirs(self.queue_dir, exist_ok=True)
+        spec = {
+            'estimator': self.estimator,
+            'candidates': candidates,
+            'splits': splits,
+            'scoring': self.scoring,
+            'error_score': self.error_score,
+            'return_train_score': self.return_train_score,
+            'X': X,
+            'y': y,
+            'fit_params': fit_params
+        }
+        spec['fingerprint'] = joblib.hash(spec)
+        queue = JobQueue(db_path)
+        if queue.fingerprint() not in (None, spec['fingerprint']):
+            raise ValueError(f'{self.queue_dir} holds the jobs of a different search (estimator, grid, '
+                             'folds, data or fit params changed); use another queue directory')
+        if queue.fingerprint() is None or not os.path.exists(spec_path):
+            # written whole before any job can be claimed
+            joblib.dump(spec, f'{spec_path}.tmp', compress=0)
+            os.replace(f'{spec_path}.tmp', spec_path)
+        queue.create(spec['fingerprint'], len(candidates), len(splits), self.lease_seconds, self.max_attempts)
+        return queue
+
+    def _wait(self, queue):
+        """ Runs the local workers, replacing any that die, until every job is done."""
+        context = multiprocessing.get_context('spawn')
+
+        def start():
+            process = context.Process(target=_local_worker, args=(self.queue_dir, self.poll_seconds))
+            process.start()
+            return process
+
+        processes = [start() for _ in range(effective_n_jobs(self.n_jobs))]
+        last = None
+        try:
+            while True:
+                counts = queue.counts()
+                if not counts.get(PENDING) and not counts.get(RUNNING):
+                    break
+                if counts != last:
+                    logger.info(f'{counts.get(DONE, 0)}/{sum(counts.values())} fits done, '
+                                f'{counts.get(RUNNING, 0)} running')
+                    last = counts
+                for i, process in enumerate(processes):
+                    if process.exitcode not in (None, 0):
+                        logger.warning(f'local worker {process.pid} exited with {process.exitcode}, restarting it')
+                        # requeue the job it was running rather than wait for its lease to lapse
+                        queue.release(f'{socket.gethostname()}:{process.pid}')
+                        processes[i] = start()
+                time.sleep(self.poll_seconds)
+        finally:
+            for process in processes:
+                process.join(timeout=self.poll_seconds)
+                if process.is_alive():
+                    process.terminate()
+
+    def fit(self, X, y=None, groups=None, **fit_params):
+        if callable(self.refit) or not isinstance(self.refit, bool):
+            raise ValueError('QueuedGridSearchCV supports single metric scoring with refit=True or False only')
+        cv = check_cv(self.cv, y, classifier=is_classifier(self.estimator))
+        splits = list(cv.split(X, y, groups))
+        candidates = list(ParameterGrid(self.param_grid))
+
+        queue = self._enqueue(X, y, candidates, splits, fit_params)
+        release_dead_workers(queue)
+        counts = queue.counts()
+        if counts.get(DONE):
+            logger.info(f'resuming: {counts[DONE]} of {sum(counts.values())} fits already done')
+        self._wait(queue)
+
+        rows = queue.results()
+        errors = [row['error'] for row in rows if row['error']]
+        if errors:
+            if self.error_score == 'raise' or len(errors) == len(rows):
+                raise ValueError(f'{len(errors)} of {len(rows)} fits failed, the first with: {errors[0]}')
+            logger.warning(f'{len(errors)} of {len(rows)} fits failed and scored {self.error_score}, '
+                           f'the first with: {errors[0]}')
+
+        self.multimetric_ = False
+        self.scorer_ = check_scoring(self.estimator, self.scoring)
+        self.n_splits_ = len(splits)
+        self.cv_results_ = cv_results(candidates, self.n_splits_, rows, self.return_train_score)
+        self.best_index_ = int(self.cv_results_['rank_test_score'].argmin())
+        self.best_score_ = self.cv_results_['mean_test_score'][self.best_index_]
+        self.best_params_ = candidates[self.best_index_]
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+            start = time.time()
+            self.best_estimator_.fit(X, y, **fit_params)
+            self.refit_time_ = time.time() - start
+        return self
+
+
+@click.command()
+@click.argument('queue_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--poll-seconds', 'poll_seconds', default=5, type=float,
+              help='How often to look for jobs while other workers finish theirs.')
+def main(queue_dir, poll_seconds):
+    """ Runs jobs of a QueuedGridSearchCV queue until it is finished."""
+    work(queue_dir, poll_seconds)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
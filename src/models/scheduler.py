@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+""" Splits a core and memory budget between the search's workers and the
+    threads each fit may use.
+
+    Candidates x folds are independent fits, so outer workers are the
+    cheapest parallelism and come first, as many as the cores, the fits and
+    the memory allow. Cores left over go to the estimator's own threads
+    (n_jobs of the forests and knn) or to BLAS/OpenMP; estimators that fit
+    on one thread (saga, libsvm, single trees) get exactly one, which keeps
+    every worker's thread pools from spreading over all of the machine's
+    cores.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from joblib import parallel_backend
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
+from threadpoolctl import threadpool_limits
+from src.data.instrumentation import measure
+from src.data.memory import available_memory
+
+logger = logging.getLogger(__name__)
+
+# how each estimator type can use more than one core within a fit
+INNER_PARALLELISM = {
+    'RandomForestClassifier': 'n_jobs',
+    'ExtraTreesClassifier': 'n_jobs',
+    'KNeighborsClassifier': 'n_jobs',
+    # the SVD, k-means and distance products run in BLAS/OpenMP
+    'ApproximateKNeighborsClassifier': 'blas',
+    # saga, liblinear and libsvm are single-threaded; the trees are too
+    'LogisticRegression': None,
+    'SVC': None,
+    'DecisionTreeClassifier': None,
+    'AdaBoostClassifier': None
+}
+
+# parameters whose largest value makes the heaviest fit, probed for the memory estimate
+MEMORY_PARAMS = ('n_estimators', 'max_features', 'n_features', 'max_samples', 'n_components')
+
+# speedup of a fit given t threads taken as t ** THREAD_SCALING: sharing a fit
+# costs more than running separate fits
+THREAD_SCALING = 0.9
+
+# peak memory per training row assumed when no candidate can be probed, over
+# twice the most a probe of the text feature unions has measured
+DEFAULT_BYTES_PER_ROW = 128 * 1024
+
+# resident memory of a fresh worker with numpy, pandas and sklearn imported
+WORKER_BYTES = 200 * 1024 ** 2
+
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is Linux only
+        return os.cpu_count()
+
+
+def inner_parallelism(estimator):
+    """ 'n_jobs', 'blas' or None: how a fit of `estimator` uses more cores."""
+    name = type(estimator).__name__
+    if name in INNER_PARALLELISM:
+        return INNER_PARALLELISM[name]
+    return 'n_jobs' if 'n_jobs' in estimator.get_params() else 'blas'
+
+
+def _heaviest_first(values):
+    # distinct values, the ones making the largest fit first
+    values = list(dict.fromkeys(values))
+    numbers = [v for v in values if isinstance(v, (int, float, np.number)) and not isinstance(v, bool)]
+    if numbers:
+        return sorted(numbers, reverse=True) + [v for v in values if v not in numbers]
+    ranges = [v for v in values if isinstance(v, tuple) and len(v) == 2]
+    if ranges:
+        # the widest ngram range makes the most columns
+        return sorted(ranges, key=lambda r: r[1] - r[0] + 1, reverse=True) + [v for v in values if v not in ranges]
+    return values
+
+
+def heavy_candidates(param_grid):
+    """ Candidates from the heaviest down: the k-th takes the k-th largest
+        value of every parameter that grows the fit (MEMORY_PARAMS, ngram
+        ranges), or its smallest if it has fewer, and the first of the others.
+    """
+    ordered = {}
+    for name, values in param_grid.items():
+        if name.rsplit('__', 1)[-1] in MEMORY_PARAMS or name.endswith('ngram_range'):
+            ordered[name] = _heaviest_first(values)
+        else:
+            ordered[name] = list(values)[:1]
+    for k in range(max(len(values) for values in ordered.values())):
+        yield {name: values[min(k, len(values) - 1)] for name, values in ordered.items()}
+
+
+def heaviest_candidate(param_grid):
+    """ The candidate taking the largest value of every parameter that grows
+        the fit and the first of the others.
+    """
+    return next(heavy_candidates(param_grid))
+
+
+def data_bytes(X):
+    if hasattr(X, 'memory_usage'):
+        return int(X.memory_usage(index=True, deep=True).sum())
+    return int(getattr(X, 'nbytes', 0))
+
+
+def probe_memory(pipe, param_grid, X, y, n_rows=2000, random_state=1):
+    """ Peak memory per training row of a fit of the heaviest candidate on a
+        sample of `n_rows`, in bytes. Candidates the estimator rejects (e.g.
+        a value the installed sklearn doesn't accept) give way to the next
+        heaviest; DEFAULT_BYTES_PER_ROW if none can be fitted.
+    """
+    sample = X.sample(min(n_rows, len(X)), random_state=random_state)
+    for candidate in heavy_candidates(param_grid):
+        estimator = clone(pipe).set_params(**candidate)
+        if 'clf__n_jobs' in estimator.get_params():
+            # more threads than any fit of the search gets, so the estimate errs high
+            estimator.set_params(clf__n_jobs=-1)
+        try:
+            with measure('scheduler/probe', rows=len(sample)) as record:
+                start = record['peak_rss_bytes']
+                estimator.fit(sample, y[sample.index])
+        except Exception as e:
+            logger.warning(f'memory probe of {candidate} failed: {e!r}')
+            continue
+        return max(record['peak_rss_bytes'] - start, 0) / len(sample)
+    logger.warning(f'no candidate could be probed, assuming {DEFAULT_BYTES_PER_ROW // 1024} KB per training row')
+    return DEFAULT_BYTES_PER_ROW
+
+
+def plan_layout(estimator, n_fits, fold_rows, cores, memory_bytes, bytes_per_row=0, base_bytes=0,
+                safety=1.5, inner_cap=None):
+    """ The number of search workers and threads per fit for `n_fits` fits
+        of `fold_rows` rows within `cores` and `memory_bytes`.
+
+        A worker is estimated to hold WORKER_BYTES, `base_bytes` (its copy of
+        the training data) and `bytes_per_row` for every row it fits on, times
+        `safety`.
+    """
+    kind = inner_parallelism(estimator)
+    worker_bytes = int((WORKER_BYTES + base_bytes + bytes_per_row * fold_rows) * safety)
+    by_memory = max(1, memory_bytes // worker_bytes)
+    max_workers = int(max(1, min(cores, n_fits, by_memory)))
+
+    def threads_for(workers):
+        if kind is None:
+            return 1
+        return max(1, min(cores // workers, inner_cap or cores))
+
+    # the shortest estimated makespan, with the most workers among equals
+    workers = min(range(max_workers, 0, -1),
+                  key=lambda w: math.ceil(n_fits / w) / threads_for(w) ** THREAD_SCALING)
+    threads = threads_for(workers)
+    if worker_bytes > memory_bytes:
+        logger.warning(f'a single fit is estimated at {worker_bytes / 1024 ** 3:.1f} GB, more than the '
+                       f'{memory_bytes / 1024 ** 3:.1f} GB budget')
+    return {
+        'cores': cores,
+        'memory_bytes': int(memory_bytes),
+        'n_fits': n_fits,
+        'inner': kind,
+        'workers': workers,
+        'threads': threads,
+        'worker_bytes': worker_bytes,
+        'limited_by': 'memory' if by_memory < min(cores, n_fits) else 'fits' if n_fits < cores else 'cores'
+    }
+
+
+def schedule(pipe, param_grid, X, y, cv, cores=None, memory_bytes=None, probe_rows=2000, n_candidates=None):
+    """ Layout of a search of `param_grid` (or `n_candidates` of it) over
+        `pipe` on (X, y) with `cv` folds, within `cores` and `memory_bytes`
+        (the machine's if not given).
+    """
+    if cores and cores > available_cores():
+        logger.warning(f'a budget of {cores} cores on {available_cores()} available oversubscribes them')
+    cores = cores or available_cores()
+    memory_bytes = memory_bytes or available_memory()
+    estimator = pipe.steps[-1][1]
+    cv = cv if isinstance(cv, int) else cv.get_n_splits()
+    n_candidates = min(n_candidates or np.inf, len(ParameterGrid(param_grid)))
+    n_fits = int(n_candidates * cv)
+    bytes_per_row = probe_memory(pipe, param_grid, X, y, probe_rows) if probe_rows else 0
+    # a forest can't use more threads than it has trees
+    n_estimators = [v for k, v in param_grid.items() if k.endswith('__n_estimators')]
+    inner_cap = int(min(min(v) for v in n_estimators)) if n_estimators else None
+    layout = plan_layout(estimator, n_fits, len(X) * (cv - 1) // cv, cores, memory_bytes,
+                         bytes_per_row=bytes_per_row, base_bytes=data_bytes(X), inner_cap=inner_cap)
+    layout['bytes_per_row'] = bytes_per_row
+    logger.info(f'{layout["workers"]} search workers x {layout["threads"]} threads '
+                f'({layout["inner"] or "single-threaded"} fits) on {cores} cores for {n_fits} fits; '
+                f'~{layout["worker_bytes"] / 1024 ** 3:.2f} GB per worker of '
+                f'{memory_bytes / 1024 ** 3:.1f} GB, limited by {layout["limited_by"]}')
+    return layout
+
+
+def apply_layout(layout, pipe, job_args):
+    """ Sets the threads of estimators with their own n_jobs on `pipe` and
+        returns `job_args` with the search's n_jobs.
+    """
+    if layout['inner'] == 'n_jobs':
+        pipe.set_params(clf__n_jobs=layout['threads'])
+    return dict(job_args, n_jobs=layout['workers'])
+
+
+@contextmanager
+def thread_limits(threads):
+    """ Caps the BLAS/OpenMP threads of every fit at `threads`: in the loky
+        workers of a search, in processes started within the block (which
+        inherit the environment) and in this process.
+    """
+    previous = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: str(threads) for name in THREAD_VARIABLES})
+    try:
+        with parallel_backend('loky', inner_max_num_threads=threads), threadpool_limits(threads):
+            yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _cpu_times():
+    # busy and total jiffies of all of the host's cores; None without /proc
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except OSError:
+        return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    return sum(fields) - idle, sum(fields)
+
+
+class UtilizationMonitor:
+    """ Samples the host's busy cores and available memory while a block runs."""
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.min_available = min(self.min_available, available_memory())
+
+    def __enter__(self):
+        self.min_available = available_memory()
+        self.start_available = self.min_available
+        self._cpu = _cpu_times()
+        self._start = time.perf_counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self._start
+        end = _cpu_times()
+        self.busy_cores = None
+        if self._cpu is not None and end is not None and end[1] > self._cpu[1]:
+            self.busy_cores = (end[0] - self._cpu[0]) / (end[1] - self._cpu[1]) * os.cpu_count()
+        self.memory_used = self.start_available - self.min_available
+        return False
+
+
+def log_utilization(layout, monitor, searchcv=None, log=logger):
+    """ Logs the cores and memory the search used against its layout, and
+        how busy its workers were going by cv_results_.
+    """
+    message = f'search took {monitor.seconds:.1f}s'
+    if monitor.busy_cores is not None:
+        message += (f', {monitor.busy_cores:.1f} of {layout["cores"]} budgeted cores busy on average '
+                    f'({monitor.busy_cores / layout["cores"]:.0%})')
+    message += (f', peak memory use {monitor.memory_used / 1024 ** 3:.2f} GB of '
+                f'{layout["memory_bytes"] / 1024 ** 3:.1f} GB')
+    if searchcv is not None and hasattr(searchcv, 'cv_results_') and monitor.seconds:
+        results = searchcv.cv_results_
+        busy = np.nansum((results['mean_fit_time'] + results['mean_score_time']) * searchcv.n_splits_)
+        message += f', workers busy {busy / (monitor.seconds * layout["workers"]):.0%} of the time'
+    log.info(message)
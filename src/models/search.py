@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+import numpy as np
+from joblib import effective_n_jobs
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import (
+    GridSearchCV,
+    RandomizedSearchCV,
+    HalvingGridSearchCV,
+    HalvingRandomSearchCV,
+    ParameterSampler
+)
+from src.models.feature_cache import CachedGridSearchCV
+from src.models.queued_search import QueuedGridSearchCV
+
+logger = logging.getLogger(__name__)
+
+SEARCHES = ['grid', 'random', 'halving-grid', 'halving-random', 'queued']
+RESOURCES = ['n_samples', 'n_estimators']
+
+
+class _BudgetSpent(Exception):
+    pass
+
+
+class BudgetMixin:
+    """ Stops dispatching candidates once `budget` seconds have passed since the
+        search started. A batch that is already running is finished, so the
+        budget can be overrun by at most one batch (or halving iteration).
+    """
+    def _run_search(self, evaluate_candidates):
+        self.budget_spent_ = False
+        if self.budget is None:
+            return self._run_candidates(evaluate_candidates)
+
+        deadline = time.monotonic() + self.budget
+
+        def evaluate_within_budget(candidate_params, *args, **kwargs):
+            if time.monotonic() > deadline:
+                raise _BudgetSpent
+            return evaluate_candidates(candidate_params, *args, **kwargs)
+
+        try:
+            self._run_candidates(evaluate_within_budget)
+        except _BudgetSpent:
+            self.budget_spent_ = True
+            logger.info(f'search budget of {self.budget:g}s spent, keeping the candidates evaluated so far')
+
+    def _run_candidates(self, evaluate_candidates):
+        super()._run_search(evaluate_candidates)
+
+
+class BudgetRandomizedSearchCV(BudgetMixin, RandomizedSearchCV):
+    """ RandomizedSearchCV evaluating its `n_iter` candidates in batches of
+        `batch_size`, so a `budget` (seconds) can stop it between batches.
+    """
+    def __init__(self, estimator, param_distributions, *, n_iter=10, budget=None, batch_size=None,
+                 scoring=None, n_jobs=None, refit=True, cv=None, verbose=0, pre_dispatch='2*n_jobs',
+                 random_state=None, error_score=np.nan, return_train_score=False):
+        super().__init__(estimator, param_distributions, n_iter=n_iter, scoring=scoring, n_jobs=n_jobs,
+                         refit=refit, cv=cv, verbose=verbose, pre_dispatch=pre_dispatch,
+                         random_state=random_state, error_score=error_score,
+                         return_train_score=return_train_score)
+        self.budget = budget
+        self.batch_size = batch_size
+
+    def _run_candidates(self, evaluate_candidates):
+        # sampled up front so the candidates don't depend on the budget
+        candidates = list(ParameterSampler(self.param_distributions, self.n_iter,
+                                           random_state=self.random_state))
+        batch_size = self.batch_size or len(candidates)
+        for start in range(0, len(candidates), batch_size):
+            evaluate_candidates(candidates[start:start + batch_size])
+
+
+class BudgetHalvingGridSearchCV(BudgetMixin, HalvingGridSearchCV):
+    """ HalvingGridSearchCV that stops after the iteration in which `budget`
+        seconds ran out; the best candidate of the last iteration is refit.
+    """
+    def __init__(self, estimator, param_grid, *, budget=None, factor=3, resource='n_samples',
+                 max_resources='auto', min_resources='exhaust', aggressive_elimination=False,
+                 cv=5, scoring=None, refit=True, error_score=np.nan, return_train_score=False,
+                 n_jobs=None, verbose=0):
+        super().__init__(estimator, param_grid, factor=factor, resource=resource,
+                         max_resources=max_resources, min_resources=min_resources,
+                         aggressive_elimination=aggressive_elimination, cv=cv, scoring=scoring,
+                         refit=refit, error_score=error_score, return_train_score=return_train_score,
+                         n_jobs=n_jobs, verbose=verbose)
+        self.budget = budget
+
+
+class BudgetHalvingRandomSearchCV(BudgetMixin, HalvingRandomSearchCV):
+    """ HalvingRandomSearchCV that stops after the iteration in which `budget`
+        seconds ran out; the best candidate of the last iteration is refit.
+    """
+    def __init__(self, estimator, param_distributions, *, n_candidates='exhaust', budget=None,
+                 factor=3, resource='n_samples', max_resources='auto', min_resources='exhaust',
+                 aggressive_elimination=False, cv=5, scoring=None, refit=True, error_score=np.nan,
+                 return_train_score=False, random_state=None, n_jobs=None, verbose=0):
+        super().__init__(estimator, param_distributions, n_candidates=n_candidates, factor=factor,
+                         resource=resource, max_resources=max_resources, min_resources=min_resources,
+                         aggressive_elimination=aggressive_elimination, cv=cv, scoring=scoring,
+                         refit=refit, error_score=error_score, return_train_score=return_train_score,
+                         random_state=random_state, n_jobs=n_jobs, verbose=verbose)
+        self.budget = budget
+
+
+def _halving_resource(param_grid, estimator, resource):
+    """ Resource arguments for the halving searches. With n_estimators the
+        ensemble size is taken out of the grid and grown between iterations
+        from its smallest to its largest grid value.
+    """
+    if resource == 'n_samples':
+        return param_grid, {'resource': 'n_samples'}
+    if 'n_estimators' not in estimator.get_params():
+        raise ValueError(f'{type(estimator).__name__} has no n_estimators to use as the resource')
+    param_grid = dict(param_grid)
+    n_estimators = param_grid.pop('clf__n_estimators', [estimator.get_params()['n_estimators']])
+    return param_grid, {
+        'resource': 'clf__n_estimators',
+        'min_resources': int(min(n_estimators)),
+        'max_resources': int(max(n_estimators))
+    }
+
+
+def make_search(search, pipe, param_grid, job_args, n_iter=60, budget=None, resource='n_samples',
+                bytes_limit=None, random_state=1, queue_dir=None):
+    """ Builds the hyperparameter search named `search` (one of SEARCHES) for
+        `pipe`. `job_args` are the cv/n_jobs/verbose/scoring kwargs from
+        model_params; `budget` caps the wall-clock seconds of the non-exhaustive
+        searches. The queued grid search keeps its jobs in `queue_dir`.
+    """
+    if search == 'grid':
+        if pipe.memory is not None:
+            # reuse each fold's feature matrix across all clf__ params
+            return CachedGridSearchCV(pipe, param_grid=param_grid, bytes_limit=bytes_limit, **job_args)
+        return GridSearchCV(pipe, param_grid=param_grid, **job_args)
+
+    if search == 'queued':
+        if queue_dir is None:
+            raise ValueError('the queued search needs a queue directory')
+        # n_jobs local workers; workers on other hosts can join through the queue
+        return QueuedGridSearchCV(pipe, param_grid=param_grid, queue_dir=queue_dir, **job_args)
+
+    if search == 'random':
+        return BudgetRandomizedSearchCV(pipe, param_distributions=param_grid, n_iter=n_iter,
+                                        budget=budget, random_state=random_state,
+                                        # a batch per round of workers keeps them all busy
+                                        batch_size=None if budget is None else effective_n_jobs(job_args.get('n_jobs')) * 2,
+                                        **job_args)
+
+    param_grid, resource_args = _halving_resource(param_grid, pipe.steps[-1][1], resource)
+    if search == 'halving-grid':
+        return BudgetHalvingGridSearchCV(pipe, param_grid=param_grid, budget=budget,
+                                         **resource_args, **job_args)
+    if search == 'halving-random':
+        return BudgetHalvingRandomSearchCV(pipe, param_distributions=param_grid, n_candidates=n_iter,
+                                           budget=budget, random_state=random_state,
+                                           **resource_args, **job_args)
+    raise ValueError(f'unknown search: {search}')
+
+
+def search_summary(search, searchcv, seconds, X_test=None, y_test=None):
+    """ Best score, cost and (if given) held-out score of a fitted search."""
+    results = searchcv.cv_results_
+    n_splits = searchcv.n_splits_
+    summary = {
+        'search': search,
+        'wall_clock_s': round(seconds, 1),
+        'n_candidates': len(set(repr(sorted(p.items())) for p in results['params'])),
+        'n_fits': len(results['params']) * n_splits,
+        'fit_time_s': round(float(np.nansum(
+            (results['mean_fit_time'] + results['mean_score_time']) * n_splits)), 1),
+        'best_cv_score': float(searchcv.best_score_),
+        'best_params': {k: repr(v) for k, v in searchcv.best_params_.items()},
+        'budget_spent': bool(getattr(searchcv, 'budget_spent_', False))
+    }
+    if X_test is not None and hasattr(searchcv, 'best_estimator_'):
+        summary['test_score'] = float(searchcv.score(X_test, y_test))
+    return summary
+
+
+def compare_searches(summaries, log=logger):
+    """ Logs each search's best score against its wall-clock time, relative to
+        the exhaustive grid if it is among `summaries`.
+    """
+    baseline = next((s for s in summaries if s['search'] == 'grid'), None)
+    log.info(f'{"search":<15}{"candidates":>11}{"fits":>8}{"wall s":>10}{"cv score":>10}'
+             f'{"test score":>12}{"speedup":>9}{"delta":>9}')
+    for s in summaries:
+        speedup = delta = ''
+        if baseline is not None:
+            speedup = f'{baseline["wall_clock_s"] / max(s["wall_clock_s"], 1e-9):.1f}x'
+            delta = f'{s["best_cv_score"] - baseline["best_cv_score"]:+.4f}'
+        test_score = f'{s["test_score"]:.4f}' if 'test_score' in s else ''
+        log.info(f'{s["search"]:<15}{s["n_candidates"]:>11}{s["n_fits"]:>8}{s["wall_clock_s"]:>10.1f}'
+                 f'{s["best_cv_score"]:>10.4f}{test_score:>12}{speedup:>9}{delta:>9}')
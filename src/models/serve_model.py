@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from dotenv import find_dotenv, load_dotenv
+import click
+import numpy as np
+import pandas as pd
+from src.models.predict_model import load_model
+from src.models.prediction_cache import CachedPredictor, PredictionCache, model_columns
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    def __init__(self, rows):
+        self.rows = rows
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.predictions = None
+        self.error = None
+        self.batch_size = 0
+
+
+class MicroBatcher:
+    """ Collects requests that arrive within `max_wait_ms` of each other and
+        classifies them with a single `model.predict` call.
+    """
+    def __init__(self, model, max_batch_size=256, max_wait_ms=10):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._latencies = []
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_batches = 0
+        # the columns a request's rows must have, checked before they are batched
+        self.columns = model.columns if isinstance(model, CachedPredictor) else model_columns(model)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict(self, rows):
+        request = _Request(rows)
+        self._queue.put(request)
+        request.done.wait()
+        latency_ms = (time.perf_counter() - request.received) * 1000
+        with self._lock:
+            self.n_requests += 1
+            self._latencies.append(latency_ms)
+            # keep a bounded window for the percentiles
+            del self._latencies[:-10000]
+        if request.error is not None:
+            raise request.error
+        return request.predictions, latency_ms, request.batch_size
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self._latencies)
+            stats = {'requests': self.n_requests, 'batches': self.n_batches}
+        if hasattr(self.model, 'stats'):
+            stats.update(self.model.stats())
+        if len(latencies):
+            stats['latency_ms_p50'] = float(np.percentile(latencies, 50))
+            stats['latency_ms_p95'] = float(np.percentile(latencies, 95))
+            stats['latency_ms_max'] = float(latencies.max())
+        return stats
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        n_rows = len(batch[0].rows)
+        deadline = time.perf_counter() + self.max_wait
+        while n_rows < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_rows += len(request.rows)
+        return batch
+
+    def _run(self):
+        while True:
+            self._predict(self._collect())
+
+    def _predict(self, batch):
+        rows = [row for request in batch for row in request.rows]
+        try:
+            predictions = self.model.predict(pd.DataFrame(rows))
+        except Exception as e:
+            if len(batch) > 1:
+                # retried one at a time so only the bad requests fail
+                logger.warning(f'batch of {len(batch)} requests failed ({e}), retrying them one at a time')
+                for request in batch:
+                    self._predict([request])
+                return
+            logger.exception('prediction failed')
+            batch[0].error = e
+            batch[0].done.set()
+            return
+        self.n_batches += 1
+        start = 0
+        for request in batch:
+            stop = start + len(request.rows)
+            request.predictions = [str(p) for p in predictions[start:stop]]
+            request.batch_size = len(rows)
+            request.done.set()
+            start = stop
+
+
+def request_rows(body, columns=None):
+    """ The records of a /predict body: the body itself or its "rows", each a
+        JSON object with the `columns` (if known). Raises ValueError otherwise.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('expected a JSON object')
+    rows = body['rows'] if 'rows' in body else [body]
+    if not isinstance(rows, list) or not rows:
+        raise ValueError('"rows" must be a non-empty list')
+    for i, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise ValueError(f'row {i} is not a JSON object')
+        missing = [column for column in columns or [] if column not in row]
+        if missing:
+            raise ValueError(f'row {i} is missing {", ".join(missing)}')
+    return rows
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """ POST /predict with a JSON record (or {"rows": [records]}) holding the
+        columns the feature union expects; GET /health and GET /stats.
+    """
+    def _send(self, status, body, latency_ms=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if latency_ms is not None:
+            self.send_header('X-Latency-Ms', f'{latency_ms:.2f}')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send(200, self.server.batcher.stats())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            rows = request_rows(json.loads(self.rfile.read(length)), self.server.batcher.columns)
+        except ValueError as e:
+            self._send(400, {'error': f'bad request: {e}'})
+            return
+        try:
+            predictions, latency_ms, batch_size = self.server.batcher.predict(rows)
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+        logger.info(f'predicted {len(rows)} row(s) in {latency_ms:.2f} ms (batch of {batch_size})')
+        self._send(200, {'predictions': predictions, 'latency_ms': latency_ms,
+                         'batch_size': batch_size}, latency_ms)
+
+    def log_message(self, format, *args):
+        # unix socket clients have no address, so don't use the default logger
+        logger.debug(format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+def make_server(batcher, host='127.0.0.1', port=8080, unix_socket=None):
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batcher = batcher
+    return server
+
+
+@click.command()
+@click.option('--model-path', 'model_path', default=None, help='Local model file, else the default model on S3.')
+@click.option('--host', 'host', default='127.0.0.1')
+@click.option('--port', 'port', default=8080, type=int)
+@click.option('--unix-socket', 'unix_socket', default=None, help='Serve on a unix socket instead of TCP.')
+@click.option('--max-batch-size', 'max_batch_size', default=256, type=int)
+@click.option('--max-wait-ms', 'max_wait_ms', default=10, type=float)
+@click.option('--cache-size', 'cache_size', default=100000, type=int,
+              help='Predictions kept in memory, by feature row and model version; 0 to disable the cache.')
+@click.option('--cache-path', 'cache_path', default=None, help='SQLite file keeping predictions across restarts.')
+@click.option('--cache-disk-size', 'cache_disk_size', default=1000000, type=int,
+              help='Predictions kept in the SQLite file.')
+def main(model_path, host, port, unix_socket, max_batch_size, max_wait_ms, cache_size, cache_path,
+         cache_disk_size):
+    """ Loads the model once and serves predictions until interrupted."""
+    model = load_model(model_path)
+    if model is None:
+        print("Model could not be loaded. Exiting.")
+        return
+    print("Model loaded successfully.")
+    if cache_size > 0:
+        # cached predictions of any other model version are dropped here
+        model = CachedPredictor(model, PredictionCache(cache_size, cache_path, cache_disk_size))
+
+    batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    server = make_server(batcher, host, port, unix_socket)
+    print(f"Serving on {unix_socket or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 import joblib
 import numpy as np
@@ -7,28 +7,44 @@ import os
 from os.path import join as pj
 import pickle as pkl
 from sklearn.utils import class_weight
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.utils.validation import has_fit_parameter
+from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from nltk.corpus import stopwords
-from model_params import parameters
 import botocore
 import boto3
 import joblib
 from datetime import datetime
 import tempfile
 import gc
+import shutil
+import time
 import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 import click
 import sys
+from contextlib import nullcontext
 sys.path.append('../..')
+# after the path is set: model_params imports estimators from src
+from model_params import parameters
 from src.features.custom_transformers import (
     FeatureExtractorText,
     FeatureExtractorOHE,
     FeatureExtractorNumber,
     CustomImputer
 )
+from src.features.build_features import text_vectorizer_name
+from src.features.tokens import set_token_store
+from src.features.sparse_union import SparseFeatureUnion
+from src.data.columnar import load_columnar, feature_columns
+from src.data.instrumentation import Instrumentation
+from src.data.near_duplicates import NearDuplicateIndex
+from src.features.instrumented_union import instrument_union, uninstrument_union
+from src.models.feature_cache import feature_memory, trim_memory
+from src.models.search import SEARCHES, RESOURCES, make_search, search_summary, compare_searches
+from src.models.artifact import search_metadata, save_artifact, upload_artifact
+from src.models.scheduler import UtilizationMonitor, apply_layout, log_utilization, schedule, thread_limits
 
 
 @click.command()
@@ -36,27 +52,74 @@ from src.features.custom_transformers import (
 @click.option('--estimator', 'estimator', required=True, type=click.Choice(list(parameters()[0].keys())))
 @click.option('--test-size', 'test_size', required=True, type=click.Choice([str(i) for i in range(2, 100)]))
 @click.option('--custom-stopwords', 'custom_stopwords', default=[], type=list)
-def main(estimator, test_size, custom_stopwords, use_s3):
+@click.option('--data-format', 'data_format', default='pickle', type=click.Choice(['pickle', 'feather']))
+@click.option('--feature-cache-dir', 'feature_cache_dir', default=None,
+              help='Cache fitted feature unions here so only the classifier is refit per clf__ param.')
+@click.option('--feature-cache-bytes', 'feature_cache_bytes', default=10 * 1024 ** 3, type=int,
+              help='Size cap of the feature cache; least recently used entries are evicted.')
+@click.option('--search', 'search', default='grid', type=click.Choice(SEARCHES),
+              help='Exhaustive grid, randomized, or successive-halving search over the param grid.')
+@click.option('--n-iter', 'n_iter', default=60, type=int,
+              help='Candidates sampled by the random and halving-random searches.')
+@click.option('--budget-seconds', 'budget_seconds', default=None, type=float,
+              help='Stop dispatching new candidates once this much wall-clock time is spent.')
+@click.option('--halving-resource', 'halving_resource', default='n_samples', type=click.Choice(RESOURCES),
+              help='What the halving searches grow between iterations.')
+@click.option('--compare-grid', 'compare_grid', is_flag=True, default=False,
+              help='Also run the exhaustive grid and report best score vs wall-clock for both.')
+@click.option('--queue-dir', 'queue_dir', default=None,
+              help='Job queue of --search queued, which resumes from it after a crash; defaults to '
+                   'data/interim/search_queue_<estimator>. Put it on a shared filesystem for remote workers.')
+@click.option('--schedule/--no-schedule', 'use_scheduler', default=True,
+              help="Split the core and memory budget between search workers and each fit's threads, "
+                   "instead of model_params' n_jobs.")
+@click.option('--cores', 'cores', default=None, type=int, help='Core budget; all available cores if not given.')
+@click.option('--memory-gb', 'memory_gb', default=None, type=float,
+              help='Memory budget; the available memory if not given.')
+@click.option('--probe-rows', 'probe_rows', default=2000, type=int,
+              help='Rows of the fit that estimates memory per candidate; 0 to only count the data.')
+@click.option('--dedupe-threshold', 'dedupe_threshold', default=None, type=float,
+              help='Collapse training charities whose activities and objects are near-duplicates at this '
+                   'Jaccard similarity into one row weighted by their number.')
+@click.option('--metrics-file', 'metrics_file', default=None,
+              help='Write per-stage, per-transformer and per-candidate timings and peak memory here: '
+                   'a Prometheus textfile if it ends in .prom, json otherwise.')
+def main(estimator, test_size, custom_stopwords, use_s3, data_format, feature_cache_dir, feature_cache_bytes,
+         search, n_iter, budget_seconds, halving_resource, compare_grid, queue_dir, use_scheduler, cores,
+         memory_gb, probe_rows, dedupe_threshold, metrics_file):
     """ Trains model on data."""
 
     #print(list(parameters()[0].keys()))
 
     processed_dir = pj(project_dir, 'data', os.environ.get('PROCESSED_DIR'))
-
-    # load data
-    filename = 'data.pkl'
-    _file = open(pj(processed_dir, filename), 'rb')
-    data = pkl.load(_file)
+    instrumentation = Instrumentation()
 
     # load features
     filename = 'feature_union.jlib'
     _file = open(pj(processed_dir, filename), 'rb')
     feature_union = joblib.load(_file)
 
-    # split data in train-test sets
-    data_copy = data.copy()
-    y = data_copy.pop('icnpo')
-    X = data_copy
+    # vectorize from the token ids of build_features --pre-tokenize if present
+    tokens_dir = pj(processed_dir, 'tokens')
+    if os.path.isdir(tokens_dir):
+        set_token_store(feature_union, tokens_dir)
+
+    # load data
+    with instrumentation.stage('train/load') as record:
+        if data_format == 'feather':
+            # memory-map the columnar file and read only the columns the features need
+            columns = feature_columns(feature_union) + ['icnpo']
+            data = load_columnar(pj(processed_dir, 'data.feather'), columns=columns)
+            data['icnpo'] = data['icnpo'].astype(object)
+        else:
+            filename = 'data.pkl'
+            _file = open(pj(processed_dir, filename), 'rb')
+            data = pkl.load(_file)
+        record['rows'] = len(data)
+
+    # split data in train-test sets (popping the target avoids holding a second copy)
+    y = data.pop('icnpo')
+    X = data
 
     X_train, X_test, y_train, y_test = train_test_split(X, y,
                                                 test_size=int(test_size)/100,
@@ -65,17 +128,23 @@ def main(estimator, test_size, custom_stopwords, use_s3):
    
 
     # set up estimator and gridsearch
-    params, job_args = parameters()
+    vectorizer = text_vectorizer_name(feature_union)
+    params, job_args = parameters(vectorizer)
     job_args = job_args['kwargs']
     clf_name = estimator
     estimator = params[clf_name]['estimator']
     param_grid = params[clf_name]['param_grid']
 
-    # create model pipeline
+    # time every step of the union's pipelines, in the search's workers too
+    if metrics_file:
+        feature_union = instrument_union(feature_union)
+
+    # create model pipeline, caching fitted feature unions on disk if requested
+    memory = feature_memory(feature_cache_dir) if feature_cache_dir else None
     pipe = Pipeline([
             ('featureunion', feature_union),
             ('clf', estimator)
-    ])
+    ], memory=memory)
 
     # set class weights
     class_weights = class_weight.compute_class_weight(class_weight='balanced',
@@ -84,6 +153,17 @@ def main(estimator, test_size, custom_stopwords, use_s3):
 
     class_weight_dict = dict(zip(np.unique(y_train), class_weights))
 
+    # collapse near-duplicate training rows (after the class weights, which count every row)
+    fit_params = {}
+    if dedupe_threshold and not has_fit_parameter(estimator, 'sample_weight'):
+        logging.getLogger(__name__).warning(f'{clf_name} can\'t weight rows, so near-duplicates are kept')
+    elif dedupe_threshold:
+        with instrumentation.stage('train/dedupe', rows=len(X_train)) as record:
+            index = NearDuplicateIndex(dedupe_threshold).fit(X_train, y_train)
+            X_train, y_train, fit_params['clf__sample_weight'] = index.collapse(X_train, y_train)
+            record['collapsed_rows'] = len(X_train)
+        del index
+
     # stop words for model
     stoplist = stopwords.words('english')
     if custom_stopwords is True:
@@ -97,15 +177,15 @@ def main(estimator, test_size, custom_stopwords, use_s3):
     fixed_params = {
         'clf__max_iter': 100000,
         'clf__class_weight': class_weight_dict,
-        'featureunion__pipeline-1__countvectorizer__lowercase': True,
-        'featureunion__pipeline-1__countvectorizer__strip_accents': 'unicode',
-        'featureunion__pipeline-1__countvectorizer__stop_words': stoplist,
-        'featureunion__pipeline-2__countvectorizer__lowercase': True,
-        'featureunion__pipeline-2__countvectorizer__strip_accents': 'unicode',
-        'featureunion__pipeline-2__countvectorizer__stop_words': stoplist,
-        'featureunion__pipeline-4__countvectorizer__lowercase': True,
-        'featureunion__pipeline-4__countvectorizer__strip_accents': 'unicode',
-        'featureunion__pipeline-4__countvectorizer__stop_words': stoplist,
+        f'featureunion__pipeline-1__{vectorizer}__lowercase': True,
+        f'featureunion__pipeline-1__{vectorizer}__strip_accents': 'unicode',
+        f'featureunion__pipeline-1__{vectorizer}__stop_words': stoplist,
+        f'featureunion__pipeline-2__{vectorizer}__lowercase': True,
+        f'featureunion__pipeline-2__{vectorizer}__strip_accents': 'unicode',
+        f'featureunion__pipeline-2__{vectorizer}__stop_words': stoplist,
+        f'featureunion__pipeline-4__{vectorizer}__lowercase': True,
+        f'featureunion__pipeline-4__{vectorizer}__strip_accents': 'unicode',
+        f'featureunion__pipeline-4__{vectorizer}__stop_words': stoplist,
         'featureunion__pipeline-1__standardscaler__with_mean': False,
         'featureunion__pipeline-2__standardscaler__with_mean': False,
         'featureunion__pipeline-4__standardscaler__with_mean': False,
@@ -114,6 +194,10 @@ def main(estimator, test_size, custom_stopwords, use_s3):
         'featureunion__pipeline-8__standardscaler__with_mean': False
     }
 
+    # the sparse union already leaves its sparse blocks uncentred
+    if isinstance(feature_union, SparseFeatureUnion):
+        fixed_params = {k: v for k, v in fixed_params.items() if not k.endswith('standardscaler__with_mean')}
+
     # remove fixed params that are not needed for various models
     if 'cart' in clf_name:
         del fixed_params['clf__max_iter']
@@ -124,33 +208,91 @@ def main(estimator, test_size, custom_stopwords, use_s3):
 
     # set model parameters and fit
     pipe.set_params(**fixed_params)
-    searchcv = GridSearchCV(pipe, param_grid=param_grid, **job_args)
-    try:
-        if __name__ == '__main__':
-            searchcv.fit(X_train, y_train)
-    except Exception as e:
-        raise
-        print(e)
-
-    # save model
+
+    # search workers x threads per fit within the core and memory budget
+    layout = None
+    if use_scheduler:
+        with instrumentation.stage('train/schedule'):
+            layout = schedule(pipe, param_grid, X_train, y_train, job_args['cv'], cores=cores,
+                              memory_bytes=memory_gb and int(memory_gb * 1024 ** 3), probe_rows=probe_rows,
+                              n_candidates=n_iter if search in ('random', 'halving-random') else None)
+        job_args = apply_layout(layout, pipe, job_args)
+    interim_dir = pj(project_dir, 'data', os.environ.get('INTERIM_DIR', 'interim'))
+    searchcv = make_search(search, pipe, param_grid, job_args, n_iter=n_iter, budget=budget_seconds,
+                           resource=halving_resource, bytes_limit=feature_cache_bytes,
+                           queue_dir=queue_dir or pj(interim_dir, f'search_queue_{clf_name}'))
+    summaries = []
+    monitor = UtilizationMonitor()
+    with instrumentation.spooling() if metrics_file else nullcontext(), \
+            thread_limits(layout['threads']) if layout else nullcontext():
+        try:
+            if __name__ == '__main__':
+                start = time.perf_counter()
+                # only this search's wall time, which log_utilization compares its fit times with
+                with instrumentation.stage('train/search', rows=len(X_train), estimator=clf_name, search=search), \
+                        monitor:
+                    searchcv.fit(X_train, y_train, **fit_params)
+                summaries.append(search_summary(search, searchcv, time.perf_counter() - start, X_test, y_test))
+                instrumentation.add_search(searchcv, estimator=clf_name, search=search)
+        except Exception as e:
+            raise
+            print(e)
+
+        # the exhaustive grid on the same split, as the reference for the cheaper searches
+        if compare_grid and search != 'grid' and summaries:
+            gridcv = make_search('grid', pipe, param_grid, job_args, bytes_limit=feature_cache_bytes)
+            start = time.perf_counter()
+            with instrumentation.stage('train/search', rows=len(X_train), estimator=clf_name, search='grid'):
+                gridcv.fit(X_train, y_train, **fit_params)
+            summaries.append(search_summary('grid', gridcv, time.perf_counter() - start, X_test, y_test))
+            instrumentation.add_search(gridcv, estimator=clf_name, search='grid')
+            del gridcv
+            gc.collect()
+    if summaries:
+        compare_searches(summaries)
+    if layout and summaries:
+        log_utilization(layout, monitor, searchcv)
+
+    if memory is not None and search != 'grid':
+        trim_memory(memory, feature_cache_bytes)
+
+    # the saved model shouldn't point at this machine's feature cache or token stores
+    if hasattr(searchcv, 'best_estimator_'):
+        searchcv.best_estimator_.set_params(memory=None)
+        union = uninstrument_union(searchcv.best_estimator_.named_steps['featureunion'])
+        searchcv.best_estimator_.steps[0] = ('featureunion', union)
+        set_token_store(searchcv.best_estimator_, None)
+
+    # save the best model alone, with the search's results in a json sidecar;
+    # the search (every fold's results) is released before the model is written
     now = datetime.now().strftime('%Y_%m_%d_%H_%M')
-    filename = f'searchcv_{clf_name}_{now}.jlib'
-    if use_s3 is True:
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(os.environ.get('BUCKET'))
-        with tempfile.TemporaryFile() as fp:
-            key = pj(bucket, filename)
-            joblib.dump(searchcv, fp)
-            fp.seek(0)
-            bucket.put_object(Key=key, Body=fp.read())
-    else:
-        models_dir = pj(project_dir, os.environ.get('MODELS_DIR'))
-        _file = open(pj(models_dir, filename), 'wb')
-        joblib.dump(searchcv, _file)
-    
-    # delete model from memory as it might be large
+    name = f'model_{clf_name}_{now}'
+    meta = search_metadata(searchcv, estimator=clf_name, test_size=int(test_size), searches=summaries)
+    model = getattr(searchcv, 'best_estimator_', searchcv)
     del searchcv
     gc.collect()
+    with instrumentation.stage('train/save'):
+        if use_s3 is True:
+            bucket = boto3.resource('s3').Bucket(os.environ.get('BUCKET'))
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                paths = save_artifact(model, meta, pj(tmp_dir, name))
+                upload_artifact(bucket.meta.client, bucket.name, paths, os.environ.get('MODELS_DIR'))
+            finally:
+                shutil.rmtree(tmp_dir)
+        else:
+            models_dir = pj(project_dir, os.environ.get('MODELS_DIR'))
+            save_artifact(model, meta, pj(models_dir, name))
+
+    # delete model from memory as it might be large
+    del model
+    gc.collect()
+
+    if metrics_file:
+        # which of the union's pipelines the search spent its time in
+        instrumentation.log_summary('features/fit_transform', ['pipeline', 'column'])
+        instrumentation.log_summary('features/transform', ['pipeline', 'column'])
+        instrumentation.write(metrics_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" Predictor for tree models exported by export_model.py.
+
+    The nodes of every tree are flattened into a few contiguous arrays that
+    are memory-mapped from the export directory, and a batch of rows walks
+    all the trees at once, one level per step, instead of calling thousands
+    of estimator objects; pairs of row and tree drop out as they reach a leaf.
+"""
+from os.path import join as pj
+import numpy as np
+from src.models.feature_blocks import BATCH_ROWS, FeatureBlocks, batches
+
+# rows x trees walked per batch, bounds the memory of the node indices
+BATCH_NODES = 2 ** 20
+
+
+class TreeEnsemblePredictor:
+    """ Pure numpy equivalent of an exported Pipeline(featureunion, tree clf)
+        for decision trees, random and extra-trees forests, bagged trees and
+        AdaBoost over trees.
+
+        Rows are a DataFrame or a list of dicts with the dataset's columns.
+        Features are cast to float32 and compared with the thresholds as
+        sklearn does, and the leaf values are summed tree by tree in the
+        ensemble's order, so predictions match the sklearn pipeline.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.features = FeatureBlocks(path)
+        self.meta = self.features.meta
+        self.classes_ = np.array(self.meta['classes'])
+        for name in ('used', 'feature', 'threshold', 'children', 'leaf', 'values', 'roots'):
+            # plain views of the maps, indexing a np.memmap costs a python call each time
+            setattr(self, name, np.asarray(np.load(pj(path, f'trees_{name}.npy'), mmap_mode='r')))
+
+    def _gather(self, rows):
+        """ Dense float32 matrix of the columns the trees split on."""
+        row, col, value = self.features.entries(rows)
+        position = np.searchsorted(self.used, col)
+        found = position < len(self.used)
+        found[found] = self.used[position[found]] == col[found]
+        X = np.zeros((len(rows), max(len(self.used), 1)), dtype=np.float32)
+        X[row[found], position[found]] = value[found]
+        return X
+
+    def _leaf_sums(self, rows):
+        """ Leaf values summed over the trees, in the ensemble's order."""
+        if len(rows) > BATCH_ROWS:
+            return np.concatenate([self._leaf_sums(batch) for batch in batches(rows, BATCH_ROWS)])
+        X = self._gather(rows)
+        n_rows, n_trees = len(X), len(self.roots)
+        sums = np.zeros((n_rows, self.values.shape[1]))
+        batch = max(1, BATCH_NODES // n_trees)
+        for start in range(0, n_rows, batch):
+            X_batch = X[start:start + batch]
+            n_batch, n_cols = X_batch.shape
+            X_flat = X_batch.ravel()
+            # node reached by every (tree, row) pair, tree by tree, and the pairs not yet at a leaf
+            nodes = np.repeat(np.asarray(self.roots), n_batch)
+            active = np.flatnonzero(self.leaf.take(nodes) < 0)
+            start_of_row = active % n_batch * n_cols
+            while active.size:
+                node = nodes.take(active)
+                go_left = X_flat.take(start_of_row + self.feature.take(node)) <= self.threshold.take(node)
+                # the right child follows the left one
+                node = self.children.take(node) + ~go_left
+                nodes[active] = node
+                inner = self.leaf.take(node) < 0
+                active, start_of_row = active[inner], start_of_row[inner]
+            leaves = self.leaf.take(nodes).reshape(n_trees, n_batch)
+            total = sums[start:start + batch]
+            for t in range(n_trees):
+                total += self.values[leaves[t]]
+        return sums
+
+    def decision_function(self, rows):
+        if self.meta['kind'] not in ('samme', 'samme.r'):
+            raise AttributeError('only the exported AdaBoost ensembles have a decision_function')
+        pred = self._leaf_sums(rows) / self.meta['divisor']
+        if len(self.classes_) == 2:
+            pred[:, 0] *= -1
+            return pred.sum(axis=1)
+        return pred
+
+    def predict(self, rows):
+        kind = self.meta['kind']
+        if kind in ('samme', 'samme.r'):
+            decision = self.decision_function(rows)
+            if len(self.classes_) == 2:
+                return self.classes_[(decision > 0).astype(int)]
+            return self.classes_[decision.argmax(axis=1)]
+        if kind == 'forest':
+            return self.classes_[self.predict_proba(rows).argmax(axis=1)]
+        return self.classes_[self._leaf_sums(rows).argmax(axis=1)]
+
+    def predict_proba(self, rows):
+        kind = self.meta['kind']
+        n_classes = len(self.classes_)
+        if kind in ('samme', 'samme.r'):
+            if n_classes == 1:
+                return np.ones((len(rows), 1))
+            decision = self.decision_function(rows)
+            if n_classes == 2:
+                decision = np.vstack([-decision, decision]).T / 2
+            else:
+                decision /= n_classes - 1
+            decision -= decision.max(axis=1).reshape((-1, 1))
+            np.exp(decision, decision)
+            decision /= decision.sum(axis=1).reshape((-1, 1))
+            return decision
+        proba = self._leaf_sums(rows)
+        if kind == 'forest':
+            return proba / self.meta['divisor']
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        return proba / normalizer
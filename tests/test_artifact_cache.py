@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import boto3
+import joblib
+import pytest
+from src.data.artifact_cache import ArtifactCache, LocalSource, file_md5
+from src.models import predict_model
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / 'bucket'
+    write(str(root / 'models' / 'a.jlib'), b'a' * 100)
+    write(str(root / 'models' / 'b.jlib'), b'b' * 100)
+    return LocalSource(str(root))
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    keys = []
+    download = LocalSource.download
+
+    def counting(self, key, dest):
+        keys.append(key)
+        download(self, key, dest)
+
+    monkeypatch.setattr(LocalSource, 'download', counting)
+    return keys
+
+
+def test_local_source_heads_like_a_single_part_upload(source):
+    path = os.path.join(source.root, 'models', 'a.jlib')
+    assert source.head('models/a.jlib') == {'etag': file_md5(path), 'size': 100}
+    with pytest.raises(FileNotFoundError):
+        source.head('models/missing.jlib')
+
+
+def test_fetch_downloads_once_until_the_content_changes(tmp_path, source, downloads):
+    cache = ArtifactCache(source, str(tmp_path / 'cache'))
+    first = cache.fetch('models/a.jlib')
+    assert cache.fetch('models/a.jlib') == first
+    assert downloads == ['models/a.jlib']
+
+    write(os.path.join(source.root, 'models', 'a.jlib'), b'c' * 50)
+    changed = cache.fetch('models/a.jlib')
+    assert changed != first and not os.path.exists(first)
+    with open(changed, 'rb') as f:
+        assert f.read() == b'c' * 50
+    assert downloads == ['models/a.jlib'] * 2
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, source, downloads):
+    cache = ArtifactCache(source, str(tmp_path / 'cache'), max_bytes=150)
+    a = cache.fetch('models/a.jlib')
+    b = cache.fetch('models/b.jlib')
+    assert os.path.exists(b) and not os.path.exists(a)
+    cache.fetch('models/b.jlib')
+    assert downloads == ['models/a.jlib', 'models/b.jlib']
+
+
+def test_truncated_download_is_not_cached(tmp_path, source, monkeypatch):
+    monkeypatch.setattr(LocalSource, 'download', lambda self, key, dest: write(dest, b'a' * 10))
+    cache = ArtifactCache(source, str(tmp_path / 'cache'))
+    with pytest.raises(IOError, match='incomplete'):
+        cache.fetch('models/a.jlib')
+    assert os.listdir(str(tmp_path / 'cache' / 'objects')) == []
+
+
+def test_load_model_offline(tmp_path, monkeypatch):
+    os.makedirs(str(tmp_path / 'bucket' / 'models'))
+    joblib.dump({'model': 'default'}, str(tmp_path / 'bucket' / 'models' / predict_model.DEFAULT_MODEL))
+    monkeypatch.setenv('ARTIFACT_SOURCE_DIR', str(tmp_path / 'bucket'))
+    monkeypatch.setenv('ARTIFACT_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('MODELS_DIR', 'models')
+    monkeypatch.delenv('BUCKET', raising=False)
+
+    def no_s3(*args, **kwargs):
+        raise AssertionError('S3 was called offline')
+
+    monkeypatch.setattr(boto3, 'client', no_s3)
+    assert predict_model.load_model() == {'model': 'default'}
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import socket
+import subprocess
+import sys
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import GridSearchCV
+from src.models.queued_search import DONE, JobQueue, QueuedGridSearchCV, _paths, release_dead_workers
+
+PARAM_GRID = {'C': [0.01, 0.1, 1.0], 'fit_intercept': [True, False]}
+
+
+@pytest.fixture(scope='module')
+def data():
+    X, y = make_classification(n_samples=300, n_features=8, n_informative=4, random_state=0)
+    weights = np.random.RandomState(0).uniform(0.5, 2, len(y))
+    return X, y, weights
+
+
+def queued_search(queue_dir, **kwargs):
+    return QueuedGridSearchCV(LogisticRegression(), PARAM_GRID, queue_dir=str(queue_dir), cv=3, n_jobs=2,
+                              poll_seconds=0.2, **kwargs)
+
+
+def assert_same_results(queued, grid):
+    assert queued.best_params_ == grid.best_params_
+    for key in ('mean_test_score', 'std_test_score', 'rank_test_score', 'split0_test_score'):
+        np.testing.assert_allclose(queued.cv_results_[key], grid.cv_results_[key])
+    assert list(queued.cv_results_['params']) == list(grid.cv_results_['params'])
+
+
+def test_matches_grid_search_with_local_workers(tmp_path, data):
+    X, y, _ = data
+    queued = queued_search(tmp_path / 'queue').fit(X, y)
+    grid = GridSearchCV(LogisticRegression(), PARAM_GRID, cv=3).fit(X, y)
+    assert_same_results(queued, grid)
+    np.testing.assert_allclose(queued.predict_proba(X), grid.predict_proba(X))
+
+
+def test_refit_resumes_from_the_queue(tmp_path, data):
+    X, y, _ = data
+    first = queued_search(tmp_path / 'queue').fit(X, y)
+    queue = JobQueue(_paths(str(tmp_path / 'queue'))[0])
+    assert queue.counts() == {DONE: len(first.cv_results_['params']) * 3}
+
+    # every fit is already done, so the stored results (and their times) come back
+    second = queued_search(tmp_path / 'queue').fit(X, y)
+    np.testing.assert_array_equal(second.cv_results_['mean_fit_time'], first.cv_results_['mean_fit_time'])
+    assert second.best_params_ == first.best_params_
+
+
+def test_changed_search_needs_another_queue(tmp_path, data):
+    X, y, _ = data
+    queued_search(tmp_path / 'queue').fit(X, y)
+    with pytest.raises(ValueError, match='different search'):
+        queued_search(tmp_path / 'queue').fit(X[:-1], y[:-1])
+
+
+def test_sample_weight_follows_the_folds(tmp_path, data):
+    X, y, weights = data
+    queued = queued_search(tmp_path / 'queue').fit(X, y, sample_weight=weights)
+    grid = GridSearchCV(LogisticRegression(), PARAM_GRID, cv=3).fit(X, y, sample_weight=weights)
+    assert_same_results(queued, grid)
+    unweighted = GridSearchCV(LogisticRegression(), PARAM_GRID, cv=3).fit(X, y)
+    assert not np.allclose(queued.cv_results_['mean_test_score'], unweighted.cv_results_['mean_test_score'])
+
+
+def test_jobs_of_dead_local_workers_are_requeued(tmp_path, data):
+    X, y, _ = data
+    split = (np.arange(200), np.arange(200, 300))
+    queue = queued_search(tmp_path / 'queue')._enqueue(X, y, [{'C': 1.0}], [split], {})
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    worker = f'{socket.gethostname()}:{dead.pid}'
+    job = queue.claim(worker)
+    assert queue.running_workers() == [worker]
+
+    release_dead_workers(queue)
+    assert queue.running_workers() == []
+    assert queue.claim('remote:1') == job
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import boto3
+import pytest
+from moto import mock_aws
+from src.data.artifact_cache import ArtifactCache, S3Source
+from src.data.s3_transfer import MB, find_keys, transfer_config, upload_file
+
+BUCKET = 'char-class-test'
+RAW = {
+    'char_class_data/raw/2020/cc_class.csv': b'regno,classtext\n1,General\n',
+    'char_class_data/raw/2020/cc_financial.csv': b'regno,fyend,income,expend\n1,2020-03-31,10,5\n',
+    'char_class_data/raw/2019/cc_class.csv': b'regno,classtext\n',
+    'char_class_data/models/model.jlib': b'model'
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        for key, body in RAW.items():
+            client.put_object(Bucket=BUCKET, Key=key, Body=body)
+        yield client
+
+
+def test_find_keys_takes_the_first_match(client):
+    keys = find_keys(client, BUCKET, ['cc_class.csv', 'cc_financial.csv'])
+    assert keys == {'cc_class.csv': 'char_class_data/raw/2019/cc_class.csv',
+                    'cc_financial.csv': 'char_class_data/raw/2020/cc_financial.csv'}
+
+
+def test_find_keys_under_a_prefix(client):
+    keys = find_keys(client, BUCKET, ['cc_class.csv'], prefix='char_class_data/raw/2020/')
+    assert keys == {'cc_class.csv': 'char_class_data/raw/2020/cc_class.csv'}
+
+
+def test_find_keys_reports_missing_files(client):
+    with pytest.raises(FileNotFoundError, match='CharityBase'):
+        find_keys(client, BUCKET, ['cc_class.csv', 'CharityBase_20200820.csv'], prefix='char_class_data/raw/')
+
+
+def test_fetch_many_writes_verified_copies(client, tmp_path):
+    cache = ArtifactCache(S3Source(BUCKET, client), str(tmp_path / 'cache'))
+    keys = find_keys(client, BUCKET, ['cc_class.csv', 'cc_financial.csv'], prefix='char_class_data/raw/2020/')
+    paths = {key: str(tmp_path / 'raw' / filename) for filename, key in keys.items()}
+    os.makedirs(str(tmp_path / 'raw'))
+    cache.fetch_many(paths)
+    for key, path in paths.items():
+        with open(path, 'rb') as f:
+            assert f.read() == RAW[key]
+
+
+def test_multipart_upload_round_trip(client, tmp_path):
+    path = str(tmp_path / 'data.pkl')
+    content = os.urandom(20 * MB)
+    with open(path, 'wb') as f:
+        f.write(content)
+    config = transfer_config(multipart_chunksize=5 * MB)
+    assert upload_file(client, BUCKET, path, 'char_class_data/processed/data.pkl', config) == \
+        'char_class_data/processed/data.pkl'
+    head = client.head_object(Bucket=BUCKET, Key='char_class_data/processed/data.pkl')
+    # a multipart ETag is "<md5 of the part md5s>-<parts>"
+    assert head['ETag'].strip('"').endswith('-4')
+
+    # downloaded as ranged gets, checked against the size as the ETag isn't an md5
+    cache = ArtifactCache(S3Source(BUCKET, client, config), str(tmp_path / 'cache'))
+    with open(cache.fetch('char_class_data/processed/data.pkl'), 'rb') as f:
+        assert f.read() == content